@@ -0,0 +1,177 @@
+#!/usr/bin/python
+"""Cached column alignment of two .tab matrices for dual pairwise dispatch.
+
+Both .tab files are parsed (see npy_varlist_from_tabfile) and, given column title
+files, their shared columns are copied in the column order of matrix 1 into aligned
+data and mask .npy pairs (see npy_pair_fnames) in work_dir, a block of rows at a time.
+Matrix 1 is the matrix with fewer rows. Without column title files, matrices are
+assumed to be aligned and the parsed .npy pairs are used as they are.
+
+A record of the alignment is saved last to [prefix].align.json, keyed by the SHA-1 of
+the contents of both .tab files and both column title files. If the record's key
+matches and its .npy pairs load with the recorded shapes, align returns it without
+parsing or aligning again, so that all functions and re-dispatches share one alignment.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/align.py tabfile_1=$HOME/gse15745/GSE15745.GPL6104.mRNA.normed.tab tabfile_2=$HOME/gse15745/GSE15745.GPL8178.miRNA.normed.tab tabfile_1_coltitles=$HOME/gse15745/GSE15745.GSE6104.subject_titles.txt tabfile_2_coltitles=$HOME/gse15745/GSE15745.GSE8178.subject_titles.txt outdir=/fs/lustre/osu6683/gse15745 work_dir=/fs/lustre/osu6683/gse15745
+"""
+from util import *
+from manifest import verified
+from numpy.lib.format import open_memmap
+import hashlib
+import json
+import sys
+
+ALIGN_EXT = ".align.json"
+# Rows copied at a time into aligned .npy pairs.
+ROW_BLOCK = 4096
+HASH_BYTES = 2**24
+
+def file_digest(fname):
+  """Return str of hex SHA-1 of the contents of file fname, or '' if fname is None."""
+  if not fname:
+    return ''
+  h = hashlib.sha1()
+  fp = open(fname, 'rb')
+  while True:
+    s = fp.read(HASH_BYTES)
+    if not s: break
+    h.update(s)
+  fp.close()
+  return h.hexdigest()
+
+def align_key(*fnames):
+  """Return str of hex SHA-1 of the contents of files fnames in order."""
+  return hashlib.sha1(",".join([file_digest(fname) for fname in fnames])).hexdigest()
+
+def shared_columns(titles_1, titles_2):
+  """Return (np.array, np.array) of column indices of titles shared by both lists,
+  in the order of titles_1."""
+  titles_1, titles_2 = np.array(titles_1), np.array(titles_2)
+  m1_idxs = np.nonzero(np.in1d(titles_1, titles_2))[0]
+  order = np.argsort(titles_2, kind='mergesort')
+  m2_idxs = order[np.searchsorted(titles_2[order], titles_1[m1_idxs])]
+  assert (titles_1[m1_idxs] == titles_2[m2_idxs]).all()
+  return m1_idxs, m2_idxs
+
+def save_aligned(M, cols, npy_fname, row_block=ROW_BLOCK):
+  """Save columns cols of masked matrix M as a data and mask .npy pair, a block of rows
+  at a time. Return data file name."""
+  data_fname, mask_fname = npy_pair_fnames(npy_fname)
+  shape = (np.size(M,0), len(cols))
+  print "Saving %d rows, %d aligned columns as data %s and mask %s..." % \
+      (shape[0], shape[1], data_fname, mask_fname)
+  D = open_memmap(data_fname, mode='w+', dtype=np.float, shape=shape)
+  B = open_memmap(mask_fname, mode='w+', dtype=np.bool, shape=shape)
+  for a in xrange(0, shape[0], row_block):
+    R = M[a:a+row_block]
+    D[a:a+row_block] = ma.getdata(R)[:,cols]
+    B[a:a+row_block] = ma.getmaskarray(R)[:,cols]
+  D.flush(); B.flush()
+  del D, B
+  return data_fname
+
+def cached(record_fname, key):
+  """Return saved alignment record if it has key and its .npy pairs verify, else None."""
+  try:
+    record = json.load(open(record_fname))
+  except (IOError, ValueError):
+    return None
+  if record.get('key') != key:
+    print "Alignment %s is of different input files." % record_fname
+    return None
+  for i in (1, 2):
+    shape = (record['n%d' % i], record['m'])
+    if not all([verified(fname, shape) for fname in npy_pair_fnames(record['npyfile_%d' % i])]):
+      print "Aligned matrix %s could not be verified." % record['npyfile_%d' % i]
+      return None
+  return record
+
+def align(tabfile_1, tabfile_2, tabfile_1_coltitles=None, tabfile_2_coltitles=None, outdir=WORK_DIR, work_dir=WORK_DIR, n_workers=1, overwrite=False):
+  """Parse and column align two .tab matrices, or reuse a cached alignment.
+
+  Returns:
+    {str: obj} of alignment record: npyfile_1 and npyfile_2 of aligned data .npy files
+      (to open with load_masked), n1 and n2 rows and m columns, coltitles file name
+      (if aligned by titles), swapped if matrix 1 is tabfile_2, and key
+  """
+  assert tabfile_1 and tabfile_2
+  if not (tabfile_1_coltitles and tabfile_2_coltitles):
+    print "No coltitles file specified; assume matrices are already column aligned."
+    tabfile_1_coltitles = tabfile_2_coltitles = None
+  prefix = os.path.join(work_dir, "%s_vs_%s" % (os.path.basename(tabfile_1), os.path.basename(tabfile_2)))
+  record_fname = prefix + ALIGN_EXT
+  key = align_key(tabfile_1, tabfile_2, tabfile_1_coltitles, tabfile_2_coltitles)
+  if not is_dry(overwrite):
+    record = cached(record_fname, key)
+    if record is not None:
+      print "Using cached alignment %s: (%d x %d) M1 and (%d x %d) M2." % \
+          (record_fname, record['n1'], record['m'], record['n2'], record['m'])
+      return record
+
+  data_fname_1, n1, M1 = npy_varlist_from_tabfile(tabfile_1, outdir, overwrite=True, n_workers=n_workers)
+  data_fname_2, n2, M2 = npy_varlist_from_tabfile(tabfile_2, outdir, overwrite=True, n_workers=n_workers)
+  npy_basename_1, npy_basename_2 = os.path.basename(tabfile_1), os.path.basename(tabfile_2)
+
+  # let the smaller matrix be matrix 1
+  swapped = n1 > n2
+  if swapped:
+    print "Matrix 1 [%s] has more rows (%d) than Matrix 2 [%s] (%d)" % \
+        (data_fname_1, n1, data_fname_2, n2)
+    data_fname_1, data_fname_2 = data_fname_2, data_fname_1
+    npy_basename_1, npy_basename_2 = npy_basename_2, npy_basename_1
+    tabfile_1_coltitles, tabfile_2_coltitles = tabfile_2_coltitles, tabfile_1_coltitles
+    n1, n2 = n2, n1
+    M1, M2 = M2, M1
+    print "Swapped matrices 1 and 2 so that matrix 1 is smaller."
+
+  # Print analytics
+  print "Created Matrix 1: %s" % data_fname_1
+  print_matrix_stats(M1)
+  print "Created Matrix 2: %s" % data_fname_2
+  print_matrix_stats(M2)
+
+  coltitles_fname = None
+  if tabfile_1_coltitles and tabfile_2_coltitles:
+    titles1, set1, idx1 = read_samples(tabfile_1_coltitles)
+    titles2, set2, idx2 = read_samples(tabfile_2_coltitles)
+    assert len(titles1) == len(set1) == np.size(M1, 1)
+    assert len(titles2) == len(set2) == np.size(M2, 1)
+    m1_idxs, m2_idxs = shared_columns(titles1, titles2)
+    m = len(m1_idxs)
+    print "Aligned %d cols from %s and %d cols from %s to %d shared columns by sample ID." % \
+        (len(titles1), tabfile_1_coltitles, len(titles2), tabfile_2_coltitles, m)
+    coltitles_fname = os.path.join(work_dir, "%s_vs_%s.coltitles.txt" % (npy_basename_1, npy_basename_2))
+    fp = open(coltitles_fname, "w")
+    fp.write(",".join([titles1[i] for i in m1_idxs])); fp.write("\n")
+    fp.close()
+    print "Wrote %d aligned column titles at %s." % (m, coltitles_fname)
+    npyfile_1 = save_aligned(M1, m1_idxs, os.path.join(work_dir, "%s_aligned_with_%s.pkl" % (npy_basename_1, npy_basename_2)))
+    npyfile_2 = save_aligned(M2, m2_idxs, os.path.join(work_dir, "%s_aligned_with_%s.pkl" % (npy_basename_2, npy_basename_1)))
+  else:
+    m = np.size(M1, 1)
+    assert m == np.size(M2, 1), "Matrices have %d and %d columns." % (m, np.size(M2, 1))
+    npyfile_1, npyfile_2 = data_fname_1, data_fname_2
+  print "Created (%d x %d) M1 and (%d x %d) M2" % (n1, m, n2, m)
+
+  record = {
+    'key': key,
+    'tabfiles': [tabfile_1, tabfile_2],
+    'npyfile_1': npyfile_1,
+    'npyfile_2': npyfile_2,
+    'n1': n1,
+    'n2': n2,
+    'm': m,
+    'coltitles': coltitles_fname,
+    'swapped': swapped,
+    'time': tstamp(),
+  }
+  json.dump(record, open(record_fname, 'w'), indent=1)
+  print "Saved alignment record %s." % record_fname
+  return record
+
+
+if __name__ == "__main__":
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  print args
+  align(**args)
@@ -1,7 +1,17 @@
 #!/usr/bin/python
+import math
 import os
+from collections import OrderedDict
 import numpy as np
+import numpy.ma as ma
+from scipy import special
+from scipy import stats
 from scipy.stats import mstats
+from dcor_fast import dense_rank, dominance_sums
+
+CACHE_SIZE = 4096
+# Largest total size of np.arrays of per-row state cached by a Batch.
+CACHE_BYTES = 2**30
 
 def make_Ms(size, names):
   d = {}
@@ -9,8 +19,223 @@ def make_Ms(size, names):
     d[n] = np.zeros(size)
   return d
 
+def t_test_pv(r, df):
+  """Return two-tailed p-values of correlations r with df degrees of freedom.
+
+  Vectorized form of the t-test used by mstats.pearsonr. As in mstats, the argument of
+  the incomplete beta function is taken as 1 where it is nan, so that the p-value of a
+  nan correlation of a constant vector is 1 (nan with no degrees of freedom).
+  """
+  r = np.clip(r, -1.0, 1.0)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    t_squared = (df / ((1.0 - r) * (1.0 + r))) * r * r
+    z = df/(df + t_squared)
+    pv = special.betainc(0.5*df, 0.5, np.where(z < 1.0, z, 1.0))
+  pv[np.abs(r) == 1.0] = 0.0
+  pv[df < 0] = np.nan
+  return pv
+
+
+def pearson_r_pv(xm, ym):
+  """Return Pearson correlation and two-tailed p-value of centered vectors xm and ym.
+
+  Same arithmetic as mstats.pearsonr: nan if there are fewer than two samples; if a
+  vector is constant, the correlation is nan and the p-value 1.
+  """
+  df = np.size(xm) - 2
+  if df < 0:
+    return np.nan, np.nan
+  with np.errstate(divide='ignore', invalid='ignore'):
+    r = np.add.reduce(xm*ym) / np.sqrt(np.dot(xm, xm) * np.dot(ym, ym))
+  r = np.clip(r, -1.0, 1.0)
+  return r, t_test_pv(np.array([r]), df)[0]
+
+
+def spearman_r_pv(r, n):
+  """Return Spearman correlations and p-values from Pearson correlations r of ranks of n samples.
+
+  As mstats.spearmanr: the correlation is 0 where the ranks of a vector are constant,
+  and the p-value is nan with no degrees of freedom (n == 2). Correlations of fewer than
+  two samples are nan.
+  """
+  r, n = np.array(r, dtype=np.float), np.asarray(n)
+  r[np.isnan(r) & (n >= 2)] = 0.0
+  pv = t_test_pv(r, n-2)
+  pv[np.broadcast_to(n == 2, np.shape(pv))] = np.nan
+  return r, pv
+
+def centered_ranks(x):
+  """Return average ranks of x minus their mean."""
+  r = stats.rankdata(x)
+  return r - r.mean()
+
+
+class Pair(object):
+  """Samples shared by masked rows u and v, computed once per pair.
+
+  Intermediates used by more than one measure (ranks, centered vectors) are computed
+  on first use and reused by every Batch of a FusedBatch.
+  """
+  def __init__(self, u, v, u_key=None, v_key=None):
+    self.mask_u, self.mask_v = ma.getmaskarray(u), ma.getmaskarray(v)
+    self.shared_mask = ~(self.mask_u | self.mask_v)
+    self.X, self.Y = ma.getdata(u)[self.shared_mask], ma.getdata(v)[self.shared_mask]
+    assert np.size(self.X) == np.size(self.Y)
+    self.u_key, self.v_key = u_key, v_key
+    self._ranks, self._centered = None, None
+
+  def own_keys(self):
+    """Return (u, v) cache keys of rows which keep all of their samples (see own_key)."""
+    return own_key(self.u_key, self.mask_u, self.shared_mask), \
+      own_key(self.v_key, self.mask_v, self.shared_mask)
+
+  def ranks(self):
+    """Return (rx, ry) of average ranks of X and Y, as mstats.rankdata."""
+    if self._ranks is None:
+      self._ranks = stats.rankdata(self.X), stats.rankdata(self.Y)
+    return self._ranks
+
+  def centered(self):
+    """Return (X - mean(X), Y - mean(Y))."""
+    if self._centered is None:
+      self._centered = self.X - self.X.mean(), self.Y - self.Y.mean()
+    return self._centered
+
+
+class RowBlock(object):
+  """Rows of a masked matrix prepared once for block (GEMM) computation.
+
+  Each row is centered and scaled by the mean and std of its own unmasked values,
+  which keeps the sums over shared samples well conditioned. Masked values are zero
+  in Z; W is 1.0 where a value is present and 0.0 where it is masked.
+  """
+  def __init__(self, R):
+    R = ma.asarray(R)
+    mask = ma.getmaskarray(R)
+    self.W = (~mask).astype(np.float)
+    D = np.where(mask, 0, ma.getdata(R)).astype(np.float)
+    counts = self.W.sum(1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      self.mean = D.sum(1) / counts
+      C = (D - self.mean[:,None]) * self.W
+      self.std = np.sqrt((C*C).sum(1) / counts)
+    self.std[~(self.std > 0)] = 1.0
+    self.Z = C / self.std[:,None]
+    self.Z[mask] = 0
+    self.full = not mask.any()
+
+  def __len__(self):
+    return np.size(self.Z, 0)
+
+  def rows(self, a, b):
+    """Return a RowBlock view of rows [a, b)."""
+    S = object.__new__(RowBlock)
+    S.W, S.Z = self.W[a:b], self.Z[a:b]
+    S.mean, S.std = self.mean[a:b], self.std[a:b]
+    S.full = self.full or not (S.W == 0).any()
+    return S
+
+
+def shared_moments(P, Q):
+  """Return sums over shared samples for all row pairs of RowBlocks P and Q.
+
+  Returns:
+    (n, c_pp, c_qq, c_pq) of (len(P) x len(Q)) arrays: number of shared samples and
+    centered sums of squares and cross products of the standardized rows.
+  """
+  s_pq = np.dot(P.Z, Q.Z.T)
+  if P.full and Q.full:
+    m = np.size(P.Z, 1)
+    n = np.empty(np.shape(s_pq)); n.fill(m)
+    s_p = P.Z.sum(1)[:,None]
+    s_q = Q.Z.sum(1)[None,:]
+    s_pp = (P.Z*P.Z).sum(1)[:,None]
+    s_qq = (Q.Z*Q.Z).sum(1)[None,:]
+  else:
+    n = np.dot(P.W, Q.W.T)
+    s_p = np.dot(P.Z, Q.W.T)
+    s_q = np.dot(P.W, Q.Z.T)
+    s_pp = np.dot(P.Z*P.Z, Q.W.T)
+    s_qq = np.dot(P.W, (Q.Z*Q.Z).T)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    c_pq = s_pq - s_p*s_q/n
+    c_pp = np.maximum(s_pp - s_p*s_p/n, 0)
+    c_qq = np.maximum(s_qq - s_q*s_q/n, 0)
+  return n, c_pp, c_qq, c_pq
+
+
+def state_nbytes(value):
+  """Return int of bytes of np.arrays in value: an np.array, a tuple or list of values,
+  or an object with such attributes."""
+  if isinstance(value, np.ndarray):
+    return value.nbytes
+  if isinstance(value, (tuple, list)):
+    return sum([state_nbytes(v) for v in value])
+  if hasattr(value, '__dict__'):
+    return sum([state_nbytes(v) for v in vars(value).values()])
+  return 0
+
+
+class RowCache(object):
+  """Bounded least-recently-used cache of per-row state. Counts hits and misses.
+
+  Holds at most size entries and, if max_bytes is not None, np.arrays of at most
+  max_bytes in total (see state_nbytes); a value larger than max_bytes is not cached.
+  """
+  def __init__(self, size=CACHE_SIZE, max_bytes=None):
+    assert size > 0
+    self.size = size
+    self.max_bytes = max_bytes
+    self.items = OrderedDict()
+    self.sizes = {}
+    self.nbytes = 0
+    self.hits, self.misses = 0, 0
+
+  def get(self, key, make):
+    """Return cached value for key; on a miss, cache and return make()."""
+    try:
+      value = self.items.pop(key)
+      self.hits += 1
+    except KeyError:
+      value = make()
+      self.misses += 1
+      nbytes = state_nbytes(value) if self.max_bytes is not None else 0
+      if self.max_bytes is not None and nbytes > self.max_bytes:
+        return value
+      while self.items and (len(self.items) >= self.size or \
+          (self.max_bytes is not None and self.nbytes + nbytes > self.max_bytes)):
+        old, _ = self.items.popitem(last=False)
+        self.nbytes -= self.sizes.pop(old)
+      self.sizes[key] = nbytes
+      self.nbytes += nbytes
+    self.items[key] = value
+    return value
+
+  def __str__(self):
+    total = max(self.hits + self.misses, 1)
+    s = "%d hits, %d misses (%.2f%% hit rate), %d of %d entries used" % \
+      (self.hits, self.misses, self.hits/float(total)*100, len(self.items), self.size)
+    if self.max_bytes is not None:
+      s += ", %.1f of %.1f MB" % (self.nbytes / 2.0**20, self.max_bytes / 2.0**20)
+    return s
+
+
+def own_key(row_key, mask, shared_mask):
+  """Return cache key for a row if its pair keeps all of its own samples, else None.
+
+  Args:
+    row_key: hashable row identifier or None
+    mask: [bool] of the row's own mask, True where values are missing
+    shared_mask: [bool] True where both rows of the pair have values
+  """
+  if row_key is None or np.any(shared_mask == mask):
+    return None
+  return (row_key, mask.tostring())
+
+
 class Batch(object):
   MNAMES = []
+  BLOCK = False
   
   def __init__(self, size=1):
     """Initialize results matrices."""
@@ -22,6 +247,40 @@ class Batch(object):
     """Compute measure of dependencies and save to results matrices."""
     assert np.size(x) == np.size(y) and i >= 0
     raise Exception, "Not Implemented."
+
+  def compute_pair(self, u, v, i, u_key=None, v_key=None):
+    """Compute dependency of masked rows u and v over their shared unmasked samples.
+
+    u_key and v_key are optional hashable row identifiers which subclasses may use to
+    cache per-row state across pairs.
+    """
+    self.compute_shared(Pair(u, v, u_key, v_key), i)
+
+  def compute_shared(self, pair, i):
+    """Compute dependency of the shared samples of a Pair and save to results matrices."""
+    self.compute(pair.X, pair.Y, i)
+
+  def reshape(self, shape):
+    """Reshape all results matrices, e.g., to the shape of a tile."""
+    for name in self.MNAMES:
+      self.Matrices[name] = self.Matrices[name].reshape(shape)
+
+  def report(self):
+    """Return list of str of batch statistics to log, e.g., cache use."""
+    return []
+
+  def prepare_rows(self, R):
+    """Return per-row state of masked row matrix R for use by compute_block."""
+    return RowBlock(R)
+
+  def compute_block(self, P, Q):
+    """Compute dependencies of all row pairs of prepared rows P and Q.
+
+    Each pair uses only samples unmasked in both rows, as in compute.
+    Returns:
+      {str: np.array} of (len(P) x len(Q)) result matrices keyed by MNAMES
+    """
+    raise Exception, "Not Implemented."
   
   def compute_one(self, x, y):
     """Compute one value in the first matrix entry, return it."""
@@ -50,39 +309,347 @@ class Batch(object):
 class PCCBatch(Batch):
   MNAMES = ["PEARSON", "PEARSON_PV"]
   HAS_NEG = True
+  BLOCK = True
   def compute(self, x, y, i):
     assert np.size(x) == np.size(y) and i >= 0
     self.Matrices["PEARSON"][i], self.Matrices["PEARSON_PV"][i] = mstats.pearsonr(x,y)
 
+  def compute_shared(self, pair, i):
+    self.Matrices["PEARSON"][i], self.Matrices["PEARSON_PV"][i] = pearson_r_pv(*pair.centered())
+
+  def compute_block(self, P, Q):
+    n, c_pp, c_qq, c_pq = shared_moments(P, Q)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      r = np.clip(c_pq / np.sqrt(c_pp*c_qq), -1.0, 1.0)
+    return {"PEARSON": r, "PEARSON_PV": t_test_pv(r, n-2)}
+
 class CovBatch(Batch):
   MNAMES = ["COVARIANCE", "STD_PRODUCT", "MIN_STD"]
   HAS_NEG = True
+  BLOCK = True
   def compute(self, x, y, i):
     assert np.size(x) == np.size(y) and i >= 0
     self.Matrices["COVARIANCE"][i] = np.cov(x,y)[0,1]
     self.Matrices["MIN_STD"][i] = min(np.std(x),np.std(y))
     self.Matrices["STD_PRODUCT"][i] = np.std(x) * np.std(y)
+
+  def compute_block(self, P, Q):
+    n, c_pp, c_qq, c_pq = shared_moments(P, Q)
+    scale = P.std[:,None] * Q.std[None,:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+      std_p = P.std[:,None] * np.sqrt(c_pp/n)
+      std_q = Q.std[None,:] * np.sqrt(c_qq/n)
+      return {
+        "COVARIANCE": scale * c_pq / (n-1),
+        "STD_PRODUCT": std_p * std_q,
+        "MIN_STD": np.minimum(std_p, std_q),
+        }
     
+class RankBlock(object):
+  """Rows of a masked matrix ranked once over each row's own unmasked values.
+
+  Pairs of rows with the same mask are computed as Pearson correlations of these ranks
+  by matrix products (see shared_moments); R keeps the masked rows to re-rank pairs
+  with different masks.
+  """
+  def __init__(self, R):
+    self.R = ma.asarray(R)
+    mask = ma.getmaskarray(self.R)
+    D = np.zeros(np.shape(self.R))
+    for j in xrange(np.size(self.R, 0)):
+      D[j, ~mask[j]] = stats.rankdata(ma.getdata(self.R[j])[~mask[j]])
+    self.ranks = RowBlock(ma.array(D, mask=mask))
+    self.count = self.ranks.W.sum(1)
+
+  def __len__(self):
+    return len(self.ranks)
+
+  def rows(self, a, b):
+    """Return a RankBlock view of rows [a, b)."""
+    S = object.__new__(RankBlock)
+    S.R, S.ranks, S.count = self.R[a:b], self.ranks.rows(a, b), self.count[a:b]
+    return S
+
+
 class SpearmanBatch(Batch):
+  """Spearman correlation as the Pearson correlation of ranks.
+
+  compute_shared keeps a bounded LRU cache of centered ranks per row, used whenever a
+  pair keeps all of the row's own samples; otherwise the pair's shared samples are
+  re-ranked. In block mode, rows are ranked once and pairs with equal masks are
+  computed by matrix products; pairs with different masks are re-ranked.
+  """
   MNAMES = ["SPEARMAN", "SPEARMAN_PV"]
   HAS_NEG = True
+  BLOCK = True
+
+  def __init__(self, size=1, cache_size=CACHE_SIZE):
+    self.cache = RowCache(int(cache_size), CACHE_BYTES)
+    super(SpearmanBatch, self).__init__(size)
+
   def compute(self, x, y, i):
     assert np.size(x) == np.size(y) and i >= 0
     self.Matrices["SPEARMAN"][i], self.Matrices["SPEARMAN_PV"][i] = mstats.spearmanr(x,y)
 
+  def compute_shared(self, pair, i):
+    ranks = []
+    for z, key, r in zip((pair.X, pair.Y), pair.own_keys(), (0, 1)):
+      if key is None:
+        rz = pair.ranks()[r]
+        ranks.append(rz - rz.mean())
+      else:
+        ranks.append(self.cache.get(key, lambda: centered_ranks(z)))
+    r, pv = spearman_r_pv([pearson_r_pv(*ranks)[0]], np.size(ranks[0]))
+    self.Matrices["SPEARMAN"][i], self.Matrices["SPEARMAN_PV"][i] = r[0], pv[0]
+
+  def report(self):
+    return ["Rank cache: %s" % self.cache]
+
+  def prepare_rows(self, R):
+    return RankBlock(R)
+
+  def compute_block(self, P, Q):
+    n, c_pp, c_qq, c_pq = shared_moments(P.ranks, Q.ranks)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      r = np.clip(c_pq / np.sqrt(c_pp*c_qq), -1.0, 1.0)
+    # Pairs which do not share all of both rows' samples must be re-ranked.
+    differ = P.count[:,None] + Q.count[None,:] - 2*n > 0
+    for a, b in zip(*np.nonzero(differ)):
+      rx, ry = Pair(P.R[a], Q.R[b]).ranks()
+      r[a,b] = pearson_r_pv(rx - rx.mean(), ry - ry.mean())[0]
+    r, pv = spearman_r_pv(r, n)
+    return {"SPEARMAN": r, "SPEARMAN_PV": pv}
+
 class EuclideanBatch(Batch):
+  """Euclidean distance over shared samples.
+
+  In block mode, squared distances of all row pairs are computed by matrix products
+  as ||x||^2 + ||y||^2 - 2x.y over shared samples. Rows are first centered by their
+  own means (RowBlock) to avoid cancellation; the difference d of row means is added
+  back as 2d*sum(x'-y') + n*d^2, where x' and y' are centered rows.
+  """
   MNAMES = ["EUCLIDEAN"]
+  BLOCK = True
+
   def compute(self,x,y,i):
     assert np.size(x) == np.size(y) and i >= 0
     q=x-y
-    self.Matrices["EUCLIDEAN"][i] = np.sqrt((q*q.T).sum())
+    self.Matrices["EUCLIDEAN"][i] = np.sqrt(np.dot(q,q))
+
+  def compute_block(self, P, Q):
+    X, Y = P.Z * P.std[:,None], Q.Z * Q.std[:,None]
+    d = P.mean[:,None] - Q.mean[None,:]
+    s_pq = np.dot(X, Y.T)
+    if P.full and Q.full:
+      # Centered rows sum to 0 over all samples.
+      n = np.size(X, 1)
+      ss = (X*X).sum(1)[:,None] + (Y*Y).sum(1)[None,:] - 2*s_pq + n*d*d
+    else:
+      n = np.dot(P.W, Q.W.T)
+      s_p, s_q = np.dot(X, Q.W.T), np.dot(P.W, Y.T)
+      ss = np.dot(X*X, Q.W.T) + np.dot(P.W, (Y*Y).T) - 2*s_pq + 2*d*(s_p - s_q) + n*d*d
+      # Pairs without shared samples have distance 0, as in compute.
+      ss[n == 0] = 0
+    return {"EUCLIDEAN": np.sqrt(np.maximum(ss, 0))}
+
+class KendallRow(object):
+  """Per-sample state of one variable for Kendall tau: dense ranks, sort order, and
+  sums over tied groups of sizes k used by the tie corrections."""
+  def __init__(self, x):
+    self.n = np.size(x)
+    self.rank = dense_rank(x)
+    self.order = np.argsort(x, kind='mergesort')
+    k = np.bincount(self.rank).astype(np.float)
+    self.has_ties = bool((k > 1).any())
+    self.t1 = (k*(k-1)).sum()
+    self.t2 = (k*(k-1)*(k-2)).sum()
+    self.t5 = (k*(k-1)*(2*k+5)).sum()
+
+
+def kendall_exact_pv(n, C):
+  """Return exact two-tailed p-value of C concordant pairs of n untied samples.
+
+  Same recurrence as mstats.kendalltau(method='exact') (Kendall, Rank Correlation
+  Methods, 1970); O(n*c) time for c = min(C, n*(n-1)/2 - C).
+  """
+  c = int(min(C, n*(n-1)/2 - C))
+  if n <= 2:
+    return 1.0
+  if c == 0:
+    return 2.0/math.factorial(n)
+  if c == 1:
+    return 2.0/math.factorial(n-1)
+  new = [0.0]*(c+1)
+  new[0], new[1] = 1.0, 1.0
+  for j in xrange(3, n+1):
+    old = new[:]
+    for k in xrange(1, min(j, c+1)):
+      new[k] += new[k-1]
+    for k in xrange(j, c+1):
+      new[k] += new[k-1] - old[k-j]
+  return 2.0*sum(new)/math.factorial(n)
+
+def kendall_tau_pv(sx, sy, method='auto'):
+  """Return Kendall tau-b and two-tailed p-value of KendallRows sx and sy.
+
+  Knight's O(n log n) algorithm: samples are sorted by x then y, and concordant pairs
+  are counted by dominance_sums over the y ranks. As in mstats.kendalltau, method
+  'auto' uses the exact p-value (kendall_exact_pv) if neither row has ties and n <= 33
+  or at most one pair is concordant or discordant, and otherwise method 'asymptotic':
+  the normal approximation with tie corrections.
+  """
+  n = sx.n
+  assert n == sy.n
+  if n < 2:
+    return np.nan, np.nan
+  if sx.has_ties:
+    order = np.lexsort((sy.rank, sx.rank))
+  else:
+    order = sx.order
+  ry = sy.rank[order]
+  # Pairs p < q in sorted order with y_p < y_q; pairs tied in x are counted if y_p < y_q.
+  A = dominance_sums(ry, np.ones((1, n)))[0].sum()
+  # Pairs tied in both x and y.
+  t_xy = 0.0
+  if sx.has_ties and sy.has_ties:
+    key = sx.rank[order] * n + ry
+    ends = np.concatenate((np.nonzero(key[1:] != key[:-1])[0], [n-1]))
+    k = np.diff(np.concatenate(([-1], ends))).astype(np.float)
+    t_xy = (k*(k-1)).sum() / 2
+  n_pairs = n*(n-1) / 2.
+  C = A - (sx.t1/2 - t_xy)
+  D = n_pairs - A - sy.t1/2
+  ties = sx.has_ties or sy.has_ties
+  if method == 'exact':
+    assert not ties, "Ties found, exact method cannot be used."
+  elif method == 'auto':
+    method = 'exact' if not ties and (n <= 33 or min(C, n_pairs - C) <= 1) else 'asymptotic'
+  else:
+    assert method == 'asymptotic', "Unknown method %s." % method
+  with np.errstate(divide='ignore', invalid='ignore'):
+    tau = (C-D) / np.sqrt((n*(n-1)-sx.t1)/2. * (n*(n-1)-sy.t1)/2.)
+    var_s = n*(n-1)*(2*n+5) - sx.t5 - sy.t5
+    v1 = sx.t1 * sy.t1 / (2.*n*(n-1))
+    if n > 2:
+      v2 = sx.t2 * sy.t2 / (9.*n*(n-1)*(n-2))
+    else:
+      v2 = 0
+    var_s = var_s / 18. + (v1 + v2)
+    z = (C-D) / np.sqrt(var_s)
+  if method == 'exact':
+    return tau, kendall_exact_pv(n, C)
+  return tau, special.erfc(abs(z)/np.sqrt(2))
+
 
-#  'kendalltau': lambda x,y: mstats.kendalltau(x,y)[0],
 class KendallBatch(Batch):
+  """Kendall tau-b in O(n log n) per pair (see kendall_tau_pv).
+
+  compute_shared keeps a bounded LRU cache of per-row KendallRow state (ranks and sort
+  order) used whenever a pair keeps all of the row's own samples. method is the
+  p-value method of mstats.kendalltau: 'auto' (default, as mstats), 'exact', or
+  'asymptotic'.
+  """
   MNAMES = ["KENDALL", "KENDALL_PV"]
+  HAS_NEG = True
+
+  def __init__(self, size=1, cache_size=CACHE_SIZE, method='auto'):
+    self.cache = RowCache(int(cache_size), CACHE_BYTES)
+    self.method = method
+    super(KendallBatch, self).__init__(size)
+
   def compute(self,x,y,i):
     assert np.size(x) == np.size(y) and i >= 0
-    k, p = mstats.kendalltau(x,y)
+    if self.method == 'auto':
+      k, p = mstats.kendalltau(x,y)
+    else:
+      k, p = mstats.kendalltau(x,y,method=self.method)
     self.Matrices["KENDALL"][i] = k
     self.Matrices["KENDALL_PV"][i] = p
 
+  def compute_shared(self, pair, i):
+    states = []
+    for z, key in zip((pair.X, pair.Y), pair.own_keys()):
+      if key is None:
+        states.append(KendallRow(z))
+      else:
+        states.append(self.cache.get(key, lambda: KendallRow(z)))
+    self.Matrices["KENDALL"][i], self.Matrices["KENDALL_PV"][i] = kendall_tau_pv(states[0], states[1], self.method)
+
+  def report(self):
+    return ["KendallRow cache: %s" % self.cache]
+
+
+class FusedRows(object):
+  """Prepared rows of each Batch of a FusedBatch; Batches that prepare rows the same
+  way share one preparation."""
+  def __init__(self, rows):
+    self.by_name = rows
+
+  def __len__(self):
+    return len(self.by_name.values()[0])
+
+  def rows(self, a, b):
+    S = object.__new__(FusedRows)
+    views = {}
+    S.by_name = {}
+    for name, R in self.by_name.items():
+      if id(R) not in views:
+        views[id(R)] = R.rows(a, b)
+      S.by_name[name] = views[id(R)]
+    return S
+
+
+class FusedBatch(Batch):
+  """Several Batches computed in one pass over the pairs.
+
+  Each pair's shared samples are extracted once (see Pair) and passed to every Batch.
+  Each Batch keeps its own results matrices, which are saved exactly as if that
+  function were run separately.
+  """
+  def __init__(self, size=1, batches=None):
+    """batches: [(str, Batch)] of function names and Batch instances of this size."""
+    assert batches
+    self.batches = OrderedDict(batches)
+    self.MNAMES = []
+    for B in self.batches.values():
+      assert not set(B.MNAMES) & set(self.MNAMES), "Matrix names must be distinct."
+      self.MNAMES += B.MNAMES
+    self.BLOCK = all([B.BLOCK for B in self.batches.values()])
+    self.size = size
+    self._link()
+
+  def _link(self):
+    self.Matrices = {}
+    for B in self.batches.values():
+      self.Matrices.update(B.Matrices)
+
+  def compute(self, x, y, i):
+    for B in self.batches.values():
+      B.compute(x, y, i)
+
+  def compute_shared(self, pair, i):
+    for B in self.batches.values():
+      B.compute_shared(pair, i)
+
+  def reshape(self, shape):
+    for B in self.batches.values():
+      B.reshape(shape)
+    self._link()
+
+  def report(self):
+    return sum([B.report() for B in self.batches.values()], [])
+
+  def prepare_rows(self, R):
+    rows, done = {}, {}
+    for name, B in self.batches.items():
+      prepare = type(B).prepare_rows.im_func
+      if prepare not in done:
+        done[prepare] = B.prepare_rows(R)
+      rows[name] = done[prepare]
+    return FusedRows(rows)
+
+  def compute_block(self, P, Q):
+    results = {}
+    for name, B in self.batches.items():
+      results.update(B.compute_block(P.by_name[name], Q.by_name[name]))
+    return results
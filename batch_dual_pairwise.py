@@ -8,64 +8,146 @@ TODO: this should be integrated with batch_pairwise to reduce redundant code.
 2) get offset row of first matrix
 3) compute all dependencies of offset row with other matrix
 4) save results to disk
+
+Add keep=topk:K or keep=abs_gt:T to save only the strongest pairs of the offset row as
+records in [batchname].sparse.npy (see sparse_edges.py).
+
+MULTI-ROW MODE:
+  Give end=E to compare rows [offset, E) of M1 with all rows of M2 in one batch.
+  Results are saved as (E-offset by M2 rows) matrices named
+  [id]_[offset]_[E].[matrix].npy, which compile_dual_pairwise.py places by row.
+  Add block=True to compute the block by matrix products for functions that support it
+  (Batch.BLOCK, see batch_pairwise.py), comparing "tile" rows of M2 at a time.
+
+Add timing=True to save stage times to [batchname].metrics.json (see metrics.py).
 """
 from util import *
 import numpy.ma as ma
+import metrics
+from metrics import StageTimer, METRICS_EXT, stage
+import sparse_edges
 import sys
 
 #BATCH_CMD = "time python %(script_path)s/batch_dual_pairwise.py npyfile_1=%(npyfile_1)s npyfile_2=%(npyfile_2)s offset=%(offset)d work_dir=%(work_dir)s function=%(function)s >> %(stdout_fname)s 2>> %(stderr_fname)s"
 
 REPORT_N = 50000
+TILE = 512
+
+def compute_rows(F, M1, M2, offset, end, verbose=False, timer=None):
+  """Compute pairs of rows [offset, end) of M1 with all rows of M2 one pair at a time."""
+  n2 = np.size(M2,0)
+  for x in xrange(offset, end):
+    for i in xrange(n2):
+      j = (x-offset)*n2 + i
+      if j % REPORT_N == 0:
+        print "Generating pair of row %d with row %d (#%d of %d total)..." % \
+          (x, i, j+1, (end-offset)*n2)
+        if timer is not None:
+          print timer.progress(j, (end-offset)*n2)
+      # Mask pairs with at least one missing value; key rows by (matrix, row number).
+      metrics.compute_pair(F, M1[x], M2[i], j, (1, x), (2, i), timer)
+      if verbose:
+        d = F.get(j)
+        s = " ".join(["%s=%f"%(k,v) for k,v in d.items()])
+        print "%d,%d: " % (x,i), s
 
-def main(npyfile_1=None, npyfile_2=None, offset=None, work_dir=None, function=None, batchname=None, verbose=False):
+def compute_dual_blocks(F, M1, M2, offset, end, tile=TILE, timer=None):
+  """Compute pairs of rows [offset, end) of M1 with all rows of M2 using F.compute_block."""
+  n1, n2 = end-offset, np.size(M2,0)
+  with stage(timer, 'mask'):
+    P = F.prepare_rows(ma.array(M1[offset:end], copy=True))
+  for b in xrange(0, n2, tile):
+    print "Computing block rows %d through %d versus rows %d through %d..." % \
+      (offset, end-1, b, min(b+tile, n2)-1)
+    with stage(timer, 'mask'):
+      Q = F.prepare_rows(ma.array(M2[b:b+tile], copy=True))
+    for a in xrange(0, n1, tile):
+      with stage(timer, 'compute'):
+        R = F.compute_block(P.rows(a, a+tile), Q)
+      for name in F.MNAMES:
+        F.Matrices[name].reshape(n1, n2)[a:a+tile, b:b+tile] = R[name]
+
+def main(npyfile_1=None, npyfile_2=None, offset=None, work_dir=None, function=None, batchname=None, verbose=False, backend=None, cache_size=None, cache_mb=None, M1=None, M2=None, keep=None, end=None, block=False, tile=TILE, timing=False):
   assert npyfile_1 and npyfile_2 and work_dir
   assert function in FUNCTIONS
   offset = int(offset)
   assert offset >= 0
+  block, tile = is_dry(block), int(tile)
+  assert tile > 0
+  timer = StageTimer() if is_dry(timing) else None
+  if keep is not None:
+    sparse_edges.parse_keep(keep)
+  multi_row = end is not None and end not in ("None", "NONE", "none")
+  if multi_row:
+    end = int(end)
+  else:
+    end = offset + 1
+  assert offset < end
   if batchname is None or batchname in ("None", "NONE", "none"):
     batchname = "%s_vs_%s_%s_%d" % \
       (os.path.basename(npyfile_1), os.path.basename(npyfile_2), function, offset)
+    if multi_row:
+      batchname += "_%d" % end
 
-  M1 = ma.load(npyfile_1) # these should be pickles
-  M2 = ma.load(npyfile_2)
-  assert offset < np.size(M1, 0)
-  assert np.count_nonzero(np.isnan(M1.compressed())) == 0
+  with stage(timer, 'load'):
+    if M1 is None:
+      M1 = load_masked(npyfile_1)
+    if M2 is None:
+      M2 = load_masked(npyfile_2)
+  assert end <= np.size(M1, 0)
+  assert np.count_nonzero(np.isnan(M1[offset:end].compressed())) == 0
   assert np.count_nonzero(np.isnan(M2.compressed())) == 0
 
   # Get batch function handler for this function.
-  size = np.size(M2,0)
-  F = FUNCTIONS[function](size)
+  n2 = np.size(M2,0)
+  size = (end-offset) * n2
+  F_kwds = {}
+  if backend is not None:
+    print "Using %s backend %s." % (function, backend)
+    F_kwds['backend'] = backend
+  if cache_size is not None:
+    F_kwds['cache_size'] = int(cache_size)
+  if cache_mb is not None:
+    F_kwds['cache_mb'] = float(cache_mb)
+  F = FUNCTIONS[function](size, **F_kwds)
   if verbose:
     print "Vebose: Try F on n=700 identity."
     print F.compute_one(np.arange(700), np.arange(700))
 
   # Compute pairs using batch handler `F`
-  print "Starting to write %d pairs for %s" % (size, batchname)
-  for i in xrange(np.size(M2,0)):
-    if i % REPORT_N == 0:
-      print "Generating pair %d (to %d) in %s..." % \
-        (i, size, batchname)
-    # Mask pairs with at least one missing value
-    shared_mask = ~(M1[offset].mask | M2[i].mask)
-    X, Y = M1[offset][shared_mask].data, M2[i][shared_mask].data
-    assert np.size(X) == np.size(Y) <= np.size(M1,1)
-
-    F.compute(X,Y,i)
-    if verbose:
-      d = F.get(i)
-      s = " ".join(["%s=%f"%(k,v) for k,v in d.items()])
-      print "%d: " % (i), s
+  print "Starting to write %d pairs of rows %d through %d for %s" % (size, offset, end-1, batchname)
+  if block:
+    assert F.BLOCK, "Function %s does not support block mode." % function
+    compute_dual_blocks(F, M1, M2, offset, end, tile, timer)
+  else:
+    compute_rows(F, M1, M2, offset, end, verbose, timer)
+  if multi_row:
+    F.reshape((end-offset, n2))
     
-  print "Computed %d pairs for %s using %s." % (n, batchname, function)
+  print "Computed %d pairs for %s using %s." % (size, batchname, function)
+  for line in F.report():
+    print line
   n_nans = F.nans()
   print "%d nans" % (n_nans)
   if n_nans > 0:
     print "!!!WARNING: There exists at least one (%d) not-a-numbers (nans) in this batch." % (n_nans)
 
-  out_names = F.save(work_dir, batchname)
-  print "Saving %d results as:" % (n)
-  for name, out_name in out_names.items():
-    print "%s: %s" % (name, out_name)
+  with stage(timer, 'save'):
+    if keep is not None:
+      # Save only the pairs selected by keep.
+      x, y = np.divmod(np.arange(size), n2)
+      sparse_edges.save_sparse(F, work_dir, batchname, x + offset, y, keep, symmetric=False)
+    else:
+      out_names = F.save(work_dir, batchname)
+      print "Saving %d results as:" % (size)
+      for name, out_name in out_names.items():
+        print "%s: %s" % (name, out_name)
+
+  if timer is not None:
+    for line in timer.report():
+      print line
+    timer.save(os.path.join(work_dir, batchname + METRICS_EXT), size,
+      function=function, batchname=batchname, block=block)
   
   
 if __name__ == "__main__":
@@ -5,20 +5,222 @@ EXAMPLE MANUAL USE:
   time python $HOME/dependency_matrix_dispatcher/batch_pairwise.py function=dcor npyfile=/fs/lustre/osu6683/GSE7307.normed.tab.pkl work_dir=/fs/lustre/osu6683/gse7307/manual_test n=54675 start=5 end=15 verbose=True
 
   parameter "n" is the number of rows (variables) in the matrix
+  parameter "npyfile" may also be a .data.npy file, which is opened memory-mapped
+    with its paired .mask.npy file so that only rows used by this batch are read.
+
+BLOCK MODE:
+  Add block=True to compute pairs a tile of rows at a time for functions that
+  support it (Batch.BLOCK, e.g., pearson, covariance, spearman, and euclidean). Rows are prepared
+  once and all pairs of a (tile x tile) block are computed by matrix products. "tile"
+  sets the number of rows per tile side (default TILE).
+  Block results are not bit-identical to the per-pair path because sums are
+  accumulated in a different order. With or without missing values, correlations and
+  their p-values agree to about 1e-14 absolute error, covariances to about 1e-15 of
+  STD_PRODUCT, and euclidean distances to about 1e-15 relative error.
+
+TILE MODE:
+  Give rows=x0:x1 cols=y0:y1 rather than start and end to compute all pairs (x, y),
+  x < y, of a rectangular tile of the upper triangle. Only those rows are loaded.
+  Results are saved as (x1-x0 by y1-y0) matrices named [id]_tile_x0_x1_y0_y1.[matrix].npy
+  with nan where x >= y; compile_pairwise.py scatters them into condensed order.
+
+METRICS:
+  Add timing=True to time stages load, mask, compute, and save, log pairs/sec and
+  ETA, and save them with peak memory to [batchname].metrics.json (see metrics.py).
+
+PERMUTATION TESTS:
+  Add n_perm=B (and optionally alpha=0.05) with function=dcor to also save DCOR_PV,
+  permutation test p-values from up to B permutations per pair (see
+  dcor_batch.permutation_pv).
+
+THREADS:
+  Add n_threads=T with function=dcor and backend cpy (the default) to compute each pair's
+  distance sums on T OpenMP threads, e.g., one process per node with T cores rather than
+  T processes; n_threads=0 uses all threads. dcor_cpy must be compiled with OpenMP (see
+  setup_cython.py).
+
+CASCADE SCREENING:
+  Add screen=MEASURE:abs_gt:T or screen=MEASURE:top:F, e.g., screen=pearson:abs_gt:0.3
+  with function=dcor, to first score all pairs of the batch with a cheap measure
+  (pearson, spearman, or dcor_sub) and compute the function only on pairs whose score is
+  greater than T or among the fraction F of the batch with the largest scores. Pairs
+  which are screened out are saved as nan, so compile_pairwise.py leaves them unset
+  (see cascade.py). Not used with block=True.
+
+SPARSE OUTPUT:
+  Add keep=topk:K or keep=abs_gt:T to save only the strongest pairs of the batch as
+  (x, y, values) records in [batchname].sparse.npy rather than dense matrices (see
+  sparse_edges.py); compile_pairwise.py merges them.
+
+FUSED FUNCTIONS:
+  Give several functions joined by '+', e.g., function=pearson+spearman+dcor, to
+  compute them all in one pass: each pair's shared samples (and ranks and centered
+  vectors) are computed once for all functions. Each function's results are saved in
+  the work_dir subdirectory named for the function with the same file names as a
+  separate run. Functions whose outputs already exist are skipped.
 """
 from util import *
 import numpy.ma as ma
 from py_symmetric_matrix import *
+import cascade
+import manifest
+import metrics
+from metrics import StageTimer, METRICS_EXT, stage
+import sparse_edges
 import sys
 import cPickle as pickle
 
 #BATCH_CMD = "time python %(script_path)s/batch_pairwise.py npyfile=%(npyfile)s offset=%(offset)d k=%(k)d work_dir=%(work_dir)s function=%(function)s n=%(n)d >> %(stdout_fname)s 2>> %(stderr_fname)s"
 REPORT_N = 10000
+TILE = 512
+
+def row_segments(start, end, n):
+  """Split condensed pair range [start, end) into runs of pairs sharing row x.
+
+  Returns:
+    [(x, y_start, y_end, i)] where pairs (x, y) for y in [y_start, y_end) have batch
+    offsets i, i+1, ... in condensed order.
+  """
+  segments = []
+  j = start
+  while j < end:
+    x, y = inv_sym_idx(j, n)
+    y_end = min(n, y + end - j)
+    segments.append((x, y, y_end, j - start))
+    j += y_end - y
+  return segments
+
+def pair_rows(start, end, n):
+  """Return (np.array, np.array) of rows x and y of pairs in condensed range [start, end)."""
+  x, y = np.empty(end-start, dtype=np.int64), np.empty(end-start, dtype=np.int64)
+  for r, y_start, y_end, i in row_segments(start, end, n):
+    x[i:i+y_end-y_start] = r
+    y[i:i+y_end-y_start] = np.arange(y_start, y_end)
+  return x, y
+
+def compute_blocks(F, M, start, end, n, tile=TILE, timer=None):
+  """Compute all pairs in [start, end) using F.compute_block on (tile x tile) blocks."""
+  segments = row_segments(start, end, n)
+  lo = segments[0][0]
+  hi = max([s[2] for s in segments])
+  print "Preparing rows %d through %d for block computation..." % (lo, hi-1)
+  with stage(timer, 'mask'):
+    S = F.prepare_rows(M[lo:hi])
+  for t in xrange(0, len(segments), tile):
+    T = segments[t:t+tile]
+    x0, x1 = T[0][0], T[-1][0]+1
+    y0, y1 = min([s[1] for s in T]), max([s[2] for s in T])
+    print "Computing block rows %d through %d (#%d of %d total) versus rows %d through %d..." % \
+      (x0, x1-1, T[0][3]+1, end-start, y0, y1-1)
+    P = S.rows(x0-lo, x1-lo)
+    for c0 in xrange(y0, y1, tile):
+      c1 = min(c0+tile, y1)
+      with stage(timer, 'compute'):
+        R = F.compute_block(P, S.rows(c0-lo, c1-lo))
+      for x, y_start, y_end, i in T:
+        a, b = max(y_start, c0), min(y_end, c1)
+        if a >= b: continue
+        for name in F.MNAMES:
+          F.Matrices[name][i+a-y_start:i+b-y_start] = R[name][x-x0, a-c0:b-c0]
+
+def compute_pairs(F, M, start, end, n, batchname, verbose=False, timer=None):
+  """Compute all pairs in [start, end) one pair at a time using F.compute."""
+  for i, j in enumerate(xrange(start, end)):
+    if i % REPORT_N == 0:
+      print "Generating pair %d (to %d), (#%d of %d total) in %s..." % \
+        (j, end-1, i+1, end-start, batchname)
+      if timer is not None:
+        print timer.progress(i, end-start)
+    # Carefully check indexing schemes...
+    x, y = inv_sym_idx(j, n)
+    assert x >= 0 and y >= 0 and x < np.size(M,0) and y < np.size(M,0)
+    idx_check = sym_idx(x,y,n)
+    assert idx_check == j and idx_check >= start and idx_check < end
+
+    # Remove samples with at least one missing value; rows are keyed by row number.
+    metrics.compute_pair(F, M[x], M[y], i, x, y, timer)
+    if verbose:
+      d = F.get(i)
+      s = " ".join(["%s=%f"%(k,v) for k,v in d.items()])
+      print "%d->%d: " % (i,j), s
+
+def screen_pairs(S, M, start, end, n, A=None, B=None, x0=0, y0=0, tile=TILE):
+  """Compute screening Batch S on pairs of range [start, end), or of the tile of rows A
+  numbered from x0 and B from y0 if A is not None.
 
-def main(npyfile=None, work_dir=None, function=None, n=None, start=None, end=None, batchname=None, verbose=False, *args, **kwds):
+  Returns:
+    (np.array, np.array, int) of rows x and y of each pair and number of unused pairs
+  """
+  if A is not None:
+    n_unused = compute_tile(S, A, B, x0, y0, S.BLOCK, tile)
+    x, y = np.divmod(np.arange(np.size(A,0)*np.size(B,0)), np.size(B,0))
+    return x + x0, y + y0, n_unused
+  if S.BLOCK:
+    compute_blocks(S, M, start, end, n, tile)
+  else:
+    compute_pairs(S, M, start, end, n, "screen")
+  x, y = pair_rows(start, end, n)
+  return x, y, 0
+
+def compute_screened(F, A, B, x, y, chosen, x0=0, y0=0, timer=None):
+  """Compute chosen pairs (x[i], y[i]) of rows A numbered from x0 and B from y0 at
+  index i; results of other pairs are nan."""
+  idx = np.nonzero(chosen)[0]
+  for c, i in enumerate(idx):
+    if c % REPORT_N == 0:
+      print "Generating screened pair (%d, %d) (#%d of %d selected)..." % (x[i], y[i], c+1, np.size(idx))
+      if timer is not None:
+        print timer.progress(c, np.size(idx))
+    metrics.compute_pair(F, A[x[i]-x0], B[y[i]-y0], i, x[i], y[i], timer)
+  cascade.unset(F, chosen)
+
+def parse_span(span):
+  """Return (int, int) from a str "a:b"."""
+  a, b = map(int, str(span).split(':'))
+  assert 0 <= a < b, span
+  return a, b
+
+def compute_tile(F, A, B, x0, y0, block=False, tile=TILE, verbose=False, timer=None):
+  """Compute all pairs (x, y), x < y, of rows A numbered from x0 and rows B from y0.
+
+  Results for pair (x, y) are at index (x-x0)*len(B) + (y-y0); pairs with x >= y are nan.
+  """
+  n_a, n_b = np.size(A,0), np.size(B,0)
+  below = (np.arange(n_a)[:,None] + x0) >= (np.arange(n_b)[None,:] + y0)
+  if block:
+    with stage(timer, 'mask'):
+      P, Q = F.prepare_rows(A), F.prepare_rows(B)
+    for a in xrange(0, n_a, tile):
+      print "Computing block rows %d through %d versus rows %d through %d..." % \
+        (x0+a, x0+min(a+tile, n_a)-1, y0, y0+n_b-1)
+      for b in xrange(0, n_b, tile):
+        with stage(timer, 'compute'):
+          R = F.compute_block(P.rows(a, a+tile), Q.rows(b, b+tile))
+        for name in F.MNAMES:
+          F.Matrices[name].reshape(n_a, n_b)[a:a+tile, b:b+tile] = R[name]
+  else:
+    for x in xrange(n_a):
+      if x % max(REPORT_N // n_b, 1) == 0:
+        print "Generating pairs of row %d (#%d of %d rows) versus rows %d through %d..." % \
+          (x0+x, x+1, n_a, y0, y0+n_b-1)
+      for y in xrange(n_b):
+        if below[x,y]: continue
+        i = x*n_b + y
+        metrics.compute_pair(F, A[x], B[y], i, x0+x, y0+y, timer)
+        if verbose:
+          d = F.get(i)
+          s = " ".join(["%s=%f"%(k,v) for k,v in d.items()])
+          print "(%d,%d): " % (x0+x,y0+y), s
+  for name in F.MNAMES:
+    F.Matrices[name].reshape(n_a, n_b)[below] = np.nan
+  return np.count_nonzero(below)
+
+def main(npyfile=None, work_dir=None, function=None, n=None, start=None, end=None, batchname=None, verbose=False, block=False, tile=TILE, backend=None, cache_size=None, cache_mb=None, M=None, rows=None, cols=None, keep=None, n_perm=None, alpha=None, timing=False, n_threads=None, screen=None, *args, **kwds):
   
   assert npyfile and work_dir
-  assert function in FUNCTIONS
+  functions = split_functions(function)
+  fused = len(functions) > 1
+  n = int(n)
   if start is None:
     start = 0
   else:
@@ -27,8 +229,14 @@ def main(npyfile=None, work_dir=None, function=None, n=None, start=None, end=Non
     end = n*(n-1) / 2
   else:
     end = int(end)
-  n = int(n)
   assert n > 0 and start >= 0 and end > 0
+  block, tile = is_dry(block), int(tile)
+  assert tile > 0
+  timer = StageTimer() if is_dry(timing) else None
+  assert bool(rows is None) == bool(cols is None)
+  if rows is not None:
+    (x0, x1), (y0, y1) = parse_span(rows), parse_span(cols)
+    assert x1 <= n and y1 <= n and x0 <= y0
   
   if not os.path.exists(work_dir):
     print "WARNING: work_dir %s does not exist." % work_dir
@@ -37,65 +245,157 @@ def main(npyfile=None, work_dir=None, function=None, n=None, start=None, end=Non
       make_dir(work_dir)
 
   # If batchname not provided, compute default value. Use batchname in output file name.
+  # Fused functions save to a work_dir subdirectory per function with the same names
+  # as separate runs.
+  def default_batchname(fn):
+    if rows is not None:
+      return "%s_%s_tile_%d_%d_%d_%d" % (os.path.basename(npyfile), fn, x0, x1, y0, y1)
+    else:
+      return "%s_%s_%d_%d" % (os.path.basename(npyfile), fn, start, end)
   if batchname is None or batchname.lower() in ("false", "f", "none"):
-    batchname = "%s_%s_%d_%d" % \
-      (os.path.basename(npyfile), function, start, end)
+    batchname = None
+  out_dirs, batchnames = {}, {}
+  for fn in functions:
+    out_dirs[fn] = os.path.join(work_dir, fn) if fused else work_dir
+    batchnames[fn] = batchname or default_batchname(fn)
+
+  if rows is not None:
+    size, shape = (x1-x0) * (y1-y0), (x1-x0, y1-y0)
+  else:
+    size, shape = end-start, (end-start,)
 
-  # Do not recreate existing batch output files.
-  output_fname = os.path.join(work_dir, batchname+".npy")
-  if os.path.exists(output_fname):
-    print "%s already exists. Exiting..." % output_fname
+  # Options of batch function handlers.
+  F_kwds = {}
+  if backend is not None:
+    print "Using %s backend %s." % ("+".join(functions), backend)
+    F_kwds['backend'] = backend
+  if cache_size is not None:
+    F_kwds['cache_size'] = int(cache_size)
+  if cache_mb is not None:
+    F_kwds['cache_mb'] = float(cache_mb)
+  if n_perm is not None:
+    F_kwds['n_perm'] = int(n_perm)
+  if n_threads is not None:
+    F_kwds['n_threads'] = int(n_threads)
+  if alpha is not None:
+    F_kwds['alpha'] = float(alpha)
+  # Do not recreate existing batch output files (see Batch.save) unless incomplete.
+  if keep is not None:
+    sparse_edges.parse_keep(keep)
+  mnames = batch_mnames("+".join(functions), **F_kwds)
+  todo = []
+  for fn in functions:
+    if keep is not None:
+      output_fnames = [os.path.join(out_dirs[fn], batchnames[fn] + sparse_edges.SPARSE_EXT)]
+      done = manifest.verified(output_fnames[0])
+    else:
+      output_fnames = [os.path.join(out_dirs[fn], "%s.%s.npy" % (batchnames[fn], name)) for name in mnames[fn]]
+      done = all([manifest.verified(f, shape) for f in output_fnames])
+    if done:
+      print "%s already exist. Skipping %s..." % (", ".join(output_fnames), fn)
+    else:
+      todo.append(fn)
+      if fused:
+        make_dir(out_dirs[fn])
+  if not todo:
+    print "All outputs exist. Exiting..."
     return 1
+  function = "+".join(todo)
+  batchname = batchname or default_batchname(function)
   
   # Load data file
-  print "Loading %s..." % npyfile
-  if npyfile.rpartition('.')[2].lower() == 'pkl':
-    print "Loading as level 2 pickle"
-    M = pickle.load(open(npyfile))
+  if M is None:
+    print "Loading %s..." % npyfile
+    with stage(timer, 'load'):
+      M = load_masked(npyfile)
   else:
-    print "Loading as level 0 numpy.MaskedArray pickle"
-    M = ma.load(npyfile)
+    print "Using shared matrix loaded from %s." % npyfile
 
   # Get batch function handler for this function.
-  size = end-start
-  F = FUNCTIONS[function](size)
+  F = make_batch(function, size, **F_kwds)
   if verbose:
     print "Vebose: Try F on n=700 identity."
     print F.compute_one(np.arange(700), np.arange(700))
 
   # Compute pairs using batch handler `F`
   print "Starting to write %d pairs for %s" % (size, batchname)
-  for i, j in enumerate(xrange(start, end)):
-    if i % REPORT_N == 0:
-      print "Generating pair %d (to %d), (#%d of %d total) in %s..." % \
-        (j, end-1, i+1, size, batchname)
-    # Carefully check indexing schemes...
-    x, y = inv_sym_idx(j, n)
-    assert x >= 0 and y >= 0 and x < np.size(M,0) and y < np.size(M,0)
-    idx_check = sym_idx(x,y,n)
-    assert idx_check == j and idx_check >= start and idx_check < end
-
-    # Remove samples with at least one missing value.
-    shared_mask = ~(M[x].mask | M[y].mask)
-    X, Y = M[x][shared_mask].data, M[y][shared_mask].data
-    assert np.size(X) == np.size(Y) <= np.size(M,1)
-
-    F.compute(X,Y,i)
-    if verbose:
-      d = F.get(i)
-      s = " ".join(["%s=%f"%(k,v) for k,v in d.items()])
-      print "%d->%d: " % (i,j), s
+  if block:
+    assert F.BLOCK, "Function %s does not support block mode." % function
+  if screen is not None:
+    assert not block, "Cascade screening is not used with block mode."
+    measure, screen_mode, screen_value = cascade.parse_screen(screen)
+    S = cascade.make_screen(measure, size)
+  n_unused, n_screened = 0, 0
+  if rows is not None:
+    # Load only the rows of this tile.
+    with stage(timer, 'load'):
+      A = ma.array(M[x0:x1], copy=True)
+      if (x0, x1) == (y0, y1):
+        B = A
+      else:
+        B = ma.array(M[y0:y1], copy=True)
+    if screen is None:
+      n_unused = compute_tile(F, A, B, x0, y0, block, tile, verbose, timer)
+      F.reshape(shape)
+    else:
+      with stage(timer, 'screen'):
+        x, y, n_unused = screen_pairs(S, M, start, end, n, A, B, x0, y0, tile)
+  elif screen is not None:
+    with stage(timer, 'screen'):
+      x, y, n_unused = screen_pairs(S, M, start, end, n, tile=tile)
+  elif block:
+    compute_blocks(F, M, start, end, n, tile, timer)
+  else:
+    compute_pairs(F, M, start, end, n, batchname, verbose, timer)
+  if screen is not None:
+    chosen = cascade.select(cascade.scores(S), screen_mode, screen_value)
+    n_screened = size - n_unused - np.count_nonzero(chosen)
+    print "Screen %s selected %d of %d pairs." % (screen, size - n_unused - n_screened, size - n_unused)
+    if rows is not None:
+      compute_screened(F, A, B, x, y, chosen, x0, y0, timer)
+      F.reshape(shape)
+    else:
+      compute_screened(F, M, M, x, y, chosen, timer=timer)
 
-  print "Computed %d pairs for %s" % (size, batchname)
-  n_nans = F.nans()
+  print "Computed %d pairs for %s" % (size - n_unused - n_screened, batchname)
+  for line in F.report():
+    print line
+  n_nans = F.nans() - (n_unused + n_screened)*len(F.MNAMES)
   print "%d nans" % (n_nans)
   if n_nans > 0:
     print "!!!WARNING: There exists at least one (%d) not-a-numbers (nans) in this batch." % (n_nans)
 
-  out_names = F.save(work_dir, batchname)
-  print "Saved %d results, %d through %d, as %d matrices:" % (size, start, end-1, len(out_names))
-  for name, out_name in out_names.items():
-    print "%s: %s" % (name, out_name)
+  with stage(timer, 'save'):
+    if keep is not None:
+      # Save only the pairs selected by keep.
+      if rows is not None:
+        x, y = np.divmod(np.arange(size), y1-y0)
+        x, y = x + x0, y + y0
+      else:
+        x, y = pair_rows(start, end, n)
+      for fn in todo:
+        B = F.batches[fn] if len(todo) > 1 else F
+        sparse_edges.save_sparse(B, out_dirs[fn], batchnames[fn], x, y, keep)
+    else:
+      out_names = {}
+      for fn in todo:
+        B = F.batches[fn] if len(todo) > 1 else F
+        out_names.update(B.save(out_dirs[fn], batchnames[fn]))
+      if rows is not None:
+        print "Saved %d results, rows %d through %d versus rows %d through %d, as %d matrices:" % \
+          (size - n_unused, x0, x1-1, y0, y1-1, len(out_names))
+      else:
+        print "Saved %d results, %d through %d, as %d matrices:" % (size, start, end-1, len(out_names))
+      for name, out_name in sorted(out_names.items()):
+        print "%s: %s" % (name, out_name)
+
+  if timer is not None:
+    for line in timer.report():
+      print line
+    # Fused functions each save a copy next to their outputs.
+    for fn in todo:
+      timer.save(os.path.join(out_dirs[fn], batchnames[fn] + METRICS_EXT), size - n_unused - n_screened,
+        function=function, batchname=batchnames[fn], block=block, screen=screen, n_screened=n_screened)
   
   
 if __name__ == "__main__":
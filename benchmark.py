@@ -0,0 +1,194 @@
+#!/usr/bin/python
+"""Benchmark Batch functions on synthetic matrices and compare with a baseline.
+
+Each function of FUNCTIONS (or functions=a,b,...) is run with each of its backends
+(Batch.BACKENDS, or the default backend) over a grid of sample counts (n_samples),
+row counts (n_rows), and fractions of masked values (masks). A run computes all
+pairs of rows of a seeded random masked matrix one pair at a time with compute_pair
+and, for functions with Batch.BLOCK, also in block mode with compute_block. Each run
+is in its own process, so that its peak resident memory is its own.
+
+Results are saved as json to out: per run, pairs per second, latency percentiles of a
+pair in milliseconds, and peak RSS in MB. In block mode, rows are prepared once
+(prepare_seconds, not in pairs per second) and all pairs are computed BLOCK_REPEATS
+times in tiles of BLOCK_TILE rows versus all later rows as in batch_pairwise.py; each
+tile is a latency sample, per pair of the tile. Runs which fail, e.g., for a missing
+optional dependency, are saved with their error.
+
+Given baseline=[json of an earlier run], runs of the same configuration with
+pairs_per_sec lower than (1-tolerance) times the baseline are reported as regressions
+and the script exits with status 1.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/benchmark.py out=bench.json functions=pearson,dcor n_samples=50,200,1000 n_rows=40 masks=0,0.1 baseline=bench_old.json
+"""
+from util import *
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+N_SAMPLES = [50, 200, 1000]
+N_ROWS = [40]
+MASKS = [0.0, 0.1]
+PERCENTILES = [50, 90, 99]
+BLOCK_TILE = 8
+BLOCK_REPEATS = 5
+TOLERANCE = 0.2
+SEED = 0
+# Configuration fields which identify a run in a baseline.
+KEY_FIELDS = ('function', 'backend', 'mode', 'n_samples', 'n_rows', 'mask')
+
+def synthetic_matrix(n_rows, n_samples, mask, seed=SEED):
+  """Return (n_rows x n_samples) masked matrix of correlated rows with mask fraction masked."""
+  rng = np.random.RandomState(seed)
+  z = rng.randn(n_samples)
+  D = rng.randn(n_rows, n_samples) + z * rng.rand(n_rows, 1) * 2
+  return ma.array(D, mask=rng.rand(n_rows, n_samples) < mask)
+
+def function_backends(function):
+  """Return list of backends of function to run; [None] for its default only."""
+  return sorted(getattr(FUNCTIONS[function], 'BACKENDS', [])) or [None]
+
+def run_grid(functions, n_samples, n_rows, masks):
+  """Return list of {str: obj} of run configurations."""
+  configs = []
+  for function in functions:
+    modes = ['pair'] + (['block'] if FUNCTIONS[function].BLOCK else [])
+    for backend in function_backends(function):
+      for mode in modes:
+        for m in n_samples:
+          for r in n_rows:
+            for mask in masks:
+              configs.append({'function': function, 'backend': backend, 'mode': mode,
+                              'n_samples': m, 'n_rows': r, 'mask': mask})
+  return configs
+
+def percentiles(latencies):
+  return dict([("p%d" % p, float(np.percentile(latencies, p)) * 1000) for p in PERCENTILES])
+
+def run(config):
+  """Run one configuration. Return {str: obj} of config with results or error."""
+  result = dict(config)
+  try:
+    M = synthetic_matrix(config['n_rows'], config['n_samples'], config['mask'])
+    n = config['n_rows']
+    size = n*(n-1)//2
+    kwds = {}
+    if config['backend'] is not None:
+      kwds['backend'] = config['backend']
+    F = make_batch(config['function'], size, **kwds)
+    latencies = []
+    if config['mode'] == 'block':
+      t = time.time()
+      R = F.prepare_rows(M)
+      result['prepare_seconds'] = time.time() - t
+      seconds = 0.0
+      for repeat in xrange(BLOCK_REPEATS):
+        for x0 in xrange(0, n-1, BLOCK_TILE):
+          x1 = min(x0 + BLOCK_TILE, n-1)
+          t = time.time()
+          F.compute_block(R.rows(x0, x1), R.rows(x0, n))
+          t = time.time() - t
+          seconds += t
+          latencies.append(t / ((x1-x0) * (n-x0)))
+      seconds /= BLOCK_REPEATS
+    else:
+      t0 = time.time()
+      i = 0
+      for x in xrange(n):
+        for y in xrange(x+1, n):
+          t = time.time()
+          F.compute_pair(M[x], M[y], i, x, y)
+          latencies.append(time.time() - t)
+          i += 1
+      seconds = time.time() - t0
+    result.update({
+      'n_pairs': size,
+      'seconds': seconds,
+      'pairs_per_sec': size / max(seconds, 1e-9),
+      'latency_ms': percentiles(latencies),
+      })
+  except Exception, e:
+    result['error'] = "%s: %s" % (type(e).__name__, e)
+  result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  return result
+
+def run_isolated(config):
+  """Run one configuration in a new process. Return its result."""
+  pool = multiprocessing.Pool(1)
+  try:
+    return pool.apply(run, (config,))
+  finally:
+    pool.close()
+    pool.join()
+
+def config_key(result):
+  return tuple([result.get(field) for field in KEY_FIELDS])
+
+def compare(results, baseline, tolerance=TOLERANCE):
+  """Return list of str of regressions of results versus baseline results."""
+  base = dict([(config_key(r), r) for r in baseline if 'pairs_per_sec' in r])
+  regressions = []
+  for r in results:
+    b = base.get(config_key(r))
+    if b is None or 'pairs_per_sec' not in r:
+      continue
+    ratio = r['pairs_per_sec'] / b['pairs_per_sec']
+    r['baseline_ratio'] = ratio
+    if ratio < 1 - tolerance:
+      regressions.append("%s: %.1f pairs/sec, %.1f%% of baseline %.1f pairs/sec" % \
+        (" ".join(["%s=%s" % (f, r[f]) for f in KEY_FIELDS]), r['pairs_per_sec'], ratio*100, b['pairs_per_sec']))
+  return regressions
+
+def parse_list(s, cast):
+  return [cast(v) for v in str(s).split(',') if v != '']
+
+def main(out="benchmark.json", functions=None, n_samples=None, n_rows=None, masks=None, baseline=None, tolerance=TOLERANCE, isolate=True):
+  functions = parse_list(functions, str) if functions else sorted(FUNCTIONS)
+  for function in functions:
+    assert function in FUNCTIONS, "Unknown function %s." % function
+  n_samples = parse_list(n_samples, int) if n_samples else N_SAMPLES
+  n_rows = parse_list(n_rows, int) if n_rows else N_ROWS
+  masks = parse_list(masks, float) if masks is not None else MASKS
+  isolate, tolerance = is_dry(isolate), float(tolerance)
+
+  results = []
+  configs = run_grid(functions, n_samples, n_rows, masks)
+  for i, config in enumerate(configs):
+    r = run_isolated(config) if isolate else run(config)
+    results.append(r)
+    desc = " ".join(["%s=%s" % (f, config[f]) for f in KEY_FIELDS])
+    if 'error' in r:
+      print "[%d/%d] %s: FAILED %s" % (i+1, len(configs), desc, r['error'])
+    else:
+      prepare = ", prepare %.3f s" % r['prepare_seconds'] if 'prepare_seconds' in r else ""
+      print "[%d/%d] %s: %.1f pairs/sec, p50 %.3f ms, p99 %.3f ms%s, peak RSS %.1f MB" % \
+        (i+1, len(configs), desc, r['pairs_per_sec'], r['latency_ms']['p50'], r['latency_ms']['p99'], prepare, r['peak_rss_mb'])
+
+  regressions = []
+  if baseline:
+    regressions = compare(results, json.load(open(baseline))['results'], tolerance)
+    print "%d regressions versus baseline %s (tolerance %.0f%%)." % (len(regressions), baseline, tolerance*100)
+    for line in regressions:
+      print "!!! REGRESSION %s" % line
+
+  report = {
+    'time': tstamp(),
+    'host': platform.node(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'baseline': baseline,
+    'regressions': regressions,
+    'results': results,
+    }
+  json.dump(report, open(out, 'w'), indent=1)
+  print "Saved %d results to %s." % (len(results), out)
+  return len(regressions)
+
+
+if __name__ == "__main__":
+  n_regressions = main(**dict([s.split('=') for s in sys.argv[1:]]))
+  sys.exit(1 if n_regressions else 0)
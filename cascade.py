@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""Cascade screening of pairs by a cheap measure before an expensive Batch.
+
+screen=MEASURE:abs_gt:T computes the expensive function only on pairs whose screening
+score is greater than T; screen=MEASURE:top:F only on the fraction F of the batch's
+pairs with the largest scores. Measures (SCREENS):
+
+  pearson, spearman: |PEARSON| or |SPEARMAN|, computed in block mode
+  dcor_sub: DCOR of at most SUBSAMPLE evenly spaced shared samples of each pair
+
+Pairs with a nan score are never selected. Pairs which are screened out are nan in all
+result matrices, so that compile_pairwise.py leaves them unset in its isset matrices.
+top:F selects within each batch, not over all pairs of the matrix.
+"""
+from batch import PCCBatch, SpearmanBatch
+from dcor_batch import DcorBatch
+import numpy as np
+
+SUBSAMPLE = 100
+
+
+class SubsampleDcorBatch(DcorBatch):
+  """Distance correlation of at most SUBSAMPLE evenly spaced shared samples of a pair."""
+  def __init__(self, size=1, subsample=SUBSAMPLE, **kwds):
+    self.subsample = int(subsample)
+    assert self.subsample > 1
+    super(SubsampleDcorBatch, self).__init__(size, **kwds)
+
+  def compute_shared(self, pair, i):
+    m = np.size(pair.X)
+    if m > self.subsample:
+      idx = np.linspace(0, m-1, self.subsample).astype(np.int64)
+      self.compute(pair.X[idx], pair.Y[idx], i)
+    else:
+      self.compute(pair.X, pair.Y, i)
+
+
+SCREENS = {
+  'pearson': PCCBatch,
+  'spearman': SpearmanBatch,
+  'dcor_sub': SubsampleDcorBatch,
+  }
+
+def parse_screen(screen):
+  """Return (str, str, float) of measure, mode, and parameter of a screen str, e.g., 'pearson:abs_gt:0.3'."""
+  parts = str(screen).split(':')
+  assert len(parts) == 3, "Screen %s is not MEASURE:MODE:VALUE." % screen
+  measure, mode, value = parts[0], parts[1], float(parts[2])
+  assert measure in SCREENS, "Unknown screen measure %s; use one of %s." % (measure, sorted(SCREENS))
+  if mode == 'top':
+    assert 0 < value <= 1, screen
+  elif mode != 'abs_gt':
+    raise Exception, "Unknown screen mode %s; use abs_gt:T or top:F." % mode
+  return measure, mode, value
+
+def make_screen(measure, size):
+  """Return Batch of size of screening measure."""
+  return SCREENS[measure](size)
+
+def scores(S):
+  """Return float np.array of flat screening scores of Batch S; absolute if it has negative values."""
+  Q = np.ravel(S.Matrices[S.MNAMES[0]])
+  return np.abs(Q) if getattr(S, 'HAS_NEG', False) else Q
+
+def select(score, mode, value):
+  """Return bool np.array of pairs with score selected by mode (see parse_screen)."""
+  valid = ~np.isnan(score)
+  chosen = np.zeros(np.size(score), dtype=np.bool)
+  if mode == 'abs_gt':
+    chosen[valid] = score[valid] > value
+  else:
+    idx = np.nonzero(valid)[0]
+    k = int(np.ceil(value * np.size(idx)))
+    if k > 0:
+      chosen[idx[np.argpartition(-score[idx], k-1)[:k]]] = True
+  return chosen
+
+def unset(F, chosen):
+  """Set results of Batch F of pairs not chosen to nan."""
+  for name in F.MNAMES:
+    np.ravel(F.Matrices[name])[~chosen] = np.nan
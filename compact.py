@@ -0,0 +1,239 @@
+#!/usr/bin/python
+"""Compact storage of compiled condensed result vectors in compressed chunks.
+
+A compiled .values.npy vector (and its .isset.npy mask, if any) is stored as fixed-size
+chunks of CHUNK values, each encoded and zlib compressed, in [prefix].[matrix].chunks
+with a json index [prefix].[matrix].chunks.json of chunk byte offsets. Unset values
+are folded into a sentinel: nan for float encodings, the largest code for quantized
+encodings. Encodings:
+
+  float32: lossless for float32 compiled values
+  float16: half precision; relative error at most 2**-11. Only for matrices bounded
+    in [-1, 1] (BOUNDS, p-values) or whose values are within the float16 range;
+    other matrices are saved as float32 (see check_encoding).
+  q16, q8: values in [lo, hi] quantized to 2**16-1 or 2**8-1 levels; absolute error
+    at most (hi-lo)/(2*(levels-1)). Bounds default to BOUNDS of the matrix (e.g.,
+    DCOR, MIC in [0, 1]) or to the range of the values.
+
+CompactMatrix reads values by condensed index and decompresses only the chunks which
+a query touches, keeping the most recently used chunks decoded.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/compact.py values=$HOME/gse15745/gse15745_gpl6104_dcor.DCOR.values.npy encoding=q16
+"""
+from batch import RowCache
+import json
+import os, sys
+import zlib
+import numpy as np
+
+CHUNK = 2**20
+CHUNKS_EXT = ".chunks"
+CACHE_CHUNKS = 8
+ENCODINGS = {
+  'float32': np.float32,
+  'float16': np.float16,
+  'q16': np.uint16,
+  'q8': np.uint8,
+  }
+# Value ranges of bounded measures; p-value matrices (*_PV) are in [0, 1].
+BOUNDS = {
+  'PEARSON': (-1.0, 1.0),
+  'SPEARMAN': (-1.0, 1.0),
+  'KENDALL': (-1.0, 1.0),
+  'DCOR': (0.0, 1.0),
+  'MIC': (0.0, 1.0),
+  }
+
+def matrix_bounds(matrix_name):
+  """Return (float, float) of value bounds of a matrix name, or None if unbounded."""
+  if matrix_name in BOUNDS:
+    return BOUNDS[matrix_name]
+  if matrix_name.endswith("_PV"):
+    return (0.0, 1.0)
+  return None
+
+def value_range(M, chunk=CHUNK):
+  """Return (float, float) of the minimum and maximum of non-nan values of vector M, or
+  (inf, -inf) if there are none. Reads M a chunk at a time."""
+  lo, hi = np.inf, -np.inf
+  for a in xrange(0, np.size(M), chunk):
+    Q = np.asarray(M[a:a+chunk], dtype=np.float)
+    Q = Q[~np.isnan(Q)]
+    if np.size(Q):
+      lo, hi = min(lo, Q.min()), max(hi, Q.max())
+  return lo, hi
+
+def check_encoding(M, encoding, matrix_name=None, chunk=CHUNK):
+  """Return str of the encoding to save values M of matrix_name with in place of encoding.
+
+  float16 is used only for matrices bounded in [-1, 1] or values within the float16
+  range; else values are saved as float32.
+  """
+  if encoding != 'float16':
+    return encoding
+  bounds = matrix_bounds(matrix_name or "")
+  if bounds is not None and -1.0 <= bounds[0] and bounds[1] <= 1.0:
+    return encoding
+  lo, hi = value_range(M, chunk)
+  if max(abs(lo), abs(hi)) <= np.finfo(np.float16).max or lo > hi:
+    return encoding
+  print "WARNING: values of %s in [%g, %g] exceed the float16 range; saving as float32." % (matrix_name, lo, hi)
+  return 'float32'
+
+def value_dtype(encoding):
+  """Return numpy dtype of decoded values of encoding, e.g., of a square row index."""
+  return np.float16 if encoding == 'float16' else np.float32
+
+def compact_fname(values_fname):
+  """Return .chunks file name of a compiled [prefix].[matrix].values.npy file name."""
+  if values_fname.endswith(".values.npy"):
+    values_fname = values_fname[:-len(".values.npy")]
+  return values_fname + CHUNKS_EXT
+
+def encode(Q, encoding, lo=None, hi=None):
+  """Return np.array of values Q (nan where unset) in encoding."""
+  dtype = ENCODINGS[encoding]
+  if encoding in ('float32', 'float16'):
+    return Q.astype(dtype)
+  sentinel = np.iinfo(dtype).max
+  with np.errstate(invalid='ignore'):
+    C = np.rint((np.clip(Q, lo, hi) - lo) / (hi - lo) * (sentinel - 1))
+  C[np.isnan(Q)] = sentinel
+  return C.astype(dtype)
+
+def decode(C, encoding, lo=None, hi=None):
+  """Return float np.array of encoded values C, nan where unset."""
+  if encoding in ('float32', 'float16'):
+    return C.astype(np.float)
+  sentinel = np.iinfo(C.dtype).max
+  Q = lo + C * ((hi - lo) / float(sentinel - 1))
+  Q[C == sentinel] = np.nan
+  return Q
+
+def write_compact(values_fname, isset_fname=None, encoding='float16', bounds=None, matrix_name=None, chunk=CHUNK, level=6):
+  """Save a compiled values .npy vector in compressed chunks. Return .chunks file name.
+
+  Args:
+    isset_fname: str of .isset.npy file; values where not set are saved as unset
+    bounds: (float, float) of quantization range; default matrix_bounds(matrix_name)
+      or the range of the values
+  """
+  assert encoding in ENCODINGS, "Unknown encoding %s; use one of %s." % (encoding, sorted(ENCODINGS))
+  chunk = int(chunk)
+  M = np.load(values_fname, mmap_mode='r')
+  B = np.load(isset_fname, mmap_mode='r') if isset_fname else None
+  n = np.size(M)
+  encoding = check_encoding(M, encoding, matrix_name, chunk)
+  lo = hi = None
+  if encoding in ('q16', 'q8'):
+    bounds = bounds or matrix_bounds(matrix_name or "")
+    if bounds is None:
+      lo, hi = value_range(M, chunk)
+      if not lo < hi:
+        lo, hi = (0.0, 1.0) if lo == np.inf else (lo, lo + 1.0)
+      print "Quantizing to the range of values [%g, %g]." % (lo, hi)
+    else:
+      lo, hi = map(float, bounds)
+    assert lo < hi
+
+  fname = compact_fname(values_fname)
+  fp = open(fname, 'wb')
+  offsets = [0]
+  for a in xrange(0, n, chunk):
+    Q = np.array(M[a:a+chunk], dtype=np.float)
+    if B is not None:
+      Q[~B[a:a+chunk]] = np.nan
+    fp.write(zlib.compress(encode(Q, encoding, lo, hi).tostring(), level))
+    offsets.append(fp.tell())
+  fp.close()
+  index = {
+    'n': n,
+    'chunk': chunk,
+    'encoding': encoding,
+    'lo': lo,
+    'hi': hi,
+    'offsets': offsets,
+  }
+  json.dump(index, open(fname + ".json", 'w'))
+  print "Saved %d values in %d chunks of %s encoding to %s (%d bytes, %.1f%% of %s)." % \
+    (n, len(offsets)-1, encoding, fname, offsets[-1], offsets[-1]*100.0/max(os.path.getsize(values_fname), 1), values_fname)
+  return fname
+
+
+class CompactMatrix(object):
+  """Read only condensed vector saved by write_compact.
+
+  Index by int, slice, or array of condensed indices; unset values are nan.
+  """
+  def __init__(self, fname, cache_chunks=CACHE_CHUNKS):
+    if fname.endswith(".json"):
+      fname = fname[:-len(".json")]
+    self.fname = fname
+    index = json.load(open(fname + ".json"))
+    self.n, self.chunk, self.encoding = index['n'], index['chunk'], str(index['encoding'])
+    self.lo, self.hi = index['lo'], index['hi']
+    self.offsets = index['offsets']
+    self.dtype = ENCODINGS[self.encoding]
+    self.fp = open(fname, 'rb')
+    self.cache = RowCache(cache_chunks)
+
+  def __len__(self):
+    return self.n
+
+  def read_chunk(self, c):
+    """Return float np.array of decoded values of chunk c."""
+    def make():
+      self.fp.seek(self.offsets[c])
+      s = zlib.decompress(self.fp.read(self.offsets[c+1] - self.offsets[c]))
+      return decode(np.fromstring(s, dtype=self.dtype), self.encoding, self.lo, self.hi)
+    return self.cache.get(c, make)
+
+  def get(self, start, end):
+    """Return float np.array of values at condensed indices [start, end)."""
+    assert 0 <= start <= end <= self.n
+    if start == end:
+      return np.empty(0)
+    parts = []
+    for c in xrange(start // self.chunk, (end - 1) // self.chunk + 1):
+      base = c * self.chunk
+      parts.append(self.read_chunk(c)[max(start-base, 0):end-base])
+    return np.concatenate(parts)
+
+  def take(self, idx):
+    """Return float np.array of values at condensed indices idx."""
+    idx = np.asarray(idx, dtype=np.int64)
+    Q = np.empty(np.shape(idx))
+    flat, out = idx.ravel(), Q.reshape(-1)
+    assert np.size(flat) == 0 or (flat.min() >= 0 and flat.max() < self.n)
+    chunks = flat // self.chunk
+    for c in np.unique(chunks):
+      hit = chunks == c
+      out[hit] = self.read_chunk(int(c))[flat[hit] - c * self.chunk]
+    return Q
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      start, end, step = key.indices(self.n)
+      if step == 1:
+        return self.get(start, max(start, end))
+      return self.take(np.arange(start, end, step))
+    if np.ndim(key) == 0:
+      return self.take(np.array([key]))[0]
+    return self.take(key)
+
+  def close(self):
+    self.fp.close()
+
+
+if __name__ == "__main__":
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  values = args['values']
+  isset = args.get('isset', values.replace(".values.npy", ".isset.npy"))
+  if not os.path.exists(isset):
+    isset = None
+  bounds = args.get('bounds')
+  if bounds:
+    bounds = map(float, bounds.split(':'))
+  matrix_name = os.path.basename(values).split('.')[-3] if values.endswith(".values.npy") else None
+  write_compact(values, isset, args.get('encoding', 'float16'), bounds, matrix_name, args.get('chunk', CHUNK))
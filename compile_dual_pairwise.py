@@ -1,67 +1,93 @@
 #!/usr/bin/python
 """Compile a directory of dual pairwise numpy matrix rows into a single matrix.
 
+Files in the same path are expected to be in format (see batch_dual_pairwise.py):
+
+[id]_[row].[matrix].npy         one row of the first matrix versus all rows of the second
+[id]_[start]_[end].[matrix].npy rows [start, end) of the first matrix (MULTI-ROW MODE)
+
+Each matrix is compiled to an (n_rows x n_cols) [outpath_prefix].[matrix].values.npy,
+written memory-mapped, and [outpath_prefix].[matrix].isset.npy if values are missing.
+
 SAMPLE USE:
 
 python $HOME/dependency_matrix_dispatcher/compile_dual_pairwise.py path=/fs/lustre/osu6683/gse15745_gpl8178_gpl6104/dcor outpath_prefix=$HOME/gse15745_gpl8178_gpl6104_dcor n_rows=735 n_cols=22184
+
+Sparse batch records (batch_dual_pairwise.py keep=...) are merged into
+[outpath_prefix].sparse.npz with one CSR row per row of the first matrix (see
+sparse_edges.py). Give keep=topk:K to keep each row's K strongest pairs.
 """
 from __future__ import division
 from py_symmetric_matrix import *
+from compile_pairwise import Result
 import re
 import numpy as np
 import os, sys
+import metrics
+import sparse_edges
 
-RX = re.compile('.*?_(\d+)\.npy')
+RX_BLOCK = re.compile('(?P<id>.*?)_(?P<start>\d+)_(?P<end>\d+)\.(?P<matrix>\w+)\.npy$')
+RX = re.compile('(?P<id>.*?)_(?P<row>\d+)\.(?P<matrix>\w+)\.npy$')
 
 
-def main(path, outpath_prefix, n_rows, n_cols):
+def main(path, outpath_prefix, n_rows, n_cols, keep=None):
   assert path, outpath_prefix
   n_rows, n_cols = int(n_rows), int(n_cols)
   assert n_rows > 0 and n_cols > 0
   n = n_cols*n_rows
 
-  M = np.zeros((n_rows, n_cols), dtype=np.float32)
-  B = np.zeros((n_rows, n_cols), dtype=np.bool)
-  
-  n_set_total, n_dupe_total, n_nan_total = 0, 0, 0
-  for fname in os.listdir(path):
-    m = RX.match(fname)
+  sparse_fnames = sorted([os.path.join(path, fname) for fname in os.listdir(path) \
+    if fname.endswith(sparse_edges.SPARSE_EXT)])
+  if sparse_fnames:
+    print "Merging %d sparse batch record files..." % len(sparse_fnames)
+    sparse_edges.compile_sparse(sparse_fnames, outpath_prefix + ".sparse.npz", n_rows, keep, symmetric=False)
+    metrics.save_aggregate(path, outpath_prefix + metrics.METRICS_EXT)
+    print "Compilation of %s complete." % path
+    return
+
+  Results = {}
+  def get_result(matrix_name):
+    if matrix_name not in Results:
+      print "Creating new Result matrix '%s' of shape (%d x %d)." % (matrix_name, n_rows, n_cols)
+      M_fname = "%s.%s.values.npy" % (outpath_prefix, matrix_name)
+      B_fname = "%s.%s.isset.npy" % (outpath_prefix, matrix_name)
+      Results[matrix_name] = Result(n, M_fname, B_fname, dtype=np.float32, shape=(n_rows, n_cols))
+    return Results[matrix_name]
+
+  for fname in sorted(os.listdir(path)):
+    m = RX_BLOCK.match(fname)
     if m:
-      row_num = int(m.group(1))
-      Q = np.load(os.path.join(path,fname))
-      q_nans = np.count_nonzero(np.isnan(Q))
-      assert q_nans == 0, q_nans
-      n_set, n_dupe, n_nan = 0, 0, 0
-      assert np.size(Q,0) == n_cols
-      for i in xrange(n_cols):
-        M[row_num,i] = Q[i]
-        if np.isnan(Q[i]):
-          n_nan += 1
-        elif not B[row_num,i]:
-          B[row_num,i] = 1
-          n_set += 1
-        else:
-          n_dupe += 1
-        # assert not np.isnan(M[row_num,i])
-      print "%.2f%% Complete: Set %d (%d dupes, %d n_nan) from %s. Expected %d." % \
-          ((n_set)/n_cols*100, n_set, n_dupe, n_nan, fname, n_cols)
-      n_set_total += n_set
-      n_dupe_total += n_dupe
-      n_nan_total += n_dupe
-      
-  print "%.2f%% Complete. Set %d (%d dupes, %d nan) from %s. Expected %d." % (n_set_total/n*100, n_set_total, n_dupe_total, n_nan_total, path, n)
-  assert np.count_nonzero(np.isnan(M)) == 0
-  
-  M_fname, B_fname = outpath_prefix+".values.npy", outpath_prefix+".isset.npy"
-  np.save(M_fname, M)
-  print "Saved %s." % (M_fname)
-  if n_set_total != n:
-    np.save(B_fname, B)
-    print "Because values are missing, saved %s." % (B_fname)
-  else:
-    print "No values missing; did not save boolean 'isset' matrix."
+      start, end = int(m.group('start')), int(m.group('end'))
+    else:
+      m = RX.match(fname)
+      if not m:
+        continue
+      start = int(m.group('row'))
+      end = start+1
+    assert 0 <= start < end <= n_rows, "Rows %d-%d of %s out of range." % (start, end-1, fname)
+    Q = np.load(os.path.join(path,fname))
+    assert np.size(Q) == (end-start)*n_cols, "%s has size %d." % (fname, np.size(Q))
+    # Rows [start, end) are contiguous in row-major order.
+    R = get_result(m.group('matrix'))
+    n_set, n_dupe, n_nan = R.set_span(start*n_cols, Q)
+    print "%.2f%% Complete: Set %d (%d dupes, %d nan) of rows %d-%d from %s. Expected %d." % \
+        (n_set/np.size(Q)*100, n_set, n_dupe, n_nan, start, end-1, fname, np.size(Q))
+    R.add_counts(n_set, n_dupe, n_nan)
+
+  for matrix_name, R in Results.items():
+    print "%.2f%% Complete. Set %d (%d dupes, %d nan) of matrix %s from %s. Expected %d." % \
+        (R.n_set_total/n*100, R.n_set_total, R.n_dupe_total, R.n_nan_total, matrix_name, path, n)
+    R.M.flush(); R.B.flush()
+    del R.M, R.B
+    print "Saved %s." % (R.M_fname)
+    if R.n_set_total != n:
+      print "Because values are missing, saved %s." % (R.B_fname)
+    else:
+      os.remove(R.B_fname)
+      print "No values missing; did not save boolean 'isset' matrix."
 
-  print "Compilation of %s complete." % path
+  metrics.save_aggregate(path, outpath_prefix + metrics.METRICS_EXT)
+  print "Compilation of %s complete. Saved %d result matrices." % (path, len(Results))
 
   
 if __name__ == "__main__":
@@ -15,6 +15,27 @@ examples:
   GSE7307_GPL570.normed.masked.pkl.gt0.25.pina.tab.pkl_dcor_5220000_5250000.DCOR.npy
   GSE7307_GPL570.normed.masked.pkl.gt0.25.pina.tab.pkl_dcor_5220000_5250000.DCOV.npy
 
+Tiles of rows [x0, x1) versus rows [y0, y1) (see batch_pairwise.py, TILE MODE) in format:
+
+[id]_tile_[x0]_[x1]_[y0]_[y1].[matrix].npy
+
+are scattered into condensed order.
+
+Sparse batch records (batch_pairwise.py keep=...) in format [id]_[start]_[end].sparse.npy
+are merged into [outpath_prefix].sparse.npz (see sparse_edges.py). Give keep=topk:K
+to keep each row's K strongest pairs over all batches.
+
+Give compact=float32, float16, q16, or q8 to save each matrix in compressed chunks as
+[outpath_prefix].[matrix].chunks in place of its .values.npy and .isset.npy files (see
+compact.py); bounds=lo:hi sets the quantization range of q16 and q8.
+
+Batch metrics files ([batchname].metrics.json, see batch_pairwise.py timing=True) in
+path are aggregated into a throughput report [outpath_prefix].metrics.json.
+
+Give row_index=True to also save each matrix as a row-major square
+[outpath_prefix].[matrix].square.npy for row queries (see row_index.py), of the same
+precision as its compact storage.
+
 SAMPLE USE:
   python $HOME/dependency_matrix_dispatcher/compile_pairwise.py path=/fs/lustre/osu6683/gse15745/dcor outpath_prefix=$HOME/gse15745/gse15745_gpl6104_dcor n=246053836
 """
@@ -23,21 +44,81 @@ from py_symmetric_matrix import *
 import re
 import numpy as np
 import os, sys
+from util import is_dry
+import compact as compact_store
+import row_index as row_index_store
+import metrics
+import sparse_edges
 
 RX = re.compile('(?P<id>.*?)_(?P<start>\d+)_(?P<end>\d+)\.(?P<matrix>\w+).npy')
+RX_TILE = re.compile('(?P<id>.*?)_tile_(?P<x0>\d+)_(?P<x1>\d+)_(?P<y0>\d+)_(?P<y1>\d+)\.(?P<matrix>\w+)\.npy')
+
+def n_rows_from_pairs(n):
+  """Return number of rows of a symmetric matrix with n condensed (n choose 2) pairs."""
+  n_rows = int(round((1 + np.sqrt(1 + 8*n)) / 2))
+  assert n_rows*(n_rows-1)/2 == n, "%d is not a number of pairs n choose 2." % n
+  return n_rows
 
 class Result(object):
-  def __init__(self, n, dtype=np.float):
+  """Compiled values and isset flags of one matrix, memory-mapped to the output files
+  so that matrices larger than RAM can be compiled."""
+  def __init__(self, n, M_fname, B_fname, dtype=np.float, shape=None):
     assert n > 0
-    self.M = np.zeros(n, dtype=dtype)
-    self.B = np.zeros(n, dtype=np.bool)
+    shape = shape or (n,)
+    assert np.prod(shape) == n
+    self.M_fname, self.B_fname = M_fname, B_fname
+    self.M = np.lib.format.open_memmap(M_fname, mode='w+', dtype=dtype, shape=shape)
+    self.B = np.lib.format.open_memmap(B_fname, mode='w+', dtype=np.bool, shape=shape)
     self.n_set_total, self.n_dupe_total, self.n_nan_total = 0, 0, 0
-    self.Q_last = None
+    # {(start, end): file name} of compiled condensed segments.
+    self.spans = {}
+
+  def set_span(self, start, Q):
+    """Set values Q at flat (e.g., condensed) indices [start, start+len(Q)).
 
-def main(path, outpath_prefix, n=None, npy_fname=None, precision=32):
+    Returns:
+      (int, int, int) of number of values newly set, duplicated, and nan
+    """
+    end = start + np.size(Q)
+    Q = np.ravel(Q)
+    M, B = self.M.reshape(-1), self.B.reshape(-1)
+    is_nan = np.isnan(Q)
+    was_set = np.array(B[start:end])
+    n_nan = np.count_nonzero(is_nan)
+    n_dupe = np.count_nonzero(~is_nan & was_set)
+    n_set = np.size(Q) - n_nan - n_dupe
+    M[start:end] = Q
+    B[start:end] = was_set | ~is_nan
+    return n_set, n_dupe, n_nan
+
+  def add_counts(self, n_set, n_dupe, n_nan):
+    self.n_set_total += n_set
+    self.n_dupe_total += n_dupe
+    self.n_nan_total += n_nan
+
+def scatter_tile(R, Q, x0, y0, n_rows):
+  """Set upper triangle values of tile Q of rows x0... versus rows y0... in Result R.
+
+  Returns:
+    (int, int, int) of number of values newly set, duplicated, and nan
+  """
+  counts = np.zeros(3, dtype=np.int64)
+  for x in xrange(x0, x0+np.size(Q,0)):
+    y_start = max(y0, x+1)
+    y_end = y0 + np.size(Q,1)
+    if y_start >= y_end: continue
+    counts += R.set_span(sym_idx(x, y_start, n_rows), Q[x-x0, y_start-y0:])
+  return tuple(counts)
+
+def main(path, outpath_prefix, n=None, npy_fname=None, precision=32, keep=None, compact=None, bounds=None, row_index=False):
   assert path, outpath_prefix
   precision = int(precision)
   assert precision in (32, 64)
+  row_index = is_dry(row_index)
+  if compact is not None:
+    assert compact in compact_store.ENCODINGS, "Unknown compact encoding %s." % compact
+    if bounds is not None:
+      bounds = map(float, str(bounds).split(':'))
 
   if n is not None:
     n = int(n)
@@ -59,67 +140,83 @@ def main(path, outpath_prefix, n=None, npy_fname=None, precision=32):
 
   # We don't know in advance how many matrices we will need to fill.
   Results = {}
+  def get_result(matrix_name):
+    if matrix_name not in Results:
+      print "Creating new Result matrix '%s' of size %d, type %s." % (matrix_name, n, str(dtype))
+      M_fname = "%s.%s.values.npy" % (outpath_prefix, matrix_name)
+      B_fname = "%s.%s.isset.npy" % (outpath_prefix, matrix_name)
+      Results[matrix_name] = Result(n, M_fname, B_fname, dtype=dtype)
+    return Results[matrix_name]
+  
+  sparse_fnames = []
   for fname in os.listdir(path):
+    if fname.endswith(sparse_edges.SPARSE_EXT):
+      sparse_fnames.append(os.path.join(path, fname))
+      continue
+    m = RX_TILE.match(fname)
+    if m:
+      x0, x1, y0, y1 = [int(m.group(g)) for g in ('x0', 'x1', 'y0', 'y1')]
+      Q = np.load(os.path.join(path, fname))
+      assert np.shape(Q) == (x1-x0, y1-y0), "Tile %s has shape %s." % (fname, np.shape(Q))
+      R = get_result(m.group('matrix'))
+      n_set, n_dupe, n_nan = scatter_tile(R, Q, x0, y0, n_rows_from_pairs(n))
+      print "Set %d (%d dupes, %d nan) from tile %s of rows %d-%d versus %d-%d." % \
+          (n_set, n_dupe, n_nan, fname, x0, x1-1, y0, y1-1)
+      R.add_counts(n_set, n_dupe, n_nan)
+      continue
     m = RX.match(fname)
     if m:
       # Parse file name into parts.
       start = int(m.group('start'))
       end = int(m.group('end'))
-      matrix_name = m.group('matrix')
       Q = np.load(os.path.join(path, fname))
+      assert np.size(Q) == end-start, "Segment %s has size %d." % (fname, np.size(Q))
       
       # Get Result for this matrix_name
-      if matrix_name not in Results:
-        print "Creating new Result matrix '%s' of size %d, type %s." % (matrix_name, n, str(dtype))
-        Results[matrix_name] = Result(n=n, dtype=dtype)
-      R = Results[matrix_name]
+      R = get_result(m.group('matrix'))
         
-      # Check to make sure that Q is not the same as last Q for this Result matrix.
-      if R.Q_last is not None:
-        try:
-          assert np.size(Q) != np.size(R.Q_last) or np.abs(np.sum(Q - R.Q_last)) > 0
-        except AssertionError:
-          print "Matrix segment seems repeated..."
-          print fname
-          print Q[:5]
-          print R.Q_last[:5]
-          print (Q-R.Q_last)[:5]
-          print np.sum(Q-R.Q_last)
-          raise
-      n_set, n_dupe, n_nan = 0, 0, 0
-      for i, x in enumerate(range(start, end)):
-        R.M[x] = Q[i]
-        if np.isnan(Q[i]):
-          # Implicit: B[x] = 0
-          n_nan += 1
-        elif not R.B[x]:
-          R.B[x] = 1
-          n_set += 1
-        else:
-          n_dupe += 1
-      R.Q_last = Q
+      # Check that no other segment file had the same range of this Result matrix.
+      assert (start, end) not in R.spans, \
+        "Matrix segment %s repeats range %d-%d of %s." % (fname, start, end, R.spans[(start, end)])
+      R.spans[(start, end)] = fname
+      n_set, n_dupe, n_nan = R.set_span(start, Q)
       print "%.2f%% Complete: Set %d (%d dupes, %d nan) from %s. Expected %d." % \
-          ((end-start)/n_set*100, n_set, n_dupe, n_nan, fname, end-start)
-      R.n_set_total += n_set
-      R.n_dupe_total += n_dupe
-      R.n_nan_total += n_nan
+          (n_set/(end-start)*100, n_set, n_dupe, n_nan, fname, end-start)
+      R.add_counts(n_set, n_dupe, n_nan)
 
   # Save results for each result.
   for matrix_name, R in Results.items():
     print "Saving results for matrix %s..." % (matrix_name)
     print "%.2f%% Complete. Set %d (%d dupes, %d nan, %d unmasked) from %s. Expected %d." % \
-        (R.n_set_total/n*100, R.n_set_total, R.n_dupe_total, R.n_nan_total, np.sum(R.B), path, n)
-    M_fname = "%s.%s.values.npy" % (outpath_prefix, matrix_name)
-    B_fname = "%s.%s.isset.npy" % (outpath_prefix, matrix_name)
-    
-    np.save(M_fname, R.M)
-    print "Saved %s." % (M_fname)
+        (R.n_set_total/n*100, R.n_set_total, R.n_dupe_total, R.n_nan_total, np.count_nonzero(R.B), path, n)
+    R.M.flush(); R.B.flush()
+    del R.M, R.B
+    print "Saved %s." % (R.M_fname)
     if R.n_set_total != n:
-      np.save(B_fname, R.B)
-      print "!!! Because values are missing, saved %s." % (B_fname)
+      print "!!! Because values are missing, saved %s." % (R.B_fname)
     else:
+      os.remove(R.B_fname)
       print "No values missing; did not save boolean 'isset' matrix."
+    encoding = None
+    if compact is not None:
+      encoding = compact_store.check_encoding(np.load(R.M_fname, mmap_mode='r'), compact, matrix_name)
+    if row_index:
+      B = np.load(R.B_fname, mmap_mode='r') if R.n_set_total != n else None
+      row_index_store.build_square(np.load(R.M_fname, mmap_mode='r'), n_rows_from_pairs(n),
+        row_index_store.square_fname(R.M_fname), B, dtype=compact_store.value_dtype(encoding))
+    if compact is not None:
+      has_isset = R.n_set_total != n
+      compact_store.write_compact(R.M_fname, R.B_fname if has_isset else None, encoding, bounds, matrix_name)
+      os.remove(R.M_fname)
+      if has_isset:
+        os.remove(R.B_fname)
+      print "Removed %s; values are in compact storage." % (R.M_fname)
+
+  if sparse_fnames:
+    print "Merging %d sparse batch record files..." % len(sparse_fnames)
+    sparse_edges.compile_sparse(sorted(sparse_fnames), outpath_prefix + ".sparse.npz", n_rows_from_pairs(n), keep)
 
+  metrics.save_aggregate(path, outpath_prefix + metrics.METRICS_EXT)
   print "Compilation of %s complete. Saved %d result matrices." % (path, len(Results))
 
   
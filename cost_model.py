@@ -0,0 +1,291 @@
+#!/usr/bin/python
+"""Estimate the runtime of pairs of a matrix and size batch jobs to a target runtime.
+
+The time of a pair is modeled as a + b * m**p, where m is the number of samples the two
+rows share (both unmasked) and p is the order of the function in m (ORDERS; log factors
+are folded into p). a is the per-pair overhead, e.g., of extracting the shared samples.
+Assuming that masked values of different rows are independent, a pair of rows x and y
+with unmasked fractions f_x and f_y of m_cols samples shares about m_cols * f_x * f_y.
+
+a and b are calibrated either by timing a random sample of pairs of the matrix itself
+(calibrate_sample; in block mode, compute_block of random sets of rows), or from results of benchmark.py (calibrate_benchmark), whose runs
+at masked fraction r are taken to share m = n_samples * (1-r)**2 samples.
+
+plan_ranges cuts the condensed (n choose 2) pair order into [start, end) ranges of about
+target seconds each, so that rows with many masked values get longer ranges.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/cost_model.py npyfile=/fs/lustre/osu6683/gse7307/GSE7307.tab.data.npy function=dcor target=3600
+"""
+from util import *
+from py_symmetric_matrix import inv_sym_idx
+import inspect
+import json
+import random
+import sys
+import time
+
+# Order p of the time of a pair in its number of shared samples m.
+ORDERS = {
+  'pearson': 1.0,
+  'covariance': 1.0,
+  'euclidean': 1.0,
+  'spearman': 1.1,
+  'kendalltau': 1.1,
+  'dcor': 2.0,
+  'mine': 2.0,
+  'hhg': 2.2,
+  }
+# Orders of function backends which differ from their function's.
+BACKEND_ORDERS = {
+  ('dcor', 'fast'): 1.1,
+  }
+assert set(ORDERS) <= set(FUNCTIONS), "Orders of unknown functions %s." % sorted(set(ORDERS) - set(FUNCTIONS))
+assert set([name for name, backend in BACKEND_ORDERS]) <= set(FUNCTIONS)
+SAMPLE_PAIRS = 100
+# Rows of each block timed by calibrate_sample in block mode.
+SAMPLE_BLOCK_ROWS = 32
+SAMPLE_SECONDS = 30
+SEED = 0
+# Default target runtime of a job as a fraction of the walltime.
+TARGET_FRACTION = 0.5
+
+def walltime_seconds(walltime):
+  """Return int of seconds of a PBS walltime str, e.g., '24:00:00'."""
+  seconds = 0
+  for part in str(walltime).split(':'):
+    seconds = seconds * 60 + int(part)
+  return seconds
+
+def function_order(function, backend=None):
+  """Return float of the order in shared samples of a function or of fused functions."""
+  orders = []
+  for name in split_functions(function):
+    orders.append(BACKEND_ORDERS.get((name, backend), ORDERS.get(name, 2.0)))
+  return max(orders)
+
+def row_fractions(M, block_rows=1024):
+  """Return float np.array of the fraction of unmasked values of each row of masked matrix M."""
+  n, m = np.size(M, 0), np.size(M, 1)
+  mask = ma.getmask(M)
+  if mask is ma.nomask:
+    return np.ones(n)
+  f = np.empty(n)
+  for r0 in xrange(0, n, block_rows):
+    f[r0:r0+block_rows] = 1 - np.asarray(mask[r0:r0+block_rows]).sum(1) / float(m)
+  return f
+
+def fit(m, seconds, order):
+  """Return (a, b) of the least squares fit of seconds ~ a + b * m**order, both >= 0."""
+  m, seconds = np.asarray(m, dtype=np.float), np.asarray(seconds, dtype=np.float)
+  X = np.column_stack((np.ones(np.size(m)), m ** order))
+  if np.size(np.unique(m)) > 1:
+    (a, b), _, _, _ = np.linalg.lstsq(X, seconds, rcond=-1)
+    if a >= 0 and b > 0:
+      return float(a), float(b)
+  # Too little spread of m or a negative term: attribute all time to the m**order term.
+  return 0.0, float(seconds.sum() / max(X[:,1].sum(), 1e-12))
+
+
+class CostModel(object):
+  """Seconds of pairs of rows of a matrix: a + b * (m_cols * f_x * f_y)**order."""
+  def __init__(self, a, b, order, f, m_cols, source=None):
+    self.a, self.b, self.order = float(a), float(b), float(order)
+    self.f, self.m_cols = np.asarray(f, dtype=np.float), int(m_cols)
+    self.n = np.size(self.f)
+    self.source = source
+    # Row weights and prefix sums of f**order over rows: G[y] = sum of f[:y]**order.
+    self.w = self.b * (self.m_cols * self.f) ** self.order
+    self.G = np.concatenate(([0.0], np.cumsum(self.f ** self.order)))
+    # Condensed index of pair (x, x+1) of each row x; starts[n] is the number of pairs.
+    self.starts = row_starts(self.n)
+
+  def pair(self, x, y):
+    """Return float of estimated seconds of pair of rows x and y."""
+    return self.a + self.b * (self.m_cols * self.f[x] * self.f[y]) ** self.order
+
+  def row_span(self, x, y0, y1):
+    """Return float of estimated seconds of pairs of row x with rows [y0, y1)."""
+    return self.a * (y1 - y0) + self.w[x] * (self.G[y1] - self.G[y0])
+
+  def rows(self, x0, x1):
+    """Return float of estimated seconds of all pairs of rows [x0, x1) with later rows."""
+    x = np.arange(x0, x1)
+    return float(self.a * (self.starts[x1] - self.starts[x0]) + (self.w[x0:x1] * (self.G[-1] - self.G[x+1])).sum())
+
+  def total(self):
+    """Return float of estimated seconds of all n choose 2 pairs."""
+    return self.rows(0, self.n)
+
+  def span(self, start, end):
+    """Return float of estimated seconds of condensed range of pairs [start, end)."""
+    if start >= end:
+      return 0.0
+    x0, y0 = inv_sym_idx(start, self.n)
+    x1, y1 = inv_sym_idx(end-1, self.n)
+    if x0 == x1:
+      return self.row_span(x0, y0, y1+1)
+    return self.row_span(x0, y0, self.n) + self.rows(x0+1, x1) + self.row_span(x1, x1+1, y1+1)
+
+  def describe(self):
+    return "%s: %.3g + %.3g * m**%.2g seconds per pair; %.1f%% of %d samples unmasked on average" % \
+      (self.source, self.a, self.b, self.order, self.f.mean()*100 if self.n else 0, self.m_cols)
+
+  def plan_ranges(self, target, start=0, end=None):
+    """Return list of (start, end) condensed ranges of pairs of about target seconds each.
+
+    Ranges follow the condensed order of sym_idx: pairs (x, x+1), ..., (x, n-1) of row x
+    are contiguous. Each range has at least one pair.
+    """
+    n, target = self.n, float(target)
+    assert target > 0
+    num_pairs = int(self.starts[n])
+    end = num_pairs if end is None else min(int(end), num_pairs)
+    ranges = []
+    if start >= end:
+      return ranges
+    x, y = inv_sym_idx(int(start), n)
+    i, r0, cost = int(start), int(start), 0.0
+    while i < end:
+      # Pairs of row x from column y to the end of the row or of the last range.
+      y_end = min(n, y + end - i)
+      row = self.row_span(x, y, y_end)
+      if cost + row < target:
+        cost += row
+        i += y_end - y
+      else:
+        # Bisect for the first column y1 at which the range reaches target.
+        lo, hi = y + 1, y_end
+        while lo < hi:
+          mid = (lo + hi) // 2
+          if cost + self.row_span(x, y, mid) >= target:
+            hi = mid
+          else:
+            lo = mid + 1
+        i += lo - y
+        ranges.append((r0, i))
+        r0, cost = i, 0.0
+        y_end = lo
+      if y_end < n:
+        y = y_end
+      else:
+        x, y = x + 1, x + 2
+    if r0 < end:
+      ranges.append((r0, end))
+    return ranges
+
+
+def row_starts(n):
+  """Return int np.array of the condensed index of pair (x, x+1) of each row x < n, and n choose 2."""
+  x = np.arange(n+1, dtype=np.int64)
+  return x*(2*n-x-1)//2
+
+def calibrate_sample(M, function, n_pairs=SAMPLE_PAIRS, max_seconds=SAMPLE_SECONDS, seed=SEED, f=None, block=False, **kwds):
+  """Return CostModel of function calibrated by timing random pairs of rows of M.
+
+  Stops after n_pairs pairs or max_seconds seconds. If block, times compute_block of
+  random sets of SAMPLE_BLOCK_ROWS rows, at least two, as blocks are computed in batch
+  jobs. kwds are passed to make_batch.
+  """
+  n, m_cols = np.size(M, 0), np.size(M, 1)
+  order = function_order(function, kwds.get('backend'))
+  if f is None:
+    f = row_fractions(M)
+  rng = random.Random(seed)
+  if block:
+    shared, seconds = calibrate_blocks(M, function, n_pairs, max_seconds, rng, **kwds)
+  else:
+    shared, seconds = calibrate_pairs(M, function, n_pairs, max_seconds, rng, **kwds)
+  a, b = fit(shared, seconds, order)
+  return CostModel(a, b, order, f, m_cols, source="%d sampled pairs%s" % (len(seconds), " in blocks" if block else ""))
+
+def calibrate_pairs(M, function, n_pairs, max_seconds, rng, **kwds):
+  """Return ([int], [float]) of shared samples and seconds of random pairs of rows of M."""
+  n = np.size(M, 0)
+  F = make_batch(function, max(int(n_pairs), 1)+1, **kwds)
+  # Warm up, e.g., lazy imports and first calls of compiled code.
+  F.compute_pair(M[0], M[1], 0)
+  shared, seconds = [], []
+  t0 = time.time()
+  for i in xrange(int(n_pairs)):
+    x, y = sorted(rng.sample(xrange(n), 2))
+    u, v = M[x], M[y]
+    t = time.time()
+    F.compute_pair(u, v, i+1)
+    seconds.append(time.time() - t)
+    shared.append(np.count_nonzero(~(ma.getmaskarray(u) | ma.getmaskarray(v))))
+    if time.time() - t0 > max_seconds:
+      break
+  return shared, seconds
+
+def calibrate_blocks(M, function, n_pairs, max_seconds, rng, rows=SAMPLE_BLOCK_ROWS, **kwds):
+  """Return ([float], [float]) of mean shared samples and seconds per pair of compute_block
+  of random sets of rows of M, in total of at least n_pairs pairs and two blocks.
+  """
+  n = np.size(M, 0)
+  k = min(int(rows), n)
+  F = make_batch(function, 1, **kwds)
+  assert F.BLOCK, "Function %s does not support block mode." % function
+  # Warm up, e.g., lazy imports and first calls of compiled code.
+  P = F.prepare_rows(M[:2])
+  F.compute_block(P, P)
+  shared, seconds = [], []
+  t0 = time.time()
+  while len(seconds) < 2 or len(seconds) * k * k < n_pairs:
+    R = M[sorted(rng.sample(xrange(n), k))]
+    P = F.prepare_rows(R)
+    t = time.time()
+    F.compute_block(P, P)
+    seconds.append((time.time() - t) / (k * k))
+    U = (~ma.getmaskarray(R)).astype(np.float)
+    shared.append(np.dot(U, U.T).mean())
+    if time.time() - t0 > max_seconds:
+      break
+  return shared, seconds
+
+def calibrate_benchmark(fname, function, f, m_cols, backend=None, mode='pair'):
+  """Return CostModel of function calibrated from results of benchmark.py saved in fname.
+
+  Uses runs of each member function of function (in mode, of backend if given, else
+  of the function's default backend); fused functions add the times of their members.
+  Returns None if any member has no successful runs.
+  """
+  results = [r for r in json.load(open(fname))['results'] if 'pairs_per_sec' in r]
+  order = function_order(function, backend)
+  a, b = 0.0, 0.0
+  for name in split_functions(function):
+    runs = [r for r in results if r['function'] == name and r.get('mode', 'pair') == mode]
+    backends = set([r.get('backend') for r in runs])
+    if backend in backends:
+      runs = [r for r in runs if r.get('backend') == backend]
+    elif len(backends) > 1:
+      runs = [r for r in runs if r.get('backend') == default_backend(name)]
+    if not runs:
+      return None
+    m = [r['n_samples'] * (1 - r['mask'])**2 for r in runs]
+    a_name, b_name = fit(m, [1.0 / r['pairs_per_sec'] for r in runs], order)
+    a, b = a + a_name, b + b_name
+  return CostModel(a, b, order, f, m_cols, source="benchmark %s" % fname)
+
+def default_backend(name):
+  """Return str of the default backend of function name, or None."""
+  cls = FUNCTIONS[name]
+  if not getattr(cls, 'BACKENDS', None):
+    return None
+  spec = inspect.getargspec(cls.__init__)
+  return dict(zip(spec.args[-len(spec.defaults):], spec.defaults)).get('backend')
+
+
+if __name__ == "__main__":
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  M = load_masked(args['npyfile'])
+  block = is_dry(args.get('block', False))
+  if 'benchmark' in args:
+    C = calibrate_benchmark(args['benchmark'], args['function'], row_fractions(M), np.size(M, 1), args.get('backend'), 'block' if block else 'pair')
+  else:
+    C = calibrate_sample(M, args['function'], block=block)
+  print C.describe()
+  print "Estimated %.1f seconds for all %d pairs." % (C.total(), C.n*(C.n-1)//2)
+  if 'target' in args:
+    ranges = C.plan_ranges(float(args['target']))
+    print "%d jobs of about %s seconds." % (len(ranges), args['target'])
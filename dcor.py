@@ -28,5 +28,17 @@ def dcov_all(x, y):
   dr = dc / (np.sqrt(dvx) * np.sqrt(dvy))
   return dc, dr, dvx, dvy
 
+class D_N(object):
+  """Double-centered distance matrix with the same interface as dcor_cpy.D_N."""
+  def __init__(self, x):
+    self.dn = d_n(np.asarray(x, dtype=np.double))
+    self.dim = np.size(x)
+
+  def squared_sum(self):
+    return (self.dn**2).sum()
+
+  def product_sum(self, other):
+    return (self.dn * other.dn).sum()
+
 def dcor(x,y):
   return dcov_all(x,y)[1]
@@ -1,16 +1,138 @@
-from batch import Batch
+from batch import Batch, RowCache, CACHE_SIZE, CACHE_BYTES
 import numpy as np
-# Comment cpy dcor, uncomment native python dcor for pychecker.
-from dcor_cpy import *
-#from dcor import *
+import numpy.ma as ma
+# Distance correlation implementations share the interface dcov_all(x, y) and D_N(x).
+# cpy: compiled O(n^2) time, O(n) space; numpy: O(n^2) time and space;
+# fast: O(n log n) time and O(n) space by sorting.
+import dcor_cpy
+import dcor
+import dcor_fast
+
+BACKENDS = {
+  'cpy': dcor_cpy,
+  'numpy': dcor,
+  'fast': dcor_fast,
+  }
+# Largest number of permutations evaluated at once by permutation_pv.
+PERM_CHUNK = 100
+# Number of elements of permuted distance matrices evaluated at once.
+PERM_ELEMS = 2**22
+
+
+def permutation_pv(A, B, n_perm, alpha=0.05, rng=np.random):
+  """Return permutation test p-value of distance covariance from double-centered matrices.
+
+  Each permutation p of the samples of y gives the statistic sum(A * B[p][:,p]); only
+  indices of B are permuted, so each permutation costs one O(n^2) product with no
+  distances recomputed. Permutations are evaluated in vectorized chunks. Sampling
+  stops early once the p-value estimate minus 3 standard errors exceeds alpha.
+
+  Returns:
+    float of (1 + number of permutations with a statistic >= observed) / (1 + permutations)
+  """
+  n = np.size(A, 0)
+  t_obs = (A * B).sum()
+  t_min = t_obs - 1e-12 * abs(t_obs)
+  chunk = max(1, min(PERM_CHUNK, PERM_ELEMS // (n*n)))
+  hits, done = 0, 0
+  while done < n_perm:
+    m = min(chunk, n_perm - done)
+    idx = np.argsort(rng.rand(m, n), axis=1)
+    T = np.einsum('ij,pij->p', A, B[idx[:,:,None], idx[:,None,:]])
+    hits += np.count_nonzero(T >= t_min)
+    done += m
+    pv = (hits + 1.0) / (done + 1)
+    if pv - 3 * np.sqrt(pv * (1-pv) / done) > alpha:
+      break
+  return pv
 
 
 class DcorBatch(Batch):
+  """Distance correlation. compute_shared keeps a bounded LRU cache of per-row D_N
+  state so that a row's distance means are computed once per batch whenever a pair
+  keeps all of the row's own samples (always the case with no missing values).
+  """
   MNAMES = ["DCOR", "DCOV"]
+  BACKENDS = BACKENDS
+
+  def __init__(self, size=1, backend='cpy', cache_size=CACHE_SIZE, cache_mb=None, n_perm=0, alpha=0.05, seed=0, n_threads=None):
+    """The D_N cache holds at most cache_size rows and cache_mb MB (default CACHE_BYTES);
+    a row's D_N is O(n) with the cpy and fast backends, but an n x n matrix with numpy.
+    n_perm > 0 adds matrix DCOR_PV of permutation test p-values (see permutation_pv);
+    the cache then also holds each row's n x n distance matrix with cpy and fast.
+    n_threads sets the threads of the cpy backend (see dcor_cpy.set_num_threads)."""
+    assert backend in BACKENDS, "Unknown dcor backend %s." % backend
+    self.backend = backend
+    self.lib = BACKENDS[backend]
+    if n_threads is not None:
+      assert backend == 'cpy', "n_threads requires the cpy backend."
+      dcor_cpy.set_num_threads(int(n_threads))
+    self.cache = RowCache(int(cache_size), CACHE_BYTES if cache_mb is None else int(float(cache_mb) * 2**20))
+    self.n_perm, self.alpha = int(n_perm), float(alpha)
+    assert self.n_perm >= 0 and 0 < self.alpha < 1
+    if self.n_perm:
+      self.MNAMES = self.MNAMES + ["DCOR_PV"]
+      self.rng = np.random.RandomState(int(seed))
+    super(DcorBatch, self).__init__(size)
+
+  def state(self, x):
+    """Return (D_N, squared_sum) of sample vector x."""
+    dn = self.lib.D_N(np.array(x, dtype=np.double))
+    return dn, dn.squared_sum()
+
+  def compute_shared(self, pair, i):
+    assert i >= 0
+    if np.size(pair.X) == 0:
+      # No shared samples, e.g., an all masked row.
+      for name in self.MNAMES:
+        self.Matrices[name][i] = np.nan
+      return
+    states = []
+    for z, key in zip((pair.X, pair.Y), pair.own_keys()):
+      if key is None:
+        states.append(self.state(z))
+      else:
+        states.append(self.cache.get(key, lambda: self.state(z)))
+    (dnx, sx), (dny, sy) = states
+    # Same arithmetic as dcov_all.
+    denom = float(dnx.dim * dnx.dim)
+    dc = dnx.product_sum(dny) / denom
+    dvx = sx / denom
+    dvy = sy / denom
+    self.Matrices["DCOR"][i] = dc / (np.sqrt(dvx) * np.sqrt(dvy))
+    self.Matrices["DCOV"][i] = dc
+    if self.n_perm:
+      self.Matrices["DCOR_PV"][i] = self.permutation_pv(pair.X, pair.Y, dnx, dny, pair.own_keys())
+
+  def d_n(self, z, dn, key=None):
+    """Return double-centered distance matrix of z: that of the numpy backend's D_N dn,
+    else dcor.d_n, cached by own key in the D_N cache if key is not None."""
+    A = getattr(dn, 'dn', None)
+    if A is not None:
+      return A
+    make = lambda: dcor.d_n(np.asarray(z, dtype=np.double))
+    if key is None:
+      return make()
+    return self.cache.get(('d_n', key), make)
+
+  def permutation_pv(self, x, y, dnx, dny, keys=(None, None)):
+    """Return permutation test p-value of x and y with D_N states dnx and dny."""
+    if np.size(x) < 2:
+      return np.nan
+    A, B = self.d_n(x, dnx, keys[0]), self.d_n(y, dny, keys[1])
+    return permutation_pv(A, B, self.n_perm, self.alpha, self.rng)
+
+  def report(self):
+    lines = ["D_N cache (%s backend): %s" % (self.backend, self.cache)]
+    if self.backend == 'cpy':
+      lines.append("dcor_cpy threads: %d" % dcor_cpy.get_num_threads())
+    return lines
 
   def compute(self, x, y, i):
     assert type(int(i)) == int
     assert np.size(x) == np.size(y) and i >= 0
-    dc, dr, dvx, dvy = dcov_all(x,y)
+    dc, dr, dvx, dvy = self.lib.dcov_all(x,y)
     self.Matrices["DCOR"][i] = dr
     self.Matrices["DCOV"][i] = dc
+    if self.n_perm:
+      self.Matrices["DCOR_PV"][i] = self.permutation_pv(x, y, None, None)
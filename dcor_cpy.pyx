@@ -40,6 +40,12 @@ For vectors of length 1000, this is about 40% faster.
 
 HOWEVER: it does not handle missing values which must be handled prior to passing
 vectors to this function.
+
+The O(n^2) loops release the GIL and run the outer loop over OpenMP threads when
+compiled with OpenMP (see setup_cython.py). The number of threads is 1 unless set by
+set_num_threads, so that processes which each compute pairs do not oversubscribe cores.
+Sums over threads are added in a different order than in one thread; results may
+differ in the last bits.
 """
 DCOR_LIB = "cython"
 
@@ -47,12 +53,36 @@ DCOR_LIB = "cython"
 import numpy as np
 cimport numpy as np
 import cython
+from cython.parallel import prange
 
 
 ctypedef np.double_t DTYPE_t
 
+cdef int n_threads = 1
+
+def set_num_threads(int n):
+    'Set number of threads of the O(n^2) loops; n < 1 uses all OpenMP threads.'
+    global n_threads
+    if n < 1:
+        n = openmp_max_threads()
+    n_threads = n
+
+def get_num_threads():
+    return n_threads
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #include <omp.h>
+    static int openmp_max_threads(void) { return omp_get_max_threads(); }
+    #else
+    static int openmp_max_threads(void) { return 1; }
+    #endif
+    """
+    int openmp_max_threads() nogil
+
 #purely for speed reasons
-cdef inline double myabs(double a) : return a if a >= 0. else -1 * a
+cdef inline double myabs(double a) nogil: return a if a >= 0. else -1 * a
 
 def dcov_all(x, y):
     'Calculate distance covariance, distance correlation, distance variance of x sample and distance variance of y sample'
@@ -74,44 +104,45 @@ class D_N:
     the matrix members on the fly"""
 
     def __init__(self, x):
-        self.x = np.array(x)
+        self.x = np.ascontiguousarray(x, dtype=np.double)
         self.dim = x.shape[0]
         self.calculate_means()
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def calculate_means(self):
+        # Distances are symmetric, so row and column sums are the same.
         cdef int dim = self.dim
-        cdef DTYPE_t value
-        cdef DTYPE_t sum_total = 0
+        cdef DTYPE_t row
         cdef np.ndarray[DTYPE_t, ndim=1] sum_0 = np.zeros(dim, dtype=np.double)
-        cdef np.ndarray[DTYPE_t, ndim=1] sum_1 = np.zeros(dim, dtype=np.double)
-        cdef np.ndarray[DTYPE_t, ndim=1] x = self.x
-        cdef unsigned int ii
-        cdef unsigned int jj
-        for ii in range(dim):
+        cdef double[::1] s = sum_0
+        cdef double[::1] x = self.x
+        cdef int ii
+        cdef int jj
+        for ii in prange(dim, nogil=True, num_threads=n_threads, schedule='static'):
+            row = 0
             for jj in range(dim):
-                value = myabs(x[jj] - x[ii])
-                sum_total += value
-                sum_1[jj] += value
-                sum_0[ii] += value
-        self.mean = sum_total / (self.dim**2)
+                row = row + myabs(x[jj] - x[ii])
+            s[ii] = row
+        self.mean = sum_0.sum() / (self.dim**2)
         self.mean_0 = sum_0 / (self.dim)
-        self.mean_1 = sum_1 / (self.dim)
+        self.mean_1 = self.mean_0.copy()
         return
 
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def squared_sum(self):
-        cdef np.ndarray[DTYPE_t, ndim=1] mean_0 = self.mean_0
-        cdef np.ndarray[DTYPE_t, ndim=1] mean_1 = self.mean_1
+        cdef double[::1] mean_0 = self.mean_0
+        cdef double[::1] mean_1 = self.mean_1
         cdef DTYPE_t mean = self.mean
         cdef DTYPE_t squared_sum = 0
         cdef DTYPE_t dist
         cdef DTYPE_t d
-        cdef np.ndarray[DTYPE_t, ndim=1] x = self.x
-        cdef unsigned int dim = self.dim
-        cdef unsigned int ii
-        cdef unsigned int jj
-        for ii in range(dim):
+        cdef double[::1] x = self.x
+        cdef int dim = self.dim
+        cdef int ii
+        cdef int jj
+        for ii in prange(dim, nogil=True, num_threads=n_threads, schedule='static'):
             for jj in range(dim): 
                 dist = myabs(x[jj] - x[ii])
                 d = dist - mean_0[ii] - mean_1[jj] + mean
@@ -119,23 +150,24 @@ class D_N:
         return squared_sum
    
     @cython.boundscheck(False)
+    @cython.wraparound(False)
     def product_sum(self, other):
-        cdef np.ndarray[DTYPE_t, ndim=1] mean_0_here = self.mean_0
-        cdef np.ndarray[DTYPE_t, ndim=1] mean_1_here = self.mean_1
+        cdef double[::1] mean_0_here = self.mean_0
+        cdef double[::1] mean_1_here = self.mean_1
         cdef DTYPE_t mean_here = self.mean
-        cdef np.ndarray[DTYPE_t, ndim=1] mean_0_there = other.mean_0
-        cdef np.ndarray[DTYPE_t, ndim=1] mean_1_there = other.mean_1
+        cdef double[::1] mean_0_there = other.mean_0
+        cdef double[::1] mean_1_there = other.mean_1
         cdef DTYPE_t mean_there = other.mean
         cdef DTYPE_t d_here
         cdef DTYPE_t d_there
         cdef DTYPE_t product_sum = 0
-        cdef np.ndarray[DTYPE_t, ndim=1] x = self.x
-        cdef np.ndarray[DTYPE_t, ndim=1] y = other.x
+        cdef double[::1] x = self.x
+        cdef double[::1] y = other.x
 
-        cdef unsigned int dim = self.dim
-        cdef unsigned int ii
-        cdef unsigned int jj
-        for ii in range(dim):
+        cdef int dim = self.dim
+        cdef int ii
+        cdef int jj
+        for ii in prange(dim, nogil=True, num_threads=n_threads, schedule='static'):
             for jj in range(dim): 
                 d_here = myabs(x[jj] - x[ii]) - mean_0_here[ii] - mean_1_here[jj] + mean_here
                 d_there = myabs(y[jj] - y[ii]) - mean_0_there[ii] - mean_1_there[jj] + mean_there
@@ -1,25 +1,125 @@
 #!/usr/bin/python
 """Dispatch pairwise dependency computations.
 
-Note: .npy now should be .pkl
+Note: .npy now should be .pkl. Batch jobs read the matrix as a memory-mapped
+.data.npy and .mask.npy pair saved next to the .pkl.
 
 USE EXAMPLE:
 
 time python $HOME/dependency_matrix_dispatcher/dispatch_pairwise.py outdir=/fs/lustre/osu6683/gse7307 tabfile=/nfs/01/osu6683/gse7307/GSE7307_GPL570.normed.masked.pkl.gt0.25.pina.tab dry=True
+
+Add partition=tiles to give each job a (tile_rows x tile_rows) tile of the upper
+triangle rather than a contiguous range of k pairs; tile_rows defaults to sqrt(k).
+
+Give several functions joined by '+' (e.g., function=pearson+spearman+dcor), or add
+fuse=True to fuse all functions, to compute them in one job array that extracts each
+pair's shared samples once; outputs are the same as separate dispatches.
+
+Add resume=True to dispatch only work missing from a previous dispatch: each function's
+work_dir is scanned for verified batch outputs, a manifest.json of completed ranges is
+saved, and jobs are generated only for the gaps, or for tiles with pairs in the gaps.
+Add merge_gaps=True to merge neighboring gaps of at most k pairs into one job; the
+completed pairs between them are recomputed.
+
+Add keep=topk:K or keep=abs_gt:T to save only the strongest pairs of each batch as
+sparse records (see sparse_edges.py).
+
+Add n_perm=B to also compute dcor permutation test p-values (DCOR_PV).
+
+Add n_threads=T to compute dcor pairs on T threads per batch (see batch_pairwise.py);
+with backend=local, use it with few n_workers to share one loaded matrix among cores.
+
+Add screen=MEASURE:abs_gt:T or screen=MEASURE:top:F to compute functions only on pairs
+passing a cheap screening measure (see cascade.py); others are left unset.
+
+Add timing=True to save stage times of each batch (see metrics.py); compile_pairwise.py
+aggregates them.
+
+Add k=auto to size jobs by estimated runtime rather than by a fixed number of pairs k:
+each function's time per pair is calibrated from a sample of pairs of the matrix, or
+from benchmark=[benchmark.py json] if it has runs of the function, and ranges are cut
+to about target_runtime seconds each (default half the walltime), accounting for the
+fraction of masked values of each row (see cost_model.py). Requires partition=range.
+
+Add backend=local n_workers=N to run the same batches in a local pool of N processes
+sharing one loaded matrix rather than submitting them by qsub.
 """
 from util import *
+from batch_pairwise import parse_span
+import batch_pairwise
+import cascade
+import cost_model
+import local_pool
+import manifest
 import sys
 import shutil
 import math
 import cPickle as pickle
 
 
-BATCH_CMD = "time python %(script_path)s/%(script_fname)s npyfile=%(npyfile)s start=%(start)d end=%(end)d work_dir=%(work_dir)s function=%(function)s n=%(n)d > %(stdout_fname)s 2> %(stderr_fname)s"
+BATCH_CMD = "time python %(script_path)s/%(script_fname)s npyfile=%(npyfile)s %(span)s work_dir=%(work_dir)s function=%(function)s n=%(n)d%(options)s > %(stdout_fname)s 2> %(stderr_fname)s"
+
+def make_chunks(num_pairs, n, k, start_offset=0, partition='range', tile_rows=None):
+  """Divide work into batch jobs.
+
+  Returns:
+    [({str: obj}, str)] of batch_pairwise keyword arguments and log file name suffix
+  """
+  chunks = []
+  if partition == 'range':
+    for start in xrange(start_offset, num_pairs, k):
+      end = min(start + k, num_pairs)
+      chunks.append(({'start': start, 'end': end}, "%d_%d" % (start, end)))
+  elif partition == 'tiles':
+    if tile_rows is None:
+      tile_rows = max(int(math.sqrt(k)), 2)
+    tile_rows = int(tile_rows)
+    assert tile_rows > 1
+    for x0 in xrange(0, n, tile_rows):
+      x1 = min(x0 + tile_rows, n)
+      for y0 in xrange(x0, n, tile_rows):
+        y1 = min(y0 + tile_rows, n)
+        chunks.append(({'rows': "%d:%d" % (x0, x1), 'cols': "%d:%d" % (y0, y1)}, \
+          "tile_%d_%d_%d_%d" % (x0, x1, y0, y1)))
+  else:
+    raise Exception, "Unknown partition %s." % partition
+  return chunks
+
+def estimate_cost(M, function, row_fractions, options, benchmark=None):
+  """Return cost_model.CostModel of function for matrix M with batch options."""
+  backend = options.get('backend')
+  if benchmark:
+    mode = 'block' if options.get('block') else 'pair'
+    cost = cost_model.calibrate_benchmark(benchmark, function, row_fractions, np.size(M, 1), backend, mode)
+    if cost is not None:
+      return cost
+    print "No %s runs of %s in benchmark %s. Calibrate from sampled pairs." % (mode, function, benchmark)
+  kwds = dict([(key, options[key]) for key in ('backend', 'n_perm', 'n_threads') if key in options])
+  return cost_model.calibrate_sample(M, function, f=row_fractions, block=bool(options.get('block')), **kwds)
+
+def check_walltime(cost, chunks, target_runtime, walltime, n_slots):
+  """Print the estimated runtime of jobs; warn if they may not finish within walltime."""
+  times = [cost.span(span['start'], span['end']) for span, suffix in chunks]
+  total, longest = sum(times), max(times) if times else 0
+  limit = cost_model.walltime_seconds(walltime)
+  print "Estimated %.1f seconds in %d jobs of about %.1f seconds (longest %.1f) on %d slots." % \
+    (total, len(chunks), target_runtime, longest, n_slots)
+  if longest > limit:
+    print "!!! WARNING: longest job is estimated to exceed walltime %s." % walltime
+  if total / n_slots > limit:
+    print "!!! WARNING: all jobs are estimated to take %.0f seconds on %d slots, more than walltime %s." % \
+      (total / n_slots, n_slots, walltime)
 
-def dispatch_pairwise(tabfile=None, pkl_file=None, outdir=WORK_DIR, function=None, k=200000, dry=False, start_offset=0, work_dir=WORK_DIR, jobname=None, n_nodes=6, n_ppn=12, walltime='24:00:00'):
+def dispatch_pairwise(tabfile=None, pkl_file=None, outdir=WORK_DIR, function=None, k=200000, dry=False, start_offset=0, work_dir=WORK_DIR, jobname=None, n_nodes=6, n_ppn=12, walltime='24:00:00', block=False, partition='range', tile_rows=None, resume=False, fuse=False, function_backend=None, backend='qsub', n_workers=None, keep=None, n_perm=None, timing=False, target_runtime=None, benchmark=None, n_threads=None, screen=None, merge_gaps=False):
   assert bool(tabfile is None) != bool(pkl_file is None)
   if pkl_file:
     assert pkl_file.rpartition('.')[2].lower() == "pkl"
+  auto_k = str(k).lower() == 'auto'
+  if auto_k:
+    assert partition == 'range', "k=auto requires partition=range."
+    target_runtime = float(target_runtime or cost_model.walltime_seconds(walltime) * cost_model.TARGET_FRACTION)
+    # Custom batch scripts are not calibrated; they get the default k.
+    k = 200000
   n_nodes, n_ppn, start_offset, k = map(int, (n_nodes, n_ppn, start_offset, k))
   assert k > 1 and start_offset >= 0 and n_nodes > 0 and n_ppn > 0
   if jobname is None:
@@ -29,16 +129,22 @@ def dispatch_pairwise(tabfile=None, pkl_file=None, outdir=WORK_DIR, function=Non
       jobname_base = os.path.basename(pkl_file)
   else:
     jobname_base = jobname
+  block, dry, resume, fuse = is_dry(block), is_dry(dry), is_dry(resume), is_dry(fuse)
+  timing, merge_gaps = is_dry(timing), is_dry(merge_gaps)
+  assert not (resume and keep), "resume=True does not support sparse outputs (keep)."
+  assert backend in ('qsub', 'local')
 
   # If no function is set, run for all 'non-ignored' functions.
   if function is None:
-    all_functions = {}
-    for name in FUNCTIONS:
-      if name not in IGNORE:
-        all_functions[name] = FUNCTIONS[name]
+    names = sorted([name for name in FUNCTIONS if name not in IGNORE])
   else:
-    assert function in FUNCTIONS
-    all_functions = {function: FUNCTIONS[function]}
+    names = split_functions(function)
+  # Fused functions are computed together in one job per chunk.
+  if fuse or (len(names) > 1 and function is not None):
+    assert all([type(FUNCTIONS[name]) != str for name in names]), "Cannot fuse custom batch scripts."
+    all_functions = {"+".join(names): names}
+  else:
+    all_functions = dict([(name, [name]) for name in names])
 
   # create outdir if it does not exist
   if not os.path.exists(outdir):
@@ -50,76 +156,146 @@ def dispatch_pairwise(tabfile=None, pkl_file=None, outdir=WORK_DIR, function=Non
   os.chdir(outdir)
   print "Changed working directory to outdir %s." % (outdir)
 
-  # for each function, create subdirs
+  # for each function, create subdirs; fused batches write to each function's subdir
   outdirs = {}
-  for function in all_functions:
+  for function in names:
     path = os.path.join(outdir, function)
     make_dir(path)
     outdirs[function] = os.path.abspath(path)
+  for function in all_functions:
+    if function not in outdirs:
+      outdirs[function] = os.path.abspath(outdir)
 
   # If provided a pickled numpy matrix already, then we don't need to covert it.
   if pkl_file:
     print "Given npy matrix %s. Do not convert from .tab text file." % (pkl_file)
-    M = pickle.load(open(pkl_file))
+    data_fname = npy_pair_fnames(pkl_file)[0]
+    if os.path.exists(data_fname):
+      M = load_masked(data_fname)
+    else:
+      M = pickle.load(open(pkl_file))
+      save_npy_pair(M, pkl_file)
     n = np.size(M,0)
     print "M is (%d by %d)" % (np.size(M,0), np.size(M,1))
     del M
-  # Convert .tab into pickled npy np.ma.MaskedArray matrix
+  # Convert .tab into a data and mask .npy pair
   else:
-    pkl_file, n, M = npy_varlist_from_tabfile(tabfile, outdir)
+    data_fname, n, M = npy_varlist_from_tabfile(tabfile, outdir, n_workers=n_workers or 1)
     del M
 
-  # Move npy_fname to workdir
+  # Move memory-mappable data and mask .npy pair to workdir for batch jobs.
   bool_copy = (tabfile is None) # if not provided tabfile, then copy npy, don't move it
   if bool_copy:
     print "Tab file not converted; copy npy matrix rather than move it."
-  work_npy_fname = move_numpy_to_workdir(work_dir, pkl_file, bool_copy)
+  work_npy_fname = move_numpy_to_workdir(work_dir, data_fname, bool_copy)
   
   # dispatch jobs in a loop
   num_pairs = int(n * (n-1) / 2) # no diagonal: n choose 2
+  if auto_k:
+    M = load_masked(work_npy_fname)
+    row_fractions = cost_model.row_fractions(M)
 
   # Write jobs to dispatch script in a list.
   t = tstamp()
-  for function in all_functions:
+  local_jobs = []
+  for function, members in all_functions.items():
+    classes = [FUNCTIONS[name] for name in members]
     # Handle custom batch scripts
-    if type(all_functions[function]) == str:
+    if type(classes[0]) == str:
       print "%s type is string '%s', not function. Assume that it is the name of custom batch file." \
-          % (function, all_functions[function])
-      script_fname = all_functions[function]
+          % (function, classes[0])
+      script_fname = classes[0]
     else:
       script_fname = "batch_pairwise.py"
       
     jobname = "%s_%s" % (jobname_base, function)
+    # Options passed through to each batch command.
+    options = {}
+    if block and all([getattr(cls, 'BLOCK', False) for cls in classes]):
+      options['block'] = True
+    if function_backend is not None and any([function_backend in getattr(cls, 'BACKENDS', {}) for cls in classes]):
+      options['backend'] = function_backend
+    if keep is not None:
+      options['keep'] = keep
+    if n_perm is not None and 'dcor' in members:
+      options['n_perm'] = int(n_perm)
+    if screen is not None:
+      cascade.parse_screen(screen)
+      options['screen'] = screen
+    if n_threads is not None and 'dcor' in members:
+      options['n_threads'] = int(n_threads)
+    if timing:
+      options['timing'] = True
     # Create new dispatch script per function
     dispatch_script_fname = \
       make_script_name(work_dir, os.path.basename(work_npy_fname), "dispatch_%s" % function)
+    cost = None
+    if auto_k and script_fname == "batch_pairwise.py":
+      cost = estimate_cost(M, function, row_fractions, options, benchmark)
+      print cost.describe()
+      chunks = [({'start': start, 'end': end}, "%d_%d" % (start, end)) \
+        for start, end in cost.plan_ranges(target_runtime, start_offset)]
+      check_walltime(cost, chunks, target_runtime, walltime, n_nodes*n_ppn)
+    else:
+      chunks = make_chunks(num_pairs, n, k, start_offset, partition, tile_rows)
+    if resume and script_fname == "batch_pairwise.py":
+      missing = []
+      kwds = dict([(key, options[key]) for key in ('backend', 'n_perm') if key in options])
+      mnames = batch_mnames(function, **kwds)
+      for name in members:
+        batch_id = "%s_%s" % (os.path.basename(work_npy_fname), name)
+        done = manifest.build_manifest(outdirs[name], batch_id, mnames[name], num_pairs, start_offset)
+        missing += done['missing']
+      missing = manifest.merge_ranges(missing)
+      if cost is not None:
+        chunks = [({'start': start, 'end': end}, "%d_%d" % (start, end)) \
+          for a, b in missing for start, end in cost.plan_ranges(target_runtime, a, b)]
+      elif partition == 'range':
+        spans = manifest.plan_chunks(missing, k, merge_gaps)
+        chunks = [({'start': start, 'end': end}, "%d_%d" % (start, end)) for start, end in spans]
+        n_redo = sum([b-a for a, b in spans]) - sum([b-a for a, b in missing])
+        if n_redo:
+          print "Resume: merged gaps recompute %d completed pairs." % n_redo
+      else:
+        # Tiles with any missing pair, e.g., of ranges of an earlier dispatch, are recomputed.
+        tiles = [parse_span(span['rows']) + parse_span(span['cols']) for span, suffix in chunks]
+        chunks = [chunk for chunk, todo in zip(chunks, manifest.tiles_missing(tiles, missing, n)) if todo]
+      print "Resume: dispatching %d jobs for missing work of %s." % (len(chunks), function)
+      if not chunks:
+        continue
     print "Creating batch script '%s'..." % dispatch_script_fname
     fp = open(dispatch_script_fname, 'w')
-    offset = start_offset
-    while offset < num_pairs:
-      start = offset
-      end = offset + k
-      if end > num_pairs:
-        end = num_pairs
+    for span, suffix in chunks:
+      stdout_fname = os.path.join(outdirs[function], "log_%s_%s_%s_%s.out" % (jobname, t, function, suffix))
+      stderr_fname = os.path.join(outdirs[function], "log_%s_%s_%s_%s.err" % (jobname, t, function, suffix))
       cmd = BATCH_CMD % {
         'script_path': os.path.dirname(os.path.realpath(__file__)),
         'script_fname': script_fname,
         'npyfile': work_npy_fname,
-        'start': start,
-        'end': end,
+        'span': " ".join(["%s=%s" % (key, value) for key, value in sorted(span.items())]),
         'n': n,
         'work_dir': outdirs[function],
-        'stdout_fname': os.path.join(outdirs[function], "log_%s_%s_%s_%d_%d.out" % (jobname, t, function, start, end)),
-        'stderr_fname': os.path.join(outdirs[function], "log_%s_%s_%s_%d_%d.err" % (jobname, t, function, start, end)),
+        'stdout_fname': stdout_fname,
+        'stderr_fname': stderr_fname,
         'function': function,
+        'options': "".join([" %s=%s" % (key, value) for key, value in sorted(options.items())]),
       }
       fp.write(cmd); fp.write('\n')
-      offset += k
+      if backend == 'local' and script_fname == "batch_pairwise.py":
+        kwds = {'npyfile': work_npy_fname, 'n': n, 'work_dir': outdirs[function], 'function': function}
+        kwds.update(span)
+        kwds.update(options)
+        local_jobs.append((batch_pairwise.main, kwds, stdout_fname, stderr_fname))
     fp.close()
-    num_jobs = math.ceil(num_pairs / k)
+    num_jobs = len(chunks)
+    k_job = k if cost is None else (num_pairs - start_offset) // max(num_jobs, 1)
+    if backend == 'local':
+      if script_fname != "batch_pairwise.py":
+        print "!!! Custom batch script %s cannot run in the local backend. Skipping." % script_fname
+      continue
     # Submit job script.
     qsub_script = QSUB_TEMPLATE % {'jobname': jobname, 'n_nodes': n_nodes, 'n_ppn': n_ppn, 'walltime': walltime, \
-      'dispatch_script': dispatch_script_fname, 'num_pairs': num_pairs, 'k': k, 'num_jobs': num_jobs, 'function': function}
+      'dispatch_script': dispatch_script_fname, 'num_pairs': num_pairs, 'k': k_job, 'num_jobs': num_jobs, 'function': function}
     print qsub_script
     if not dry:
       fork_qsub_submit(qsub_script)
@@ -127,6 +303,15 @@ def dispatch_pairwise(tabfile=None, pkl_file=None, outdir=WORK_DIR, function=Non
     else:
       print "Dry run."
 
+  if backend == 'local':
+    if not dry:
+      # Load the matrix once; forked workers share it.
+      M = load_masked(work_npy_fname)
+      n_failed = local_pool.run_jobs(local_jobs, n_workers, shared={'M': M})
+      print "Local run complete. %d of %d jobs failed." % (n_failed, len(local_jobs))
+    else:
+      print "Dry run. Would run %d jobs locally." % len(local_jobs)
+
 
 if __name__ == "__main__":
   print sys.argv
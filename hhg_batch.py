@@ -1,32 +1,126 @@
 from batch import Batch
-# R and Rpy2 must be installed.
-from rpy2 import robjects
-from rpy2.robjects import r
-from rpy2.robjects.packages import importr
-import rpy2.robjects.numpy2ri
-rpy2.robjects.numpy2ri.activate()
+from dcor_fast import dense_rank, dominance_sums
 import numpy as np
+# HHG 2x2 implementations: rpy2 (default): myHHG from the HHG2x2 R library; R and rpy2
+# must be installed. numpy: O(n^2 log n) time by ranks, below.
+BACKENDS = set(['numpy', 'rpy2'])
+
+
+def max_ranks(D):
+  """Return for each entry of each row of D the number of entries of its row <= it."""
+  order = np.argsort(D, axis=1, kind='mergesort')
+  rows = np.arange(np.size(D, 0))[:,None]
+  S = D[rows, order]
+  m = np.size(D, 1)
+  is_end = np.ones(np.shape(D), dtype=np.bool)
+  is_end[:,:-1] = S[:,1:] != S[:,:-1]
+  ends = np.where(is_end, np.arange(m), m)
+  R = np.empty(np.shape(D), dtype=np.int64)
+  R[rows, order] = np.minimum.accumulate(ends[:,::-1], axis=1)[:,::-1] + 1
+  return R
+
+def hhg_2x2(x, y):
+  """Return HHG 2x2 test statistics of samples x and y.
+
+  FROM:
+  Heller, R., Heller, Y. and Gorfine, M. (2013) "A consistent multivariate test of
+  association based on ranks of distances." Biometrika 100(2).
+
+  For each ordered pair (i, j), i != j, the other n-2 samples k are tabulated by
+  |x_i - x_k| <= |x_i - x_j| and |y_i - y_k| <= |y_i - y_j|, and Pearson's chi-square and
+  the likelihood ratio of the 2x2 table are summed and maximized over all (i, j). Terms
+  of tables with an empty margin are 0, as is 0 log 0.
+
+  Tables are counted for all j of a sample i at once from ranks of distances:
+  samples are sorted by x distance rank then y distance rank, and the upper-left
+  cell is a dominance count (dcor_fast.dominance_sums) plus later joint ties. All
+  samples i are counted in one call, so the time is O(n^2 log n).
+
+  Returns:
+    {str: float} of sum_chisquared, sum_lr, max_chisquared, max_lr
+  """
+  x, y = np.asarray(x, dtype=np.double), np.asarray(y, dtype=np.double)
+  n = np.size(x)
+  assert n == np.size(y)
+  if n < 4:
+    return dict([(name, np.nan) for name in ('sum_chisquared', 'sum_lr', 'max_chisquared', 'max_lr')])
+  off = ~np.eye(n, dtype=np.bool)
+  Rx = max_ranks(np.abs(x[:,None] - x[None,:])[off].reshape(n, n-1))
+  Ry = max_ranks(np.abs(y[:,None] - y[None,:])[off].reshape(n, n-1))
+
+  # Sort each row by (Rx, Ry); count earlier samples with Ry <= in the same row. Rows
+  # are concatenated with decreasing rank offsets so earlier rows never dominate.
+  order = np.argsort(Rx * n + Ry, axis=1, kind='mergesort')
+  rows = np.arange(n)[:,None]
+  rx, ry = Rx[rows, order], Ry[rows, order]
+  offsets = (n - 1 - np.arange(n))[:,None] * n
+  dom = dominance_sums(dense_rank((ry + offsets).ravel()), np.ones((1, n*(n-1))), strict=False)[0]
+  # Add later samples in a row tied with j in both ranks.
+  key = rx * n + ry
+  is_end = np.ones(np.shape(key), dtype=np.bool)
+  is_end[:,:-1] = key[:,1:] != key[:,:-1]
+  ends = np.where(is_end, np.arange(n-1), n-1)
+  later = np.minimum.accumulate(ends[:,::-1], axis=1)[:,::-1] - np.arange(n-1)
+  a11 = dom.reshape(n, n-1) + later
+
+  m = float(n - 2)
+  a1_, a_1 = rx - 1.0, ry - 1.0
+  a12, a21 = a1_ - a11, a_1 - a11
+  a22 = m - a1_ - a_1 + a11
+  a2_, a_2 = m - a1_, m - a_1
+  with np.errstate(divide='ignore', invalid='ignore'):
+    chi = m * (a12*a21 - a11*a22)**2 / (a1_*a2_*a_1*a_2)
+    lr = 0
+    for a, r, c in ((a11, a1_, a_1), (a12, a1_, a_2), (a21, a2_, a_1), (a22, a2_, a_2)):
+      lr = lr + np.where(a > 0, a * np.log(a * m / (r * c)), 0)
+  chi[~np.isfinite(chi)] = 0
+  lr[~np.isfinite(lr)] = 0
+  return {
+    'sum_chisquared': chi.sum(),
+    'sum_lr': lr.sum(),
+    'max_chisquared': chi.max(),
+    'max_lr': lr.max(),
+    }
+
 
 class HHGBatch(Batch):
   MNAMES = ["SUM_CHI", "SUM_LR", "MAX_CHI", "MAX_LR"]
+  BACKENDS = BACKENDS
 
-  def __init__(self, size=1):
-    # Load HHG library from R installation.
-    r('library("HHG2x2")')
+  def __init__(self, size=1, backend='rpy2'):
+    assert backend in BACKENDS, "Unknown hhg backend %s." % backend
+    self.backend = backend
+    if backend == 'rpy2':
+      # Load HHG library from R installation.
+      from rpy2 import robjects
+      import rpy2.robjects.numpy2ri
+      rpy2.robjects.numpy2ri.activate()
+      self.robjects = robjects
+      robjects.r('library("HHG2x2")')
     super(HHGBatch, self).__init__(size)
 
+  def hhg_rpy2(self, x, y):
+    """Return myHHG(Dx, Dy) statistics computed by R."""
+    r = self.robjects.r
+    self.robjects.globalenv["x"] = x
+    self.robjects.globalenv["y"] = y
+    r('Dx = as.matrix(dist((x),diag=TRUE,upper=TRUE))')
+    r('Dy = as.matrix(dist((y),diag=TRUE,upper=TRUE))')
+    HHG = r('myHHG(Dx,Dy)')
+    return dict([(name, float(HHG.rx(name)[0][0])) for name in \
+      ('sum_chisquared', 'sum_lr', 'max_chisquared', 'max_lr')])
+
   def compute(self, x, y, i):
     assert type(int(i)) == int
     assert np.size(x) == np.size(y) and i >= 0
     n = np.size(x)
-    robjects.globalenv["x"] = x
-    robjects.globalenv["y"] = y
-    r('Dx = as.matrix(dist((x),diag=TRUE,upper=TRUE))')
-    r('Dy = as.matrix(dist((y),diag=TRUE,upper=TRUE))')
-    HHG = r('myHHG(Dx,Dy)')
+    if self.backend == 'rpy2':
+      HHG = self.hhg_rpy2(x, y)
+    else:
+      HHG = hhg_2x2(x, y)
     v = n*(n-2)*(n-3) # max sum_chi value
     lg = np.log(2)
-    self.Matrices["SUM_CHI"][i] = float(HHG.rx('sum_chisquared')[0][0]) / v
-    self.Matrices["SUM_LR"][i]  = float(HHG.rx('sum_lr')[0][0]) / v / lg / (2/np.e)
-    self.Matrices["MAX_CHI"][i] = float(HHG.rx('max_chisquared')[0][0]) / (n-2)
-    self.Matrices["MAX_LR"][i]  = float(HHG.rx('max_lr')[0][0]) / (n-2) / lg
+    self.Matrices["SUM_CHI"][i] = HHG['sum_chisquared'] / v
+    self.Matrices["SUM_LR"][i]  = HHG['sum_lr'] / v / lg / (2/np.e)
+    self.Matrices["MAX_CHI"][i] = HHG['max_chisquared'] / (n-2)
+    self.Matrices["MAX_LR"][i]  = HHG['max_lr'] / (n-2) / lg
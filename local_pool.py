@@ -0,0 +1,66 @@
+#!/usr/bin/python
+"""Run batch jobs in a local multiprocessing pool rather than submitting them by qsub.
+
+Used by dispatch_*.py with backend=local. Shared objects (e.g., the loaded data
+matrix) are set before the pool forks so that all workers share one copy; each job
+writes stdout and stderr to the same log file names as the qsub dispatch scripts.
+"""
+import multiprocessing
+import sys
+import traceback
+
+# Keyword arguments added to every job; inherited by forked workers.
+SHARED = {}
+
+def run_job(job):
+  """Call target(**kwds) with stdout and stderr redirected to log files.
+
+  Returns:
+    bool of whether the job completed without an exception
+  """
+  target, kwds, stdout_fname, stderr_fname = job
+  kwds = dict(kwds)
+  kwds.update(SHARED)
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = open(stdout_fname, 'w'), open(stderr_fname, 'w')
+  try:
+    target(**kwds)
+    return True
+  except Exception:
+    traceback.print_exc()
+    return False
+  finally:
+    sys.stdout.close(); sys.stderr.close()
+    sys.stdout, sys.stderr = stdout, stderr
+
+def run_jobs(jobs, n_workers=None, shared=None):
+  """Run jobs in a pool of n_workers processes.
+
+  Args:
+    jobs: [(function, {str: obj}, str, str)] of target, keyword arguments, stdout and
+      stderr file names
+    n_workers: int of processes, default number of CPUs
+    shared: {str: obj} of keyword arguments shared by all jobs without pickling
+  Returns:
+    int of number of failed jobs
+  """
+  if n_workers is None:
+    n_workers = multiprocessing.cpu_count()
+  n_workers = int(n_workers)
+  assert n_workers > 0
+  SHARED.clear()
+  SHARED.update(shared or {})
+  print "Running %d jobs in a local pool of %d workers..." % (len(jobs), n_workers)
+  pool = multiprocessing.Pool(n_workers)
+  n_done, n_failed = 0, 0
+  try:
+    for ok in pool.imap_unordered(run_job, jobs):
+      n_done += 1
+      if not ok:
+        n_failed += 1
+      print "Completed %d of %d jobs (%d failed)." % (n_done, len(jobs), n_failed)
+  finally:
+    pool.close()
+    pool.join()
+    SHARED.clear()
+  return n_failed
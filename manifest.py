@@ -0,0 +1,182 @@
+#!/usr/bin/python
+"""Manifest of completed batch outputs in a function's work_dir, used to resume dispatch.
+
+A condensed range [start, end) (or tile) is complete when every matrix of the function
+(Batch.MNAMES) has an output file that loads and has the expected size. Tiles count as
+the condensed ranges of their pairs, so ranges and tiles of either partition are
+complete in a resume with the other. Dispatch then generates jobs only for the missing
+gaps, or only for tiles with missing pairs.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/manifest.py work_dir=/fs/lustre/osu6683/gse7307/dcor batch_id=GSE7307.tab.data.npy_dcor function=dcor num_pairs=1494625975
+"""
+from compile_pairwise import RX, RX_TILE, n_rows_from_pairs
+from py_symmetric_matrix import sym_idx
+from util import tstamp, batch_mnames
+import bisect
+import json
+import os, sys
+import numpy as np
+
+MANIFEST_FNAME = "manifest.json"
+
+def merge_ranges(ranges):
+  """Return sorted list of disjoint [start, end) ranges covering ranges."""
+  merged = []
+  for start, end in sorted(ranges):
+    if merged and start <= merged[-1][1]:
+      merged[-1][1] = max(merged[-1][1], end)
+    else:
+      merged.append([start, end])
+  return [tuple(r) for r in merged]
+
+def subtract_ranges(start, end, ranges):
+  """Return gaps of [start, end) not covered by ranges."""
+  gaps = []
+  for a, b in merge_ranges(ranges):
+    if b <= start or a >= end: continue
+    if a > start:
+      gaps.append((start, a))
+    start = max(start, b)
+  if start < end:
+    gaps.append((start, end))
+  return gaps
+
+def intersect_ranges(range_lists):
+  """Return ranges covered by every list of ranges in range_lists."""
+  if not range_lists:
+    return []
+  result = merge_ranges(range_lists[0])
+  for ranges in range_lists[1:]:
+    ranges = merge_ranges(ranges)
+    both, i, j = [], 0, 0
+    while i < len(result) and j < len(ranges):
+      (a, b), (c, d) = result[i], ranges[j]
+      if max(a, c) < min(b, d):
+        both.append((max(a, c), min(b, d)))
+      if b < d:
+        i += 1
+      else:
+        j += 1
+    result = both
+  return result
+
+def tiles_missing(tiles, missing, n_rows):
+  """Return list of bool of whether each tile (x0, x1, y0, y1) has pairs in missing ranges."""
+  missing = merge_ranges(missing)
+  ends = [b for a, b in missing]
+  result = []
+  for tile in tiles:
+    found = False
+    for start, end in tile_ranges(*tile, n_rows=n_rows):
+      i = bisect.bisect_right(ends, start)
+      if i < len(missing) and missing[i][0] < end:
+        found = True
+        break
+    result.append(found)
+  return result
+
+def tile_ranges(x0, x1, y0, y1, n_rows):
+  """Return condensed [start, end) ranges of the pairs (x, y), x < y, of a tile of rows
+  [x0, x1) versus rows [y0, y1); pairs of each row x are contiguous (see sym_idx)."""
+  ranges = []
+  for x in xrange(x0, x1):
+    y_start = max(y0, x+1)
+    if y_start < y1:
+      start = sym_idx(x, y_start, n_rows)
+      ranges.append((start, start + y1 - y_start))
+  return ranges
+
+def plan_chunks(gaps, k, merge=False):
+  """Divide gaps into jobs of at most k pairs.
+
+  With merge=True, small neighboring gaps are merged into one job if the merged span,
+  including any completed pairs between them, is at most k; those pairs are recomputed
+  and counted as duplicates by compile_pairwise.py. Large gaps are split into k sized jobs.
+  """
+  chunks = []
+  for start, end in gaps:
+    if merge and chunks and end - chunks[-1][0] <= k:
+      chunks[-1] = (chunks[-1][0], end)
+      continue
+    for s in xrange(start, end, k):
+      chunks.append((s, min(s+k, end)))
+  return chunks
+
+def verified(fname, shape=None):
+  """Return if .npy file fname loads with the expected shape (if given)."""
+  try:
+    Q = np.load(fname, mmap_mode='r')
+  except Exception:
+    return False
+  return shape is None or np.shape(Q) == shape
+
+def scan_work_dir(work_dir, batch_id, mnames):
+  """Find verified batch outputs in work_dir for batches named with batch_id.
+
+  Returns:
+    ({str: [(int, int)]}, {str: [(int, int, int, int)]}) of verified ranges and verified
+      tiles (x0, x1, y0, y1) per matrix name
+  """
+  ranges = dict([(name, []) for name in mnames])
+  tiles = dict([(name, []) for name in mnames])
+  n_bad = 0
+  for fname in os.listdir(work_dir):
+    m = RX_TILE.match(fname)
+    if m:
+      if m.group('id') != batch_id or m.group('matrix') not in tiles: continue
+      x0, x1, y0, y1 = [int(m.group(g)) for g in ('x0', 'x1', 'y0', 'y1')]
+      if verified(os.path.join(work_dir, fname), (x1-x0, y1-y0)):
+        tiles[m.group('matrix')].append((x0, x1, y0, y1))
+      else:
+        n_bad += 1
+      continue
+    m = RX.match(fname)
+    if m and m.group('id') == batch_id and m.group('matrix') in ranges:
+      start, end = int(m.group('start')), int(m.group('end'))
+      if verified(os.path.join(work_dir, fname), (end-start,)):
+        ranges[m.group('matrix')].append((start, end))
+      else:
+        n_bad += 1
+  if n_bad:
+    print "!!! %d output files in %s could not be verified; their pairs will be recomputed." % (n_bad, work_dir)
+  return ranges, tiles
+
+def build_manifest(work_dir, batch_id, mnames, num_pairs, start_offset=0):
+  """Scan work_dir for completed batches and save a manifest of completed and missing work.
+
+  Returns:
+    {str: obj} of manifest, also saved as json to MANIFEST_FNAME in work_dir
+  """
+  ranges, tiles = scan_work_dir(work_dir, batch_id, mnames)
+  if any(tiles.values()):
+    n_rows = n_rows_from_pairs(num_pairs)
+    for name in mnames:
+      for tile in tiles[name]:
+        ranges[name] += tile_ranges(*tile, n_rows=n_rows)
+  completed = intersect_ranges([ranges[name] for name in mnames])
+  completed_tiles = set(tiles[mnames[0]])
+  for name in mnames[1:]:
+    completed_tiles &= set(tiles[name])
+  manifest = {
+    'batch_id': batch_id,
+    'num_pairs': num_pairs,
+    'measures': dict([(name, merge_ranges(ranges[name])) for name in mnames]),
+    'completed': completed,
+    'completed_tiles': sorted(completed_tiles),
+    'missing': subtract_ranges(start_offset, num_pairs, completed),
+    'time': tstamp(),
+  }
+  fname = os.path.join(work_dir, MANIFEST_FNAME)
+  json.dump(manifest, open(fname, 'w'), indent=1)
+  n_done = sum([b-a for a, b in completed])
+  print "Manifest %s: %d of %d pairs complete in %d ranges, %d tiles complete, %d gaps missing." % \
+    (fname, n_done, num_pairs, len(completed), len(completed_tiles), len(manifest['missing']))
+  return manifest
+
+
+if __name__ == "__main__":
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  kwds = {'n_perm': int(args['n_perm'])} if 'n_perm' in args else {}
+  build_manifest(args['work_dir'], args['batch_id'], batch_mnames(args['function'], **kwds)[args['function']],
+                 int(args['num_pairs']), int(args.get('start_offset', 0)))
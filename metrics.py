@@ -0,0 +1,181 @@
+#!/usr/bin/python
+"""Per-stage timing of batch jobs and aggregation of their metrics files.
+
+A StageTimer accumulates wall and CPU seconds per named stage (load, mask, compute,
+save) and reports progress with pairs/sec and an ETA. Stage mask is the extraction of
+pairs' shared samples (see Pair), or the preparation of rows in block mode. Batches run
+with timing=True save it as json to [batchname].metrics.json next to their outputs,
+with number of pairs, pairs/sec, and peak resident memory. aggregate summarizes the metrics
+files of a run; compile_pairwise.py saves it as [outpath_prefix].metrics.json.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/metrics.py path=/fs/lustre/osu6683/gse7307/dcor
+"""
+from batch import Pair
+from contextlib import contextmanager
+import json
+import os, sys
+import resource
+import socket
+import time
+import numpy as np
+
+METRICS_EXT = ".metrics.json"
+
+def peak_rss_mb():
+  """Return float of peak resident memory of this process in MB."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def format_seconds(s):
+  s = int(round(s))
+  return "%d:%02d:%02d" % (s // 3600, s // 60 % 60, s % 60)
+
+
+class StageTimer(object):
+  """Wall and CPU seconds per stage, in order of first use."""
+  def __init__(self):
+    self.wall, self.cpu, self.order = {}, {}, []
+    self.t0 = time.time()
+
+  def add(self, name, wall, cpu):
+    if name not in self.wall:
+      self.order.append(name)
+      self.wall[name], self.cpu[name] = 0.0, 0.0
+    self.wall[name] += wall
+    self.cpu[name] += cpu
+
+  @contextmanager
+  def stage(self, name):
+    """Time the enclosed block as stage name."""
+    w, c = time.time(), time.clock()
+    try:
+      yield
+    finally:
+      self.add(name, time.time() - w, time.clock() - c)
+
+  def progress(self, done, total, stage='compute'):
+    """Return str of pairs/sec and ETA after done of total pairs computed in stage."""
+    wall = self.wall.get(stage, 0.0)
+    if not done or not wall:
+      return "ETA unknown"
+    rate = done / wall
+    return "%.1f pairs/sec, ETA %s" % (rate, format_seconds((total - done) / rate))
+
+  def summary(self, n_pairs, **extra):
+    """Return {str: obj} of stage times, pairs/sec of computation, and peak memory."""
+    compute = self.wall.get('compute', 0.0)
+    d = {
+      'host': socket.gethostname(),
+      'n_pairs': n_pairs,
+      'wall': sum(self.wall.values()),
+      'elapsed': time.time() - self.t0,
+      'stages': dict([(name, {'wall': self.wall[name], 'cpu': self.cpu[name]}) for name in self.order]),
+      'pairs_per_sec': n_pairs / compute if compute else None,
+      'peak_rss_mb': peak_rss_mb(),
+      }
+    d.update(extra)
+    return d
+
+  def report(self):
+    """Return list of str of stage times to log."""
+    lines = []
+    for name in self.order:
+      lines.append("%s: %.2fs wall, %.2fs cpu" % (name, self.wall[name], self.cpu[name]))
+    lines.append("peak memory: %.1f MB" % peak_rss_mb())
+    return lines
+
+  def save(self, fname, n_pairs, **extra):
+    """Save summary as json to fname. Return fname."""
+    json.dump(self.summary(n_pairs, **extra), open(fname, 'w'), indent=1)
+    print "Saved metrics to %s." % fname
+    return fname
+
+
+@contextmanager
+def no_stage():
+  yield
+
+def stage(timer, name):
+  """Return context to time stage name with timer, or to do nothing if timer is None."""
+  if timer is None:
+    return no_stage()
+  return timer.stage(name)
+
+def compute_pair(F, u, v, i, u_key=None, v_key=None, timer=None):
+  """Batch.compute_pair of F, timing the shared samples as stage mask and the rest as
+  stage compute of timer (if not None)."""
+  if timer is None:
+    F.compute_pair(u, v, i, u_key, v_key)
+    return
+  w, c = time.time(), time.clock()
+  pair = Pair(u, v, u_key, v_key)
+  w2, c2 = time.time(), time.clock()
+  F.compute_shared(pair, i)
+  timer.add('mask', w2 - w, c2 - c)
+  timer.add('compute', time.time() - w2, time.clock() - c2)
+
+def find_metrics(path):
+  """Return sorted list of str of metrics file names in path."""
+  return sorted([os.path.join(path, fname) for fname in os.listdir(path) if fname.endswith(METRICS_EXT)])
+
+def aggregate(fnames):
+  """Return {str: obj} of totals and per-batch throughput of batch metrics files."""
+  batches = []
+  for fname in fnames:
+    try:
+      batches.append(json.load(open(fname)))
+    except (IOError, ValueError):
+      print "!!! Could not read metrics file %s." % fname
+  stages = {}
+  for b in batches:
+    for name, t in b['stages'].items():
+      s = stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+      s['wall'] += t['wall']; s['cpu'] += t['cpu']
+  rates = np.array([b['pairs_per_sec'] for b in batches if b.get('pairs_per_sec')])
+  n_pairs = sum([b['n_pairs'] for b in batches])
+  compute = stages.get('compute', {}).get('wall', 0.0)
+  d = {
+    'n_batches': len(batches),
+    'n_pairs': n_pairs,
+    'stages': stages,
+    'pairs_per_sec': n_pairs / compute if compute else None,
+    'batch_pairs_per_sec': dict(zip(('min', 'median', 'max'),
+      [float(np.min(rates)), float(np.median(rates)), float(np.max(rates))])) if np.size(rates) else None,
+    'batch_wall': dict(zip(('min', 'median', 'max'),
+      [float(f(np.array([b['wall'] for b in batches]))) for f in (np.min, np.median, np.max)])) if batches else None,
+    'peak_rss_mb': max([b['peak_rss_mb'] for b in batches]) if batches else None,
+    'hosts': sorted(set([b.get('host') for b in batches])),
+    }
+  return d
+
+def report_lines(d):
+  """Return list of str of an aggregate metrics summary."""
+  lines = ["%d batches, %d pairs." % (d['n_batches'], d['n_pairs'])]
+  for name, t in sorted(d['stages'].items()):
+    lines.append("%s: %.1fs wall, %.1fs cpu total" % (name, t['wall'], t['cpu']))
+  if d['pairs_per_sec']:
+    lines.append("%.1f pairs/sec per process overall." % d['pairs_per_sec'])
+  if d['batch_pairs_per_sec']:
+    lines.append("Batch pairs/sec: min %(min).1f, median %(median).1f, max %(max).1f." % d['batch_pairs_per_sec'])
+  if d['peak_rss_mb']:
+    lines.append("Peak memory of a batch: %.1f MB." % d['peak_rss_mb'])
+  return lines
+
+def save_aggregate(path, out_fname):
+  """Aggregate metrics files in path to out_fname if there are any. Return summary or None."""
+  fnames = find_metrics(path)
+  if not fnames:
+    return None
+  d = aggregate(fnames)
+  json.dump(d, open(out_fname, 'w'), indent=1)
+  print "Throughput of %d batch metrics files in %s:" % (len(fnames), path)
+  for line in report_lines(d):
+    print line
+  print "Saved %s." % out_fname
+  return d
+
+
+if __name__ == "__main__":
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  for line in report_lines(aggregate(find_metrics(args['path']))):
+    print line
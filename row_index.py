@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""Row-major square index of a compiled condensed matrix for fast row queries.
+
+Row i of a condensed (n choose 2) vector is spread over n-1 places in the vector
+(see sym_idx). build_square saves the symmetric (n_rows x n_rows) matrix as a
+row-major [prefix].[matrix].square.npy, nan on the diagonal and where not set, so
+that all values of a row are one contiguous read of the memory-mapped file. Values
+are float32, or float16 as in compact storage of a matrix saved as float16 (see
+compact.value_dtype).
+
+The square matrix is written a block of rows at a time: the upper triangle part of
+each row is contiguous in the condensed vector, and the lower part is read back from
+the rows of the square matrix already written.
+
+RowIndex answers row(i), pair(i, j), and top_k(i, K) from the memory-mapped file.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/row_index.py values=$HOME/gse15745/gse15745_gpl6104_dcor.DCOR.values.npy n_rows=22184
+"""
+from py_symmetric_matrix import sym_idx
+from numpy.lib.format import open_memmap
+import compact
+import os, sys
+import numpy as np
+
+SQUARE_EXT = ".square.npy"
+BLOCK_ROWS = 1024
+
+def square_fname(values_fname):
+  """Return .square.npy file name of a compiled .values.npy or .chunks file name."""
+  for ext in (".values.npy", compact.CHUNKS_EXT):
+    if values_fname.endswith(ext):
+      values_fname = values_fname[:-len(ext)]
+  return values_fname + SQUARE_EXT
+
+def open_condensed(fname, isset_fname=None):
+  """Return (condensed vector, isset vector or None) of a .values.npy or .chunks file."""
+  if fname.endswith(compact.CHUNKS_EXT) or fname.endswith(compact.CHUNKS_EXT + ".json"):
+    return compact.CompactMatrix(fname), None
+  if isset_fname is None and fname.endswith(".values.npy"):
+    isset_fname = fname[:-len(".values.npy")] + ".isset.npy"
+  B = None
+  if isset_fname and os.path.exists(isset_fname):
+    B = np.load(isset_fname, mmap_mode='r')
+  return np.load(fname, mmap_mode='r'), B
+
+def build_square(M, n_rows, out_fname, B=None, block_rows=BLOCK_ROWS, dtype=np.float32):
+  """Save condensed vector M (and isset vector B) as a row-major square .npy matrix.
+
+  Args:
+    M: condensed vector of n_rows choose 2 values supporting slices, e.g., a memory-mapped
+      .npy or a compact.CompactMatrix
+    dtype: numpy dtype of the square matrix; compact.value_dtype of M's compact encoding
+  Returns:
+    str of out_fname
+  """
+  n_rows, block_rows = int(n_rows), int(block_rows)
+  assert len(M) == n_rows*(n_rows-1)//2, "%d values are not %d rows choose 2." % (len(M), n_rows)
+  S = open_memmap(out_fname, mode='w+', dtype=dtype, shape=(n_rows, n_rows))
+  for r0 in xrange(0, n_rows, block_rows):
+    r1 = min(r0 + block_rows, n_rows)
+    print "Writing rows %d through %d of %d to %s..." % (r0, r1-1, n_rows, out_fname)
+    U = np.empty((r1-r0, n_rows), dtype=dtype)
+    U[:,:r0] = S[:r0,r0:r1].T
+    for x in xrange(r0, r1):
+      U[x-r0, x] = np.nan
+      if x+1 == n_rows: continue
+      a = sym_idx(x, x+1, n_rows)
+      Q = np.array(M[a:a+n_rows-1-x], dtype=np.float)
+      if B is not None:
+        Q[~B[a:a+n_rows-1-x]] = np.nan
+      U[x-r0, x+1:] = Q
+      # Rows of this block below x mirror its upper triangle.
+      U[x+1-r0:, x] = Q[:r1-x-1]
+    S[r0:r1] = U
+  S.flush()
+  del S
+  print "Saved (%d x %d) square row index %s." % (n_rows, n_rows, out_fname)
+  return out_fname
+
+
+class RowIndex(object):
+  """Row queries of a square .npy matrix saved by build_square, memory-mapped."""
+  def __init__(self, fname):
+    self.fname = fname
+    self.S = np.load(fname, mmap_mode='r')
+    self.n = np.size(self.S, 0)
+
+  def row(self, i):
+    """Return float np.array of the values of row i with all rows; nan at i."""
+    return np.array(self.S[i], dtype=np.float)
+
+  def pair(self, i, j):
+    """Return float of the value of rows i and j."""
+    return float(self.S[i,j])
+
+  def top_k(self, i, k, absolute=False):
+    """Return (np.array, np.array) of the rows with the k largest values with row i,
+    largest first, and their values. Rank by absolute value if absolute."""
+    Q = self.row(i)
+    idx = np.nonzero(~np.isnan(Q))[0]
+    score = np.abs(Q[idx]) if absolute else Q[idx]
+    k = min(int(k), np.size(idx))
+    top = np.argpartition(-score, k-1)[:k] if k > 0 else np.array([], dtype=np.int64)
+    top = top[np.argsort(-score[top], kind='mergesort')]
+    return idx[top], Q[idx[top]]
+
+
+if __name__ == "__main__":
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  M, B = open_condensed(args['values'], args.get('isset'))
+  encoding = M.encoding if isinstance(M, compact.CompactMatrix) else args.get('encoding', 'float32')
+  build_square(M, args['n_rows'], args.get('out_fname', square_fname(args['values'])), B, dtype=compact.value_dtype(encoding))
@@ -2,16 +2,27 @@
 """Compile using:
 
 python setup_cython.py build_ext --inplace
+
+dcor_cpy is compiled with OpenMP so that its loops can run on several threads (see
+dcor_cpy.set_num_threads). Set environment variable NO_OPENMP=1 to compile without it,
+e.g., for compilers which do not support -fopenmp.
 """
 from distutils.core import setup
 from distutils.extension import Extension
 from Cython.Distutils import build_ext
 
 import numpy
+import os
+
+if os.environ.get('NO_OPENMP'):
+  openmp_args = []
+else:
+  openmp_args = ['-fopenmp']
 
 ext = Extension("dcor_cpy", ["dcor_cpy.pyx"],
-    include_dirs = [numpy.get_include()])
+    include_dirs = [numpy.get_include()],
+    extra_compile_args = openmp_args,
+    extra_link_args = openmp_args)
                 
 setup(ext_modules=[ext],
       cmdclass = {'build_ext': build_ext})
-
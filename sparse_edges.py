@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""Sparse records of the strongest pairs, saved by batches in place of dense results.
+
+keep=topk:K keeps, for each row, the K pairs of the row with the largest scores.
+keep=abs_gt:T keeps pairs with a score greater than T.
+
+The score of a pair is the first matrix of its Batch (MNAMES[0]), in absolute value
+if the Batch has negative values (HAS_NEG), e.g., |PEARSON| or DCOR. Pairs with a nan
+score are never kept.
+
+Batches save record arrays with fields x, y, score, and each matrix in MNAMES to
+[batchname].sparse.npy. In pairwise batches x < y are rows of the same matrix and a
+pair counts toward the top K of both of its rows (symmetric); in dual batches x is a
+row of the first matrix, y of the second, and only rows x are ranked. Selecting the top
+K of each row in every batch keeps every pair in the top K of a row overall, so
+compile_sparse can merge batches with bounded memory.
+
+compile_sparse saves rows' pairs in compressed sparse row (CSR) form to an .npz:
+indptr (n_rows+1), indices (column of each pair), score, and each matrix, so that row
+r's pairs are at [indptr[r], indptr[r+1]) ordered by decreasing score.
+"""
+import os
+import numpy as np
+
+SPARSE_EXT = ".sparse.npy"
+# Number of records buffered by compile_sparse before selecting.
+MERGE_BUFFER = 2**22
+
+def parse_keep(keep):
+  """Return (str, number) of mode and parameter of keep str 'topk:K' or 'abs_gt:T'."""
+  mode, c, value = str(keep).partition(':')
+  if mode == 'topk':
+    value = int(value)
+    assert value > 0, keep
+  elif mode == 'abs_gt':
+    value = float(value)
+  else:
+    raise Exception, "Unknown keep mode %s; use topk:K or abs_gt:T." % keep
+  return mode, value
+
+def record_dtype(mnames):
+  return np.dtype([('x', np.int64), ('y', np.int64), ('score', np.float)] + \
+    [(name, np.float) for name in mnames])
+
+def make_records(x, y, Matrices, mnames, has_neg=False):
+  """Return record array of pairs (x, y) of flat result matrices keyed by mnames."""
+  R = np.empty(np.size(x), dtype=record_dtype(mnames))
+  R['x'], R['y'] = x, y
+  for name in mnames:
+    R[name] = np.ravel(Matrices[name])
+  R['score'] = R[mnames[0]]
+  if has_neg:
+    R['score'] = np.abs(R['score'])
+  return R
+
+def top_per_row(rows, score, k):
+  """Return bool array of entries among the k largest scores of their row."""
+  order = np.lexsort((-score, rows))
+  r = rows[order]
+  starts = np.concatenate(([0], np.nonzero(r[1:] != r[:-1])[0] + 1))
+  rank = np.arange(np.size(r)) - np.repeat(starts, np.diff(np.concatenate((starts, [np.size(r)]))))
+  keep = np.zeros(np.size(r), dtype=np.bool)
+  keep[order] = rank < k
+  return keep
+
+def select(R, keep, symmetric=True):
+  """Return records of R selected by keep (see parse_keep)."""
+  mode, value = parse_keep(keep)
+  R = R[~np.isnan(R['score'])]
+  if mode == 'abs_gt':
+    return R[R['score'] > value]
+  chosen = top_per_row(R['x'], R['score'], value)
+  if symmetric:
+    chosen |= top_per_row(R['y'], R['score'], value)
+  return R[chosen]
+
+def save_sparse(F, work_dir, batchname, x, y, keep, symmetric=True):
+  """Save records of pairs (x, y) of Batch F selected by keep. Return file name."""
+  R = select(make_records(x, y, F.Matrices, F.MNAMES, getattr(F, 'HAS_NEG', False)), keep, symmetric)
+  fname = os.path.join(work_dir, batchname + SPARSE_EXT)
+  np.save(fname, R)
+  print "Kept %d of %d pairs (%s) in %s." % (np.size(R), np.size(x), keep, fname)
+  return fname
+
+def unique_pairs(R):
+  """Return records of R with one record per pair (x, y)."""
+  if np.size(R) == 0:
+    return R
+  order = np.lexsort((R['y'], R['x']))
+  R = R[order]
+  first = np.concatenate(([True], (R['x'][1:] != R['x'][:-1]) | (R['y'][1:] != R['y'][:-1])))
+  return R[first]
+
+def compile_sparse(fnames, out_fname, n_rows, keep=None, symmetric=True):
+  """Merge sparse batch record files into a CSR .npz file.
+
+  Records are buffered and reduced by keep (if given) every MERGE_BUFFER records.
+  With keep=topk:K, each row keeps its K pairs with the largest scores.
+  Returns:
+    int of number of pairs saved
+  """
+  buf, n_buf, R = [], 0, None
+  for fname in fnames:
+    Q = np.load(fname)
+    print "Loaded %d records from %s." % (np.size(Q), fname)
+    buf.append(Q); n_buf += np.size(Q)
+    if n_buf > MERGE_BUFFER:
+      R = unique_pairs(np.concatenate(buf))
+      if keep is not None:
+        R = select(R, keep, symmetric)
+      buf, n_buf = [R], np.size(R)
+  assert buf, "No sparse records to compile."
+  R = unique_pairs(np.concatenate(buf))
+  if keep is not None:
+    R = select(R, keep, symmetric)
+  n_pairs = np.size(R)
+
+  # Rows of CSR: each pair is listed under x and, if symmetric, also under y.
+  rows, cols = R['x'], R['y']
+  if symmetric:
+    rows, cols = np.concatenate((R['x'], R['y'])), np.concatenate((R['y'], R['x']))
+    R = np.concatenate((R, R))
+  chosen = np.ones(np.size(rows), dtype=np.bool)
+  if keep is not None and parse_keep(keep)[0] == 'topk':
+    chosen = top_per_row(rows, R['score'], parse_keep(keep)[1])
+  rows, cols, R = rows[chosen], cols[chosen], R[chosen]
+  order = np.lexsort((-R['score'], rows))
+  rows, cols, R = rows[order], cols[order], R[order]
+  assert np.size(rows) == 0 or rows[-1] < n_rows, "Row %d out of range." % rows[-1]
+  arrays = {
+    'indptr': np.searchsorted(rows, np.arange(n_rows+1)),
+    'indices': cols,
+    }
+  for name in R.dtype.names[2:]:
+    arrays[name] = R[name]
+  np.savez(out_fname, **arrays)
+  print "Saved %d pairs as %d row entries of %d rows to %s." % (n_pairs, np.size(rows), n_rows, out_fname)
+  return n_pairs
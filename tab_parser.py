@@ -0,0 +1,171 @@
+#!/usr/bin/python
+"""Streaming parser of labeled .tab matrices into a data and mask .npy file pair.
+
+Used by util.npy_varlist_from_tabfile in place of np.genfromtxt, which holds every
+line and the whole masked matrix in memory. The file is split at line boundaries into
+blocks of about BLOCK_BYTES. A first pass counts the rows of each block; the data and
+mask .npy files are then allocated on disk and each block is parsed and written into
+its own rows. With n_workers > 1, blocks are counted and parsed in parallel by a
+process pool. Row names are appended to the varlist file in file order.
+
+As with genfromtxt(name_iter(...), usemask=True): lines starting with '#' and empty
+lines are skipped, the first column is the row name, and empty fields and fields in
+missing_values are masked. Masked values are saved in the float64 data matrix as
+genfromtxt saves them: the float of the token if it parses (e.g., 'nan'), else np.nan.
+The data, mask, and fill value of the loaded .npy pair (see util.load_masked) are
+bit-identical to those of the genfromtxt masked matrix pickled by earlier versions.
+
+SAMPLE USE:
+  python $HOME/dependency_matrix_dispatcher/tab_parser.py tabfile=/nfs/01/osu6683/gse7307/GSE7307.tab outdir=/fs/lustre/osu6683/gse7307 n_workers=12
+"""
+import itertools
+import multiprocessing
+import os
+import sys
+import numpy as np
+from numpy.lib.format import open_memmap
+
+BLOCK_BYTES = 2**25
+
+def block_offsets(fname, block_bytes=BLOCK_BYTES):
+  """Return [(int, int)] of byte ranges of about block_bytes that end at line ends."""
+  size = os.path.getsize(fname)
+  fp = open(fname, 'rb')
+  offsets = [0]
+  while offsets[-1] < size:
+    fp.seek(min(offsets[-1] + block_bytes, size) - 1)
+    fp.readline()
+    offsets.append(min(fp.tell(), size))
+  fp.close()
+  return zip(offsets[:-1], offsets[1:])
+
+def read_lines(fname, start, end):
+  """Return list of str of data lines, without line ends, in byte range [start, end)."""
+  fp = open(fname, 'rb')
+  fp.seek(start)
+  text = fp.read(end - start)
+  fp.close()
+  return [line for line in text.replace('\r', '').split('\n') if line and line[0] != '#']
+
+def is_float(token):
+  """Return bool of whether str token parses as a float."""
+  try:
+    float(token)
+  except ValueError:
+    return False
+  return True
+
+def parse_lines(lines, n_cols, missing):
+  """Parse data lines into row names and data and mask matrices.
+
+  Args:
+    lines: [str] of tab delimited lines, each a row name and n_cols values
+    n_cols: int of number of values per line
+    missing: [str] of tokens of missing values
+  Returns:
+    ([str], np.array, np.array) of row names, (len(lines) x n_cols) float data matrix
+      with nan where missing, and bool mask matrix
+  """
+  if not lines:
+    return [], np.empty((0, n_cols)), np.empty((0, n_cols), dtype=np.bool)
+  names, rows = [], []
+  for line in lines:
+    name, c, row = line.partition('\t')
+    names.append(name)
+    rows.append(row)
+  tokens = np.array('\t'.join(rows).split('\t'))
+  if np.size(tokens) != len(lines) * n_cols:
+    for name, row in zip(names, rows):
+      assert row.count('\t') + 1 == n_cols, \
+        "Row %s has %d values, expected %d." % (name, row.count('\t') + 1, n_cols)
+  mask = np.in1d(tokens, missing + [''])
+  # As genfromtxt, missing tokens which parse as floats (e.g., 'nan', whose float may
+  # have the sign bit set) keep their value; others are filled with np.nan.
+  fill = np.in1d(tokens, [token for token in missing if not is_float(token)] + [''])
+  tokens[fill] = '0'
+  try:
+    data = tokens.astype(np.float)
+  except ValueError, e:
+    raise ValueError, "Cannot parse values in rows %s through %s: %s" % (names[0], names[-1], e)
+  data[fill] = np.nan
+  return names, data.reshape(len(lines), n_cols), mask.reshape(len(lines), n_cols)
+
+def count_block(job):
+  fname, start, end = job
+  return len(read_lines(fname, start, end))
+
+def parse_block(job):
+  """Parse a block into its rows of the data and mask .npy files. Return row names."""
+  fname, start, end, row, n_cols, missing, data_fname, mask_fname = job
+  names, data, mask = parse_lines(read_lines(fname, start, end), n_cols, missing)
+  if names:
+    for npy_fname, values in ((data_fname, data), (mask_fname, mask)):
+      M = open_memmap(npy_fname, mode='r+')
+      M[row:row+len(names)] = values
+      M.flush()
+      del M
+  return names
+
+def parse_tabfile(tabfile, data_fname, mask_fname, varlist_fname, missing_values, n_workers=1, block_bytes=BLOCK_BYTES):
+  """Parse .tab file to data and mask .npy files and a varlist of row names.
+
+  Args:
+    missing_values: str of comma separated tokens of missing values (see MISSING_VALUES)
+    n_workers: int of processes to parse blocks in parallel
+  Returns:
+    (int, int) of number of rows and columns
+  """
+  n_workers, block_bytes = int(n_workers), int(block_bytes)
+  assert n_workers > 0 and block_bytes > 0
+  missing = missing_values.split(',')
+  blocks = block_offsets(tabfile, block_bytes)
+  # Number of columns from the first data line.
+  n_cols = 0
+  for start, end in blocks:
+    lines = read_lines(tabfile, start, end)
+    if lines:
+      n_cols = lines[0].count('\t')
+      break
+  assert n_cols > 0, "No data in %s." % tabfile
+
+  if n_workers > 1:
+    pool = multiprocessing.Pool(n_workers)
+    imap = pool.imap
+  else:
+    pool, imap = None, itertools.imap
+  try:
+    counts = list(imap(count_block, [(tabfile, start, end) for start, end in blocks]))
+    n_rows = sum(counts)
+    print "Parsing %d rows, %d columns of %s in %d blocks with %d workers..." % \
+      (n_rows, n_cols, tabfile, len(blocks), n_workers)
+    open_memmap(data_fname, mode='w+', dtype=np.float, shape=(n_rows, n_cols)).flush()
+    open_memmap(mask_fname, mode='w+', dtype=np.bool, shape=(n_rows, n_cols)).flush()
+    jobs, row = [], 0
+    for (start, end), count in zip(blocks, counts):
+      jobs.append((tabfile, start, end, row, n_cols, missing, data_fname, mask_fname))
+      row += count
+    fp = open(varlist_fname, 'w')
+    n_done = 0
+    for names in imap(parse_block, jobs):
+      if names:
+        if n_done:
+          fp.write('\n')
+        fp.write('\n'.join(names))
+      n_done += len(names)
+    fp.close()
+    assert n_done == n_rows
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+  print "Saved data %s, mask %s, and varlist %s." % (data_fname, mask_fname, varlist_fname)
+  return n_rows, n_cols
+
+
+if __name__ == "__main__":
+  from util import MISSING_VALUES, npy_pair_fnames
+  args = dict([s.split('=') for s in sys.argv[1:]])
+  tabfile, outdir = args['tabfile'], args['outdir']
+  data_fname, mask_fname = npy_pair_fnames(os.path.join(outdir, "%s.pkl" % tabfile))
+  varlist_fname = os.path.join(outdir, os.path.basename(tabfile) + ".varlist.txt")
+  parse_tabfile(tabfile, data_fname, mask_fname, varlist_fname, MISSING_VALUES, args.get('n_workers', 1))
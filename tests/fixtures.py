@@ -0,0 +1,92 @@
+"""Data and assertions shared by the tests.
+
+Run the tests from a directory without a dcor_cpy build for another Python:
+  python -m unittest discover -s tests
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+import numpy as np
+import numpy.ma as ma
+from batch import Pair
+
+
+def degenerate_matrix(n_rows=8, n_samples=30, seed=0):
+  """Return masked matrix of random rows with missing values, a constant row (0), an
+  all masked row (1), and a row with two unmasked values (2)."""
+  rng = np.random.RandomState(seed)
+  D = rng.randn(n_rows, n_samples)
+  D[3:] += D[3] * rng.rand(n_rows-3, 1)
+  mask = rng.rand(n_rows, n_samples) < 0.1
+  D[0], mask[0] = 3.0, False
+  mask[1] = True
+  mask[2], mask[2,:2] = True, False
+  return ma.array(D, mask=mask)
+
+def reference(cls, u, v):
+  """Return {str: float} of cls.compute on the shared samples of rows u and v; nan
+  where the reference raises, e.g., mstats.spearmanr of fewer than 3 samples or dcor
+  of none."""
+  pair = Pair(u, v)
+  F = cls(1)
+  try:
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      F.compute(pair.X, pair.Y, 0)
+  except (ValueError, ZeroDivisionError):
+    return dict([(name, np.nan) for name in F.MNAMES])
+  return F.get(0)
+
+def compared(cls, u, v):
+  """Return names of matrices of cls to compare for rows u and v. With two shared samples
+  the correlation is +-1 up to rounding and the mstats p-value is 0 or nan by rounding."""
+  if np.size(Pair(u, v).X) == 2:
+    return cls.MNAMES[:1]
+  return cls.MNAMES
+
+def assert_same(test, expected, actual, msg, rtol=1e-10, names=None):
+  """Assert that {str: float} actual equals expected to rtol for names, nan where expected is nan."""
+  for name in names or expected:
+    e, a = float(expected[name]), float(actual[name])
+    if np.isnan(e):
+      test.assertTrue(np.isnan(a), "%s %s: expected nan, got %r" % (msg, name, a))
+    else:
+      test.assertTrue(abs(e - a) <= rtol * max(abs(e), 1e-12) + 1e-14, "%s %s: expected %r, got %r" % (msg, name, e, a))
+
+def all_pairs(M):
+  """Return list of (x, y), x < y, of the rows of M in condensed order."""
+  n = np.size(M, 0)
+  return [(x, y) for x in xrange(n) for y in xrange(x+1, n)]
+
+
+class WorkDirTest(unittest.TestCase):
+  """Test case with a temporary work_dir, removed after each test."""
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+
+class CompiledTest(WorkDirTest):
+  """Test case with a random compiled condensed vector Q of n_rows rows, unset where not isset."""
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    self.n_rows = 30
+    n = self.n_rows*(self.n_rows-1)//2
+    rng = np.random.RandomState(0)
+    self.Q = rng.uniform(-1, 1, n).astype(np.float32)
+    self.isset = rng.rand(n) > 0.1
+    self.expected = np.where(self.isset, self.Q, np.nan)
+
+  def save(self, name, Q, isset=None):
+    """Save Q and isset as compile_pairwise.py does. Return (str, str) of file names."""
+    values_fname = os.path.join(self.work_dir, "m.%s.values.npy" % name)
+    np.save(values_fname, Q)
+    isset_fname = None
+    if isset is not None:
+      isset_fname = os.path.join(self.work_dir, "m.%s.isset.npy" % name)
+      np.save(isset_fname, isset)
+    return values_fname, isset_fname
@@ -0,0 +1,71 @@
+"""Tests of cached column alignment of two .tab matrices."""
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import align
+from fixtures import WorkDirTest
+from util import load_masked
+
+
+class AlignTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    self.titles = {1: ['s%d' % j for j in (0, 1, 2, 3, 4, 5)], 2: ['s%d' % j for j in (7, 4, 0, 2, 5)]}
+    self.D = {1: rng.randn(5, 6), 2: rng.randn(3, 5)}
+    self.D[1][1,2] = np.nan
+    self.fnames = {}
+    for i in (1, 2):
+      tabfile = os.path.join(self.work_dir, "m%d.tab" % i)
+      self.write_tab(tabfile, self.D[i])
+      coltitles = os.path.join(self.work_dir, "m%d.titles.txt" % i)
+      open(coltitles, 'w').write(",".join(self.titles[i]) + "\n")
+      self.fnames[i] = (tabfile, coltitles)
+
+  def write_tab(self, tabfile, D):
+    lines = ["r%d\t%s\n" % (r, "\t".join(["%r" % v for v in row])) for r, row in enumerate(D)]
+    open(tabfile, 'w').write("".join(lines))
+
+  def align(self, **kwds):
+    return align.align(self.fnames[1][0], self.fnames[2][0], self.fnames[1][1], self.fnames[2][1],
+      self.work_dir, self.work_dir, **kwds)
+
+  def test_shared_columns(self):
+    m1, m2 = align.shared_columns(self.titles[1], self.titles[2])
+    self.assertEqual(list(m1), [0, 2, 4, 5])
+    self.assertEqual(list(m2), [2, 3, 1, 4])
+
+  def test_align(self):
+    record = self.align()
+    # Matrix 1 has more rows, so the matrices are swapped.
+    self.assertTrue(record['swapped'])
+    self.assertEqual((record['n1'], record['n2'], record['m']), (3, 5, 4))
+    M1, M2 = load_masked(record['npyfile_1']), load_masked(record['npyfile_2'])
+    cols_2, cols_1 = align.shared_columns(self.titles[2], self.titles[1])
+    for M, D, cols in ((M1, self.D[2], cols_2), (M2, self.D[1], cols_1)):
+      np.testing.assert_array_equal(ma.getmaskarray(M), np.isnan(D[:,cols]))
+      np.testing.assert_array_equal(M.filled(0), np.nan_to_num(D[:,cols]))
+    self.assertEqual(open(record['coltitles']).read().strip().split(','), [self.titles[2][j] for j in cols_2])
+
+  def test_cached(self):
+    record = self.align()
+    self.assertEqual(self.align(), record)
+    # Changed inputs or aligned files are aligned again.
+    self.D[2][0,1] = 9.0
+    self.write_tab(self.fnames[2][0], self.D[2])
+    changed = self.align()
+    self.assertNotEqual(changed['key'], record['key'])
+    self.assertEqual(load_masked(changed['npyfile_1'])[0,0], 9.0)
+    np.save(changed['npyfile_2'], np.zeros((2, 2)))
+    self.assertEqual(align.cached(os.path.join(self.work_dir, "m1.tab_vs_m2.tab" + align.ALIGN_EXT), changed['key']), None)
+
+  def test_without_titles(self):
+    self.write_tab(self.fnames[2][0], self.D[2][:,:5].repeat(2, axis=1)[:,:6])
+    record = align.align(self.fnames[1][0], self.fnames[2][0], outdir=self.work_dir, work_dir=self.work_dir)
+    self.assertEqual((record['n1'], record['n2'], record['m']), (3, 5, 6))
+    self.assertEqual(record['coltitles'], None)
+
+
+if __name__ == "__main__":
+  unittest.main()
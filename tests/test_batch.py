@@ -0,0 +1,91 @@
+"""Tests of Batch functions against their reference (mstats) computations."""
+import unittest
+import warnings
+import numpy as np
+import numpy.ma as ma
+from batch import Pair, PCCBatch, SpearmanBatch, KendallBatch
+from fixtures import degenerate_matrix, reference, assert_same, compared, all_pairs
+
+
+class DegenerateRowsTest(unittest.TestCase):
+  """Constant and all masked rows give the same results as mstats in every path."""
+  def setUp(self):
+    self.M = degenerate_matrix()
+
+  def check_pair(self, cls):
+    F = cls(1)
+    for x, y in all_pairs(self.M):
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        F.compute_pair(self.M[x], self.M[y], 0, x, y)
+      assert_same(self, reference(cls, self.M[x], self.M[y]), F.get(0), "%s pair (%d, %d)" % (cls.__name__, x, y),
+        names=compared(cls, self.M[x], self.M[y]))
+
+  def check_block(self, cls):
+    F = cls(1)
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      P = F.prepare_rows(self.M)
+      R = F.compute_block(P, P)
+    for x, y in all_pairs(self.M):
+      assert_same(self, reference(cls, self.M[x], self.M[y]), dict([(name, R[name][x,y]) for name in F.MNAMES]),
+        "%s block (%d, %d)" % (cls.__name__, x, y), rtol=1e-8, names=compared(cls, self.M[x], self.M[y]))
+
+  def test_pearson_pair(self):
+    self.check_pair(PCCBatch)
+
+  def test_pearson_block(self):
+    self.check_block(PCCBatch)
+
+  def test_spearman_pair(self):
+    self.check_pair(SpearmanBatch)
+
+  def test_spearman_block(self):
+    self.check_block(SpearmanBatch)
+
+  def test_kendall_pair(self):
+    self.check_pair(KendallBatch)
+
+  def test_constant_row(self):
+    F = PCCBatch(1)
+    F.compute_pair(self.M[0], self.M[4], 0)
+    self.assertTrue(np.isnan(F.get(0)["PEARSON"]))
+    self.assertEqual(F.get(0)["PEARSON_PV"], 1.0)
+    F = SpearmanBatch(1)
+    F.compute_pair(self.M[0], self.M[4], 0)
+    self.assertEqual((F.get(0)["SPEARMAN"], F.get(0)["SPEARMAN_PV"]), (0.0, 1.0))
+
+
+class KendallTest(unittest.TestCase):
+  """O(n log n) Kendall tau-b and its p-values match mstats.kendalltau."""
+  def check(self, M, method='auto'):
+    F, G = KendallBatch(1, method=method), KendallBatch(1, method=method)
+    for x, y in all_pairs(M):
+      F.compute_pair(M[x], M[y], 0, x, y)
+      pair = Pair(M[x], M[y])
+      G.compute(pair.X, pair.Y, 0)
+      assert_same(self, G.get(0), F.get(0), "rows (%d, %d)" % (x, y))
+
+  def test_exact_small_untied(self):
+    # n <= 33 without ties: exact p-values.
+    self.check(ma.array(np.random.RandomState(1).randn(6, 30)))
+
+  def test_exact_one_discordant(self):
+    x = np.arange(60, dtype=np.float)
+    y = x.copy()
+    y[[10, 11]] = y[[11, 10]]
+    self.check(ma.array([x, y]))
+
+  def test_asymptotic_large(self):
+    self.check(ma.array(np.random.RandomState(2).randn(5, 80)))
+
+  def test_ties(self):
+    rng = np.random.RandomState(3)
+    self.check(ma.array(rng.randint(0, 5, (6, 30)).astype(np.float), mask=rng.rand(6, 30) < 0.1))
+
+  def test_asymptotic_method(self):
+    self.check(ma.array(np.random.RandomState(4).randn(4, 20)), method='asymptotic')
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,35 @@
+"""Tests of batch_pairwise.py output handling."""
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+from util import batch_mnames
+from fixtures import WorkDirTest
+
+
+class ExistingOutputsTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    self.M = ma.masked_array(rng.randn(5, 20), mask=rng.rand(5, 20) < 0.1)
+
+  def run_batch(self, **kwds):
+    return batch_pairwise.main(npyfile='M.npy', work_dir=self.work_dir, n=5, M=self.M, **kwds)
+
+  def test_batch_mnames(self):
+    self.assertNotIn('DCOR_PV', batch_mnames('dcor')['dcor'])
+    self.assertIn('DCOR_PV', batch_mnames('dcor', n_perm=5)['dcor'])
+    self.assertIn('DCOR_PV', batch_mnames('pearson+dcor', n_perm=5)['dcor'])
+
+  def test_missing_permutation_pvalues(self):
+    # Outputs of a run without n_perm do not include DCOR_PV of a run with n_perm.
+    self.assertNotEqual(self.run_batch(function='dcor'), 1)
+    self.assertEqual(self.run_batch(function='dcor'), 1)
+    self.assertNotEqual(self.run_batch(function='dcor', n_perm='5'), 1)
+    self.assertTrue(os.path.exists(os.path.join(self.work_dir, 'M.npy_dcor_0_10.DCOR_PV.npy')))
+    self.assertEqual(self.run_batch(function='dcor', n_perm='5'), 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,34 @@
+"""Tests of benchmark.py runs and baseline comparison."""
+import unittest
+import benchmark
+
+
+class RunTest(unittest.TestCase):
+  def config(self, mode):
+    return {'function': 'pearson', 'backend': None, 'mode': mode, 'n_samples': 30, 'n_rows': 20, 'mask': 0.1}
+
+  def test_block(self):
+    r = benchmark.run(self.config('block'))
+    self.assertNotIn('error', r)
+    self.assertIn('prepare_seconds', r)
+    self.assertEqual(r['n_pairs'], 20*19//2)
+    L = r['latency_ms']
+    self.assertTrue(0 < L['p50'] <= L['p90'] <= L['p99'])
+
+  def test_pair(self):
+    r = benchmark.run(self.config('pair'))
+    self.assertNotIn('error', r)
+    self.assertNotIn('prepare_seconds', r)
+    self.assertTrue(r['pairs_per_sec'] > 0)
+
+  def test_compare(self):
+    base = dict(self.config('pair'), pairs_per_sec=100.0)
+    results = [dict(base, pairs_per_sec=70.0), dict(self.config('block'), pairs_per_sec=1.0)]
+    regressions = benchmark.compare(results, [base], tolerance=0.2)
+    self.assertEqual(len(regressions), 1)
+    self.assertAlmostEqual(results[0]['baseline_ratio'], 0.7)
+    self.assertNotIn('baseline_ratio', results[1])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,54 @@
+"""Tests of block mode against pair mode over ranges of batch_pairwise.py."""
+import unittest
+import warnings
+import numpy as np
+from batch_pairwise import compute_blocks, compute_pairs
+from fixtures import degenerate_matrix, assert_same
+from util import FUNCTIONS
+
+
+class BlockTest(unittest.TestCase):
+  def setUp(self):
+    self.M = degenerate_matrix(n_rows=13, n_samples=40, seed=1)
+    # Rows with at least three unmasked values, as p-values of two differ by rounding.
+    self.M = self.M[[0] + range(3, 13)]
+    self.n = np.size(self.M, 0)
+
+  def check(self, function, rtol=1e-10):
+    n = self.n
+    for start, end, tile in [(0, n*(n-1)//2, 4), (7, 40, 3), (12, 13, 2), (30, n*(n-1)//2, 64)]:
+      P, B = FUNCTIONS[function](end-start), FUNCTIONS[function](end-start)
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        compute_pairs(P, self.M, start, end, n, "pairs")
+        compute_blocks(B, self.M, start, end, n, tile)
+      for i in xrange(end-start):
+        assert_same(self, P.get(i), B.get(i), "%s block %d of [%d, %d) tile %d" % (function, i, start, end, tile), rtol)
+
+  def test_pearson(self):
+    self.check('pearson')
+
+  def test_covariance(self):
+    self.check('covariance')
+
+  def test_spearman(self):
+    self.check('spearman')
+
+  def test_euclidean(self):
+    self.check('euclidean')
+
+  def test_absolute_error(self):
+    # Correlations and p-values of rows of different scales agree to about 1e-14.
+    rng = np.random.RandomState(2)
+    M = degenerate_matrix(n_rows=30, n_samples=200, seed=2)[3:] * rng.uniform(0.1, 100, (27, 1))
+    n = np.size(M, 0)
+    for function in ('pearson', 'spearman'):
+      P, B = FUNCTIONS[function](n*(n-1)//2), FUNCTIONS[function](n*(n-1)//2)
+      compute_pairs(P, M, 0, n*(n-1)//2, n, "pairs")
+      compute_blocks(B, M, 0, n*(n-1)//2, n, 7)
+      for name in P.MNAMES:
+        np.testing.assert_allclose(B.Matrices[name], P.Matrices[name], rtol=0, atol=5e-14)
+
+
+if __name__ == "__main__":
+  unittest.main()
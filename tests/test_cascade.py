@@ -0,0 +1,72 @@
+"""Tests of cascade screening of pairs before an expensive Batch."""
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+import cascade
+from dcor_batch import DcorBatch
+from fixtures import WorkDirTest
+
+
+class SelectTest(unittest.TestCase):
+  def test_parse_screen(self):
+    self.assertEqual(cascade.parse_screen("pearson:abs_gt:0.3"), ("pearson", "abs_gt", 0.3))
+    self.assertEqual(cascade.parse_screen("dcor_sub:top:0.1"), ("dcor_sub", "top", 0.1))
+    for screen in ("pearson:top:0", "pearson:top:1.5", "mine:abs_gt:0.3", "pearson:gt:0.3", "pearson:0.3"):
+      self.assertRaises(Exception, cascade.parse_screen, screen)
+
+  def test_select(self):
+    score = np.array([0.5, np.nan, 0.1, 0.9, 0.3, np.nan, 0.7])
+    self.assertEqual(list(np.nonzero(cascade.select(score, 'abs_gt', 0.3))[0]), [0, 3, 6])
+    self.assertEqual(list(np.nonzero(cascade.select(score, 'top', 0.4))[0]), [3, 6])
+    self.assertEqual(list(np.nonzero(cascade.select(score, 'top', 1.0))[0]), [0, 2, 3, 4, 6])
+    self.assertFalse(cascade.select(np.array([np.nan, np.nan]), 'top', 0.5).any())
+
+  def test_subsample(self):
+    rng = np.random.RandomState(0)
+    x, y = rng.randn(300), rng.randn(300)
+    S, F = cascade.SubsampleDcorBatch(1, subsample=50, backend='numpy'), DcorBatch(1, backend='numpy')
+    idx = np.linspace(0, 299, 50).astype(np.int64)
+    S.compute_pair(ma.array(x), ma.array(y), 0)
+    F.compute(x[idx], y[idx], 0)
+    self.assertEqual(S.get(0), F.get(0))
+    S.compute_pair(ma.array(x[:40]), ma.array(y[:40]), 0)
+    F.compute(x[:40], y[:40], 0)
+    self.assertEqual(S.get(0), F.get(0))
+
+
+class ScreenedBatchTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    z = rng.randn(40)
+    D = rng.randn(10, 40) + z * rng.rand(10, 1) * 2
+    self.M = ma.masked_array(D, mask=rng.rand(10, 40) < 0.1)
+
+  def run_batch(self, batchname, function, **kwds):
+    batch_pairwise.main(npyfile='M.npy', work_dir=self.work_dir, n=10, M=self.M, function=function, batchname=batchname, **kwds)
+    return dict([(name, np.load(os.path.join(self.work_dir, "%s.%s.npy" % (batchname, name)))) \
+      for name in batch_pairwise.FUNCTIONS[function].MNAMES])
+
+  def check(self, span, screen):
+    measure = cascade.parse_screen(screen)[0]
+    full = self.run_batch("full", 'dcor', **span)
+    screened = self.run_batch("screened", 'dcor', screen=screen, **span)
+    score = np.abs(self.run_batch("score", measure, **span)[measure.upper()])
+    chosen = cascade.select(score.ravel(), *cascade.parse_screen(screen)[1:]).reshape(np.shape(score))
+    self.assertTrue(chosen.any() and not chosen.all())
+    for name in ('DCOR', 'DCOV'):
+      np.testing.assert_array_equal(screened[name][chosen], full[name][chosen])
+      self.assertTrue(np.isnan(screened[name][~chosen]).all())
+
+  def test_range(self):
+    self.check({'start': 3, 'end': 40}, "pearson:abs_gt:0.5")
+    self.check({'start': 0, 'end': 45}, "spearman:top:0.25")
+
+  def test_tile(self):
+    self.check({'rows': "0:4", 'cols': "2:10"}, "pearson:abs_gt:0.5")
+
+
+if __name__ == "__main__":
+  unittest.main()
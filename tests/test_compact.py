@@ -0,0 +1,52 @@
+"""Tests of compact chunked storage of compiled matrices."""
+import unittest
+import numpy as np
+import compact
+from fixtures import CompiledTest
+
+
+class CompactTest(CompiledTest):
+  def test_round_trip(self):
+    values_fname, isset_fname = self.save("PEARSON", self.Q, self.isset)
+    # Largest error of each encoding of values in [-1, 1]: half a float16 unit in [0.5, 1)
+    # or half a quantization step.
+    for encoding, atol in [('float32', 0), ('float16', 2**-11), ('q16', 1.0/(2**16-2)), ('q8', 1.0/254)]:
+      fname = compact.write_compact(values_fname, isset_fname, encoding, matrix_name="PEARSON", chunk=100)
+      C = compact.CompactMatrix(fname, cache_chunks=2)
+      self.assertEqual(len(C), np.size(self.Q))
+      np.testing.assert_array_equal(np.isnan(C[:]), ~self.isset)
+      np.testing.assert_allclose(C[:][self.isset], self.Q[self.isset], rtol=0, atol=atol + 1e-12)
+      np.testing.assert_array_equal(C[150:333], C[:][150:333])
+      np.testing.assert_array_equal(C[::7], C[:][::7])
+      idx = np.array([[3, 400], [199, 0]])
+      np.testing.assert_array_equal(C[idx], C[:][idx])
+      self.assertTrue(np.isnan(C[1]) if not self.isset[1] else C[1] == C[:][1])
+      C.close()
+
+  def test_float16_range(self):
+    # Bounded measures and values within range keep float16; others are saved as float32.
+    self.assertEqual(compact.check_encoding(self.Q * 10, 'float16', "PEARSON"), 'float16')
+    self.assertEqual(compact.check_encoding(self.Q, 'float16', "DCOR_PV"), 'float16')
+    self.assertEqual(compact.check_encoding(self.Q * 1e3, 'float16', "COVARIANCE"), 'float16')
+    self.assertEqual(compact.check_encoding(self.Q * 1e6, 'float16', "COVARIANCE"), 'float32')
+    self.assertEqual(compact.check_encoding(self.Q * 1e6, 'q16', "COVARIANCE"), 'q16')
+    Q = self.Q * 1e6
+    values_fname, _ = self.save("COVARIANCE", Q)
+    C = compact.CompactMatrix(compact.write_compact(values_fname, None, 'float16', matrix_name="COVARIANCE"))
+    self.assertEqual(C.encoding, 'float32')
+    np.testing.assert_array_equal(C[:], Q)
+
+  def test_value_range(self):
+    # Matrices without known bounds are quantized over the range of their values.
+    Q = self.Q * 50 + 10
+    values_fname, _ = self.save("COVARIANCE", Q)
+    for encoding, levels in [('q16', 2**16-2), ('q8', 254)]:
+      C = compact.CompactMatrix(compact.write_compact(values_fname, None, encoding, matrix_name="COVARIANCE"))
+      step = (Q.max() - Q.min()) / float(levels)
+      np.testing.assert_allclose(C[:], Q, rtol=0, atol=step/2 * (1 + 1e-6))
+      self.assertEqual((C[:].min(), C[:].max()), (float(Q.min()), float(Q.max())))
+      C.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
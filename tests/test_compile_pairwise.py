@@ -0,0 +1,73 @@
+"""Tests of compile_pairwise.py."""
+import os
+import unittest
+import numpy as np
+import compile_pairwise
+from fixtures import WorkDirTest
+
+
+class CompileSegmentsTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    self.Q = np.random.RandomState(0).randn(10)
+    self.prefix = os.path.join(self.work_dir, "out")
+
+  def save(self, start, end, Q, batch_id="m.data.npy_pearson"):
+    np.save(os.path.join(self.work_dir, "%s_%d_%d.PEARSON.npy" % (batch_id, start, end)), Q)
+
+  def compiled(self, **kwds):
+    compile_pairwise.main(path=self.work_dir, outpath_prefix=self.prefix, n=10, **kwds)
+    return np.load(self.prefix + ".PEARSON.values.npy")
+
+  def test_missing_segment(self):
+    self.save(4, 8, self.Q[4:8])
+    self.save(0, 4, self.Q[0:4])
+    V = self.compiled()
+    B = np.load(self.prefix + ".PEARSON.isset.npy")
+    self.assertEqual(V.dtype, np.float32)
+    np.testing.assert_array_equal(B, np.arange(10) < 8)
+    np.testing.assert_array_equal(V[:8], self.Q[:8].astype(np.float32))
+
+  def test_overlapping_segments(self):
+    self.save(0, 6, self.Q[0:6])
+    self.save(4, 10, self.Q[4:10])
+    V = self.compiled(precision=64)
+    self.assertFalse(os.path.exists(self.prefix + ".PEARSON.isset.npy"))
+    self.assertEqual(V.dtype, np.float64)
+    np.testing.assert_array_equal(V, self.Q)
+
+  def test_row_index_option(self):
+    self.save(0, 10, self.Q)
+    square = self.prefix + ".PEARSON.square.npy"
+    self.compiled(row_index="False")
+    self.assertFalse(os.path.exists(square))
+    self.compiled(row_index="True")
+    self.assertEqual(np.load(square).shape, (5, 5))
+
+  def test_segments_with_nan(self):
+    # A constant row gives nan for all of its pairs; equal segments are valid output.
+    Q = np.arange(10, dtype=np.float) / 10
+    Q[[0, 1, 2, 3]] = np.nan
+    self.save(0, 4, Q[0:4])
+    self.save(4, 8, Q[4:8])
+    self.save(8, 10, Q[8:10])
+    V = self.compiled()
+    B = np.load(self.prefix + ".PEARSON.isset.npy")
+    np.testing.assert_array_equal(B, ~np.isnan(Q))
+    self.assertTrue(np.allclose(V[B], Q[B]))
+
+  def test_identical_nan_segments(self):
+    self.save(0, 5, np.array([np.nan]*5))
+    self.save(5, 10, np.array([np.nan]*5))
+    self.compiled()
+    self.assertFalse(np.load(self.prefix + ".PEARSON.isset.npy").any())
+
+  def test_repeated_range(self):
+    self.save(0, 5, np.zeros(5))
+    self.save(0, 5, np.ones(5), batch_id="other_pearson")
+    self.save(5, 10, np.ones(5))
+    self.assertRaises(AssertionError, self.compiled)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,61 @@
+"""Tests of the pair runtime cost model used by dispatch_pairwise.py k=auto."""
+import unittest
+import numpy as np
+import numpy.ma as ma
+import cost_model
+from cost_model import CostModel
+from py_symmetric_matrix import inv_sym_idx
+from util import FUNCTIONS
+
+
+def brute_span(C, start, end):
+  return sum([C.pair(*inv_sym_idx(i, C.n)) for i in xrange(start, end)])
+
+
+class CostModelTest(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.RandomState(0)
+    self.C = CostModel(1e-4, 1e-6, 2.0, rng.uniform(0.2, 1.0, 23), 50)
+    self.num_pairs = 23*22//2
+
+  def test_orders_are_functions(self):
+    self.assertTrue(set(cost_model.ORDERS) <= set(FUNCTIONS))
+    self.assertEqual(cost_model.function_order('kendalltau'), cost_model.ORDERS['kendalltau'])
+
+  def test_span(self):
+    C = self.C
+    for start, end in [(0, self.num_pairs), (0, 1), (5, 6), (3, 40), (21, 22), (100, 200), (250, self.num_pairs)]:
+      self.assertAlmostEqual(C.span(start, end), brute_span(C, start, end), places=10)
+    self.assertAlmostEqual(C.total(), brute_span(C, 0, self.num_pairs), places=10)
+    self.assertEqual(C.span(7, 7), 0.0)
+
+  def test_plan_ranges(self):
+    C = self.C
+    for start, end, target in [(0, None, 0.01), (17, 200, 0.003), (0, None, 1e-9), (0, None, 1e3)]:
+      ranges = C.plan_ranges(target, start, end)
+      end = self.num_pairs if end is None else end
+      # Ranges cover [start, end) contiguously, each with at least one pair.
+      self.assertEqual(ranges[0][0], start)
+      self.assertEqual(ranges[-1][1], end)
+      for (a, b), (c, d) in zip(ranges, ranges[1:]):
+        self.assertEqual(b, c)
+      for a, b in ranges:
+        self.assertTrue(a < b)
+      # All ranges but the last reach target and are under target without their last pair.
+      for a, b in ranges[:-1]:
+        self.assertTrue(brute_span(C, a, b) >= target - 1e-12)
+        self.assertTrue(b-a == 1 or brute_span(C, a, b-1) < target)
+
+  def test_calibrate_sample(self):
+    rng = np.random.RandomState(1)
+    M = ma.masked_array(rng.randn(40, 60), mask=rng.rand(40, 60) < 0.2)
+    for block in (False, True):
+      C = cost_model.calibrate_sample(M, 'pearson', n_pairs=50, block=block)
+      self.assertEqual(C.n, 40)
+      self.assertTrue(C.a >= 0 and C.b > 0)
+      self.assertTrue(len(C.plan_ranges(C.total() / 4)) in (4, 5))
+    self.assertTrue('blocks' in C.source)
+
+
+if __name__ == "__main__":
+  unittest.main()
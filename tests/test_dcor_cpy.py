@@ -0,0 +1,31 @@
+"""Tests of threads of the dcor_cpy kernels."""
+import unittest
+import numpy as np
+import dcor_cpy
+from dcor_batch import DcorBatch
+from fixtures import all_pairs
+
+
+class ThreadsTest(unittest.TestCase):
+  def tearDown(self):
+    dcor_cpy.set_num_threads(1)
+
+  def test_n_threads(self):
+    rng = np.random.RandomState(0)
+    M = rng.randn(6, 300)
+    M[1] = np.floor(M[1])
+    results = []
+    for n_threads in (1, 4):
+      F = DcorBatch(15, n_threads=n_threads)
+      for i, (x, y) in enumerate(all_pairs(M)):
+        F.compute(M[x], M[y], i)
+      results.append(F.Matrices)
+    for name in DcorBatch.MNAMES:
+      np.testing.assert_allclose(results[1][name], results[0][name], rtol=1e-12)
+
+  def test_numpy_backend(self):
+    self.assertRaises(AssertionError, DcorBatch, 1, backend='numpy', n_threads=2)
+
+
+if __name__ == "__main__":
+  unittest.main()
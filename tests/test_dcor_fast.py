@@ -0,0 +1,60 @@
+"""Tests of the O(n log n) distance correlation against the O(n^2) definition."""
+import unittest
+import numpy as np
+import dcor
+import dcor_fast
+from dcor_batch import DcorBatch, BACKENDS
+from fixtures import assert_same, all_pairs
+
+
+class DcorFastTest(unittest.TestCase):
+  def samples(self):
+    rng = np.random.RandomState(0)
+    for n in (2, 3, 5, 17, 64, 200):
+      x = rng.randn(n)
+      yield x, x**2 + rng.randn(n) * 0.1
+      # Ties, including all equal values of x.
+      yield np.floor(x), np.floor(rng.randn(n) * 2)
+      yield np.ones(n), rng.randn(n)
+
+  def test_dominance_sums(self):
+    rng = np.random.RandomState(1)
+    for n in (1, 2, 7, 33):
+      ranks = dcor_fast.dense_rank(rng.randint(0, 5, n).astype(np.float))
+      W = rng.rand(2, n)
+      for strict in (True, False):
+        expected = np.zeros((2, n))
+        for q in xrange(n):
+          for p in xrange(q):
+            if ranks[p] < ranks[q] or (not strict and ranks[p] == ranks[q]):
+              expected[:,q] += W[:,p]
+        np.testing.assert_allclose(dcor_fast.dominance_sums(ranks, W, strict), expected, rtol=1e-12, atol=1e-12)
+
+  def test_dcov_all(self):
+    for x, y in self.samples():
+      with np.errstate(all='ignore'):
+        expected, actual = dcor.dcov_all(x, y), dcor_fast.dcov_all(x, y)
+      for e, a in zip(expected, actual):
+        if np.isnan(e):
+          self.assertTrue(np.isnan(a))
+        else:
+          self.assertTrue(abs(e - a) <= 1e-9 * max(abs(e), 1e-12) + 1e-12, "n=%d: %r != %r" % (np.size(x), e, a))
+
+  def test_backends(self):
+    rng = np.random.RandomState(2)
+    M = rng.randn(8, 50)
+    M[0] = 1.0
+    M[1] = np.floor(M[1])
+    batches = dict([(backend, DcorBatch(1, backend=backend)) for backend in BACKENDS])
+    for x, y in all_pairs(M):
+      results = {}
+      for backend, F in batches.items():
+        with np.errstate(all='ignore'):
+          F.compute(M[x], M[y], 0)
+        results[backend] = F.get(0)
+      for backend in ('cpy', 'fast'):
+        assert_same(self, results['numpy'], results[backend], "%s (%d, %d)" % (backend, x, y), rtol=1e-9)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,37 @@
+"""Tests of multi-row dual pairwise batches and their compilation."""
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import batch_dual_pairwise
+import compile_dual_pairwise
+from fixtures import WorkDirTest
+
+
+class MultiRowTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    self.M1 = ma.masked_array(rng.randn(7, 20), mask=rng.rand(7, 20) < 0.1)
+    self.M2 = ma.masked_array(rng.randn(5, 20), mask=rng.rand(5, 20) < 0.1)
+
+  def compiled(self, name, spans, **kwds):
+    path = os.path.join(self.work_dir, name)
+    os.mkdir(path)
+    for offset, end in spans:
+      batch_dual_pairwise.main(npyfile_1='a.npy', npyfile_2='b.npy', offset=offset, end=end, work_dir=path,
+        function='pearson', M1=self.M1, M2=self.M2, **kwds)
+    prefix = os.path.join(self.work_dir, name)
+    compile_dual_pairwise.main(path, prefix, 7, 5)
+    self.assertFalse(os.path.exists(prefix + ".PEARSON.isset.npy"))
+    return np.load(prefix + ".PEARSON.values.npy")
+
+  def test_multi_row(self):
+    # One row per batch, as before multi-row batches.
+    expected = self.compiled("rows", [(x, None) for x in xrange(7)])
+    np.testing.assert_array_equal(self.compiled("multi", [(0, 3), (3, 4), (4, 7)]), expected)
+    np.testing.assert_allclose(self.compiled("block", [(0, 5), (5, 7)], block=True, tile=2), expected, rtol=1e-6)
+
+
+if __name__ == "__main__":
+  unittest.main()
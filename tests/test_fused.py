@@ -0,0 +1,40 @@
+"""Tests of FusedBatch against the reference computations of each of its functions."""
+import unittest
+import warnings
+from util import make_batch, FUNCTIONS
+from fixtures import degenerate_matrix, reference, assert_same, compared, all_pairs
+
+
+class FusedTest(unittest.TestCase):
+  def setUp(self):
+    self.M = degenerate_matrix()
+
+  def test_fused_pair(self):
+    names = ['pearson', 'spearman', 'kendalltau', 'covariance', 'dcor']
+    F = make_batch("+".join(names), 1)
+    for x, y in all_pairs(self.M):
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        F.compute_pair(self.M[x], self.M[y], 0, x, y)
+      for name in names:
+        cls = FUNCTIONS[name]
+        assert_same(self, reference(cls, self.M[x], self.M[y]), F.batches[name].get(0),
+          "fused %s (%d, %d)" % (name, x, y), rtol=1e-8, names=compared(cls, self.M[x], self.M[y]))
+
+  def test_fused_block(self):
+    names = ['pearson', 'spearman', 'covariance']
+    F = make_batch("+".join(names), 1)
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      P = F.prepare_rows(self.M)
+      R = F.compute_block(P, P)
+    for x, y in all_pairs(self.M):
+      for name in names:
+        cls = FUNCTIONS[name]
+        actual = dict([(m, R[m][x,y]) for m in cls.MNAMES])
+        assert_same(self, reference(cls, self.M[x], self.M[y]), actual,
+          "fused block %s (%d, %d)" % (name, x, y), rtol=1e-8, names=compared(cls, self.M[x], self.M[y]))
+
+
+if __name__ == "__main__":
+  unittest.main()
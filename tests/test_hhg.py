@@ -0,0 +1,64 @@
+"""Tests of the HHG 2x2 statistics against a brute force count of each table."""
+import math
+import unittest
+import numpy as np
+import cost_model
+from hhg_batch import HHGBatch, hhg_2x2, max_ranks
+
+
+def brute_hhg(x, y):
+  """Return HHG 2x2 statistics of samples x and y from O(n^3) table counts."""
+  n = len(x)
+  m = float(n - 2)
+  chis, lrs = [], []
+  for i in xrange(n):
+    for j in xrange(n):
+      if i == j: continue
+      a = np.zeros((2, 2))
+      for k in xrange(n):
+        if k in (i, j): continue
+        a[int(abs(x[i]-x[k]) > abs(x[i]-x[j])), int(abs(y[i]-y[k]) > abs(y[i]-y[j]))] += 1
+      rows, cols = a.sum(1), a.sum(0)
+      if rows.min() == 0 or cols.min() == 0:
+        chis.append(0.0); lrs.append(0.0)
+        continue
+      chis.append(m * (a[0,1]*a[1,0] - a[0,0]*a[1,1])**2 / (rows[0]*rows[1]*cols[0]*cols[1]))
+      lrs.append(sum([a[r,c] * math.log(a[r,c] * m / (rows[r]*cols[c])) \
+        for r in (0, 1) for c in (0, 1) if a[r,c] > 0]))
+  return {'sum_chisquared': sum(chis), 'sum_lr': sum(lrs), 'max_chisquared': max(chis), 'max_lr': max(lrs)}
+
+
+class HHGTest(unittest.TestCase):
+  def test_max_ranks(self):
+    D = np.array([[3., 1., 3., 2.], [0., 0., 0., 5.]])
+    np.testing.assert_array_equal(max_ranks(D), [[4, 1, 4, 2], [3, 3, 3, 4]])
+
+  def test_brute_force(self):
+    rng = np.random.RandomState(0)
+    for n in (4, 5, 9, 20):
+      x = rng.randn(n)
+      for y in (x**2 + rng.randn(n)*0.3, rng.randn(n), np.round(rng.randn(n)), x):
+        for xx in (x, np.round(x * 2)):
+          expected, actual = brute_hhg(xx, y), hhg_2x2(xx, y)
+          for name in expected:
+            self.assertTrue(abs(expected[name] - actual[name]) <= 1e-10 * max(abs(expected[name]), 1.0),
+              "n=%d %s: %r != %r" % (n, name, expected[name], actual[name]))
+
+  def test_batch(self):
+    # The numpy backend is selected explicitly; rpy2 stays the default.
+    self.assertEqual(cost_model.default_backend('hhg'), 'rpy2')
+    rng = np.random.RandomState(1)
+    x, y = rng.randn(12), rng.randn(12)
+    F = HHGBatch(1, backend='numpy')
+    F.compute(x, y, 0)
+    d = hhg_2x2(x, y)
+    self.assertAlmostEqual(F.get(0)['SUM_CHI'], d['sum_chisquared'] / (12*10*9))
+    self.assertAlmostEqual(F.get(0)['MAX_CHI'], d['max_chisquared'] / 10)
+
+  def test_small(self):
+    for name, value in hhg_2x2([1., 2., 3.], [1., 2., 4.]).items():
+      self.assertTrue(np.isnan(value), name)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,45 @@
+"""Tests of memory-mapped .npy pairs of masked matrices."""
+import os
+import unittest
+import cPickle as pickle
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+from fixtures import WorkDirTest
+from util import npy_pair_fnames, save_npy_pair, load_masked
+
+
+class LoadMaskedTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    self.M = ma.masked_array(rng.randn(9, 20), mask=rng.rand(9, 20) < 0.2)
+    self.pkl_fname = os.path.join(self.work_dir, "m.tab.pkl")
+    pickle.dump(self.M, open(self.pkl_fname, 'w'), protocol=2)
+    self.data_fname = save_npy_pair(self.M, self.pkl_fname)
+
+  def test_npy_pair_fnames(self):
+    self.assertEqual(npy_pair_fnames("a/m.tab.pkl"), ("a/m.tab.data.npy", "a/m.tab.mask.npy"))
+    self.assertEqual(npy_pair_fnames("a/m.tab.data.npy"), ("a/m.tab.data.npy", "a/m.tab.mask.npy"))
+
+  def test_load_masked(self):
+    self.assertEqual(self.data_fname, os.path.join(self.work_dir, "m.tab.data.npy"))
+    M = load_masked(self.data_fname)
+    self.assertTrue(isinstance(M.data.base, np.memmap) or isinstance(M.data, np.memmap))
+    np.testing.assert_array_equal(M.data, self.M.data)
+    np.testing.assert_array_equal(M.mask, self.M.mask)
+    P = load_masked(self.pkl_fname)
+    np.testing.assert_array_equal(P.mask, self.M.mask)
+    np.testing.assert_array_equal(P.data, self.M.data)
+
+  def test_batch_pairwise(self):
+    for npyfile in (self.pkl_fname, self.data_fname):
+      batch_pairwise.main(npyfile=npyfile, work_dir=self.work_dir, function='pearson', n=9, start=3, end=30,
+        batchname=os.path.basename(npyfile))
+    for name in ("PEARSON", "PEARSON_PV"):
+      expected = np.load(os.path.join(self.work_dir, "m.tab.pkl.%s.npy" % name))
+      np.testing.assert_array_equal(np.load(os.path.join(self.work_dir, "m.tab.data.npy.%s.npy" % name)), expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,85 @@
+"""Tests of the local process-pool backend of the dispatchers."""
+import glob
+import os
+import unittest
+import cPickle as pickle
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+import compile_pairwise
+import local_pool
+from dispatch_pairwise import dispatch_pairwise
+from fixtures import WorkDirTest
+
+
+def save_row_sum(fname, x, M=None):
+  np.save(fname, M[x].sum())
+  print "Saved row %d." % x
+
+def fail(x, M=None):
+  raise ValueError("Job %d fails." % x)
+
+
+class LocalPoolTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    self.cwd = os.getcwd()
+    rng = np.random.RandomState(0)
+    self.M = ma.masked_array(rng.randn(12, 20), mask=rng.rand(12, 20) < 0.1)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    WorkDirTest.tearDown(self)
+
+  def log(self, name):
+    return os.path.join(self.work_dir, name)
+
+  def test_run_jobs(self):
+    jobs = [(save_row_sum, {'fname': self.log("row%d.npy" % x), 'x': x}, self.log("%d.out" % x), self.log("%d.err" % x)) \
+      for x in xrange(5)]
+    jobs.append((fail, {'x': 5}, self.log("5.out"), self.log("5.err")))
+    self.assertEqual(local_pool.run_jobs(jobs, 2, shared={'M': self.M}), 1)
+    for x in xrange(5):
+      self.assertEqual(np.load(self.log("row%d.npy" % x)), self.M[x].sum())
+      self.assertEqual(open(self.log("%d.out" % x)).read(), "Saved row %d.\n" % x)
+    self.assertTrue("Job 5 fails." in open(self.log("5.err")).read())
+    self.assertEqual(local_pool.SHARED, {})
+
+  def test_dispatch_local(self):
+    pkl_file = os.path.join(self.work_dir, "m.pkl")
+    pickle.dump(self.M, open(pkl_file, 'w'), protocol=2)
+    outdir = os.path.join(self.work_dir, "out")
+    dispatch_pairwise(pkl_file=pkl_file, outdir=outdir, work_dir=outdir, function='pearson', k=25,
+      backend='local', n_workers=2)
+    batch_pairwise.main(npyfile=pkl_file, work_dir=self.work_dir, function='pearson', n=12, batchname="all")
+    expected = np.load(os.path.join(self.work_dir, "all.PEARSON.npy"))
+    for start in xrange(0, 66, 25):
+      end = min(start + 25, 66)
+      fname = os.path.join(outdir, "pearson", "m.data.npy_pearson_%d_%d.PEARSON.npy" % (start, end))
+      np.testing.assert_array_equal(np.load(fname), expected[start:end])
+    self.assertEqual(len(glob.glob(os.path.join(outdir, "pearson", "log_*.out"))), 3)
+
+  def test_resume_tiles(self):
+    # A tiles resume of a range dispatch recomputes only the tiles with missing pairs.
+    pkl_file = os.path.join(self.work_dir, "m.pkl")
+    pickle.dump(self.M, open(pkl_file, 'w'), protocol=2)
+    outdir = os.path.join(self.work_dir, "out")
+    dispatch_pairwise(pkl_file=pkl_file, outdir=outdir, work_dir=outdir, function='pearson', k=25,
+      backend='local', n_workers=2)
+    path = os.path.join(outdir, "pearson")
+    for fname in glob.glob(os.path.join(path, "m.data.npy_pearson_25_50.*.npy")):
+      os.remove(fname)
+    dispatch_pairwise(pkl_file=pkl_file, outdir=outdir, work_dir=outdir, function='pearson',
+      partition='tiles', tile_rows=4, resume=True, backend='local', n_workers=2)
+    # Pairs [25, 50) are of rows 2 through 5, in tiles of rows 0-3 and 4-7 versus later rows.
+    tiles = sorted([os.path.basename(f) for f in glob.glob(os.path.join(path, "*_tile_*.PEARSON.npy"))])
+    self.assertEqual(tiles, ["m.data.npy_pearson_tile_%s.PEARSON.npy" % s for s in ("0_4_4_8", "0_4_8_12", "4_8_4_8", "4_8_8_12")])
+    prefix = os.path.join(self.work_dir, "compiled")
+    compile_pairwise.main(path=path, outpath_prefix=prefix, n=66)
+    batch_pairwise.main(npyfile=pkl_file, work_dir=self.work_dir, function='pearson', n=12, batchname="all")
+    np.testing.assert_array_equal(np.load(prefix + ".PEARSON.values.npy"),
+      np.load(os.path.join(self.work_dir, "all.PEARSON.npy")).astype(np.float32))
+
+
+if __name__ == "__main__":
+  unittest.main()
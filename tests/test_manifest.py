@@ -0,0 +1,98 @@
+"""Tests of range arithmetic and manifests of completed batches."""
+import os
+import random
+import unittest
+import numpy as np
+import manifest
+from py_symmetric_matrix import sym_idx
+from fixtures import WorkDirTest
+
+
+def covered(ranges):
+  return set([i for a, b in ranges for i in xrange(a, b)])
+
+
+class RangesTest(unittest.TestCase):
+  def random_ranges(self, rng, n=8, hi=100):
+    ranges = []
+    for j in xrange(rng.randint(0, n)):
+      a = rng.randint(0, hi-1)
+      ranges.append((a, rng.randint(a+1, hi)))
+    return ranges
+
+  def test_merge_subtract_intersect(self):
+    rng = random.Random(0)
+    for t in xrange(200):
+      ranges = self.random_ranges(rng)
+      merged = manifest.merge_ranges(ranges)
+      self.assertEqual(covered(merged), covered(ranges))
+      # Sorted, disjoint, and not adjacent.
+      for (a, b), (c, d) in zip(merged, merged[1:]):
+        self.assertTrue(a < b < c < d)
+      start, end = sorted(rng.sample(xrange(0, 110), 2))
+      gaps = manifest.subtract_ranges(start, end, ranges)
+      self.assertEqual(covered(gaps), set(xrange(start, end)) - covered(ranges))
+      self.assertEqual(gaps, manifest.merge_ranges(gaps))
+      other = self.random_ranges(rng)
+      both = manifest.intersect_ranges([ranges, other])
+      self.assertEqual(covered(both), covered(ranges) & covered(other))
+    self.assertEqual(manifest.merge_ranges([(5, 10), (0, 5)]), [(0, 10)])
+    self.assertEqual(manifest.intersect_ranges([]), [])
+
+  def test_plan_chunks(self):
+    rng = random.Random(1)
+    for t in xrange(200):
+      gaps = manifest.subtract_ranges(0, 200, self.random_ranges(rng, hi=200))
+      k = rng.randint(1, 50)
+      # Without merge, chunks are exactly the gaps.
+      self.assertEqual(covered(manifest.plan_chunks(gaps, k)), covered(gaps))
+      chunks = manifest.plan_chunks(gaps, k, merge=True)
+      # Chunks cover all gaps in order with at most k pairs each.
+      self.assertTrue(covered(gaps) <= covered(chunks))
+      for a, b in chunks:
+        self.assertTrue(0 < b - a <= k)
+      for (a, b), (c, d) in zip(chunks, chunks[1:]):
+        self.assertTrue(b <= c)
+      # Only pairs between gaps merged into one job are recomputed.
+      for a, b in chunks:
+        self.assertTrue(a in covered(gaps) and b-1 in covered(gaps))
+
+  def test_tile_ranges(self):
+    n_rows = 9
+    for tile in [(0, 3, 0, 9), (2, 5, 4, 7), (4, 9, 0, 4), (3, 6, 3, 6)]:
+      x0, x1, y0, y1 = tile
+      pairs = [sym_idx(x, y, n_rows) for x in xrange(x0, x1) for y in xrange(y0, y1) if x < y]
+      self.assertEqual(covered(manifest.tile_ranges(*tile, n_rows=n_rows)), set(pairs))
+      self.assertEqual(manifest.tiles_missing([tile], [(p, p+1) for p in pairs[:1]], n_rows), [bool(pairs)])
+      self.assertEqual(manifest.tiles_missing([tile], manifest.subtract_ranges(0, 36, [(p, p+1) for p in pairs]), n_rows), [False])
+
+
+class BuildManifestTest(WorkDirTest):
+  def save(self, name, size):
+    np.save(os.path.join(self.work_dir, name), np.zeros(size))
+
+  def test_build_manifest(self):
+    # 12 rows of 66 pairs; pairs of row 2 are [21, 30).
+    batch_id = "M.npy_dcor"
+    for start, end in [(0, 10), (10, 20), (30, 40)]:
+      for matrix in ("DCOR", "DCOV"):
+        self.save("%s_%d_%d.%s.npy" % (batch_id, start, end, matrix), end-start)
+    # DCOR_PV only of the first range, a file of the wrong shape, and another batch.
+    self.save("%s_0_10.DCOR_PV.npy" % batch_id, 10)
+    self.save("%s_40_50.DCOR.npy" % batch_id, 3)
+    self.save("M.npy_pearson_20_30.DCOR.npy", 10)
+    # A tile of row 2 versus rows 0 through 11 fills most of gap [20, 30).
+    self.save("%s_tile_2_3_0_12.DCOR.npy" % batch_id, (1, 12))
+    self.save("%s_tile_2_3_0_12.DCOV.npy" % batch_id, (1, 12))
+    M = manifest.build_manifest(self.work_dir, batch_id, ["DCOR", "DCOV"], 66)
+    self.assertEqual(M['completed'], [(0, 20), (21, 40)])
+    self.assertEqual(M['missing'], [(20, 21), (40, 66)])
+    self.assertEqual(M['completed_tiles'], [(2, 3, 0, 12)])
+    M = manifest.build_manifest(self.work_dir, batch_id, ["DCOR", "DCOV", "DCOR_PV"], 66, start_offset=5)
+    self.assertEqual(M['completed'], [(0, 10)])
+    self.assertEqual(M['missing'], [(10, 66)])
+    self.assertTrue(os.path.exists(os.path.join(self.work_dir, manifest.MANIFEST_FNAME)))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,56 @@
+"""Tests of batch stage timing and aggregation of metrics files."""
+import json
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+import compile_pairwise
+import metrics
+from metrics import StageTimer
+from fixtures import WorkDirTest
+
+
+class StageTimerTest(unittest.TestCase):
+  def test_summary(self):
+    T = StageTimer()
+    T.add('load', 1.0, 0.5)
+    T.add('compute', 2.0, 2.0)
+    T.add('compute', 2.0, 1.5)
+    with T.stage('save'):
+      pass
+    d = T.summary(100, function='pearson')
+    self.assertEqual(T.order, ['load', 'compute', 'save'])
+    self.assertEqual(d['stages']['compute'], {'wall': 4.0, 'cpu': 3.5})
+    self.assertEqual(d['pairs_per_sec'], 25.0)
+    self.assertEqual(d['function'], 'pearson')
+    self.assertEqual(T.progress(50, 100), "12.5 pairs/sec, ETA 0:00:04")
+
+
+class AggregateTest(WorkDirTest):
+  def test_aggregate(self):
+    for i, (n_pairs, compute) in enumerate([(100, 1.0), (300, 2.0), (200, 4.0)]):
+      T = StageTimer()
+      T.add('compute', compute, compute)
+      T.save(os.path.join(self.work_dir, "b%d%s" % (i, metrics.METRICS_EXT)), n_pairs)
+    d = metrics.aggregate(metrics.find_metrics(self.work_dir))
+    self.assertEqual((d['n_batches'], d['n_pairs']), (3, 600))
+    self.assertEqual(d['stages']['compute']['wall'], 7.0)
+    self.assertAlmostEqual(d['pairs_per_sec'], 600/7.0)
+    self.assertEqual(d['batch_pairs_per_sec'], {'min': 50.0, 'median': 100.0, 'max': 150.0})
+
+  def test_batches(self):
+    rng = np.random.RandomState(0)
+    M = ma.array(rng.randn(8, 20), mask=rng.rand(8, 20) < 0.1)
+    for start, end in ((0, 10), (10, 28)):
+      batch_pairwise.main(npyfile='M.npy', work_dir=self.work_dir, function='pearson', n=8,
+        start=start, end=end, M=M, timing=True)
+    prefix = os.path.join(self.work_dir, "compiled")
+    compile_pairwise.main(path=self.work_dir, outpath_prefix=prefix, n=28)
+    d = json.load(open(prefix + metrics.METRICS_EXT))
+    self.assertEqual((d['n_batches'], d['n_pairs']), (2, 28))
+    self.assertEqual(sorted(d['stages']), ['compute', 'mask', 'save'])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,90 @@
+"""Tests of permutation test p-values of distance covariance (DCOR_PV)."""
+import unittest
+import numpy as np
+import numpy.ma as ma
+import dcor
+import dcor_batch
+from dcor_batch import DcorBatch, BACKENDS, permutation_pv
+from fixtures import all_pairs
+
+
+class CountingRandomState(np.random.RandomState):
+  """RandomState which counts the permutations drawn by permutation_pv."""
+  def __init__(self, seed):
+    np.random.RandomState.__init__(self, seed)
+    self.drawn = 0
+
+  def rand(self, m, n):
+    self.drawn += m
+    return np.random.RandomState.rand(self, m, n)
+
+
+class PermutationTest(unittest.TestCase):
+  def setUp(self):
+    rng = np.random.RandomState(0)
+    self.x = rng.randn(30)
+    self.y = self.x**2 + rng.randn(30) * 0.1
+    self.z = rng.randn(30)
+
+  def test_loop(self):
+    # Same permutations, one at a time.
+    A, B = dcor.d_n(self.x), dcor.d_n(self.z)
+    # alpha near 1 so that sampling does not stop early.
+    pv = permutation_pv(A, B, 250, alpha=0.999, rng=np.random.RandomState(1))
+    rng = np.random.RandomState(1)
+    t_obs, hits = (A * B).sum(), 0
+    for done in xrange(0, 250, dcor_batch.PERM_CHUNK):
+      for p in np.argsort(rng.rand(min(dcor_batch.PERM_CHUNK, 250-done), 30), axis=1):
+        hits += (A * B[p][:,p]).sum() >= t_obs - 1e-12 * abs(t_obs)
+    self.assertEqual(pv, (hits + 1.0) / 251)
+
+  def test_early_stopping(self):
+    A, B, C = dcor.d_n(self.x), dcor.d_n(self.y), dcor.d_n(self.z)
+    # Dependent: no permutation reaches the statistic, so all permutations are drawn.
+    rng = CountingRandomState(2)
+    self.assertEqual(permutation_pv(A, B, 500, rng=rng), 1.0 / 501)
+    self.assertEqual(rng.drawn, 500)
+    # Independent: the estimate is far above alpha after the first chunk.
+    rng = CountingRandomState(2)
+    pv = permutation_pv(A, C, 10000, alpha=0.05, rng=rng)
+    self.assertTrue(pv > 0.2)
+    self.assertEqual(rng.drawn, dcor_batch.PERM_CHUNK)
+
+  def test_backends(self):
+    rng = np.random.RandomState(3)
+    M = ma.masked_array(rng.randn(5, 25), mask=rng.rand(5, 25) < 0.1)
+    M[1] += M[0]
+    results = {}
+    for backend in BACKENDS:
+      F = DcorBatch(10, backend=backend, n_perm=200)
+      self.assertEqual(F.MNAMES, ["DCOR", "DCOV", "DCOR_PV"])
+      for i, (x, y) in enumerate(all_pairs(M)):
+        F.compute_pair(M[x], M[y], i, x, y)
+      results[backend] = F.Matrices["DCOR_PV"]
+    self.assertTrue(results['numpy'][0] < 0.01)
+    for backend in ('cpy', 'fast'):
+      np.testing.assert_array_equal(results[backend], results['numpy'])
+    self.assertEqual(DcorBatch(1).MNAMES, ["DCOR", "DCOV"])
+
+  def test_cached_d_n(self):
+    # Without missing values, the distance matrix of each row is computed once.
+    M = ma.array(np.random.RandomState(4).randn(6, 25))
+    calls = []
+    d_n = dcor.d_n
+    def counting_d_n(x):
+      calls.append(np.size(x))
+      return d_n(x)
+    dcor.d_n = counting_d_n
+    try:
+      for backend in ('cpy', 'fast'):
+        F = DcorBatch(15, backend=backend, n_perm=50)
+        for i, (x, y) in enumerate(all_pairs(M)):
+          F.compute_pair(M[x], M[y], i, x, y)
+        self.assertEqual(len(calls), 6)
+        del calls[:]
+    finally:
+      dcor.d_n = d_n
+
+
+if __name__ == "__main__":
+  unittest.main()
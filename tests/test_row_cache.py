@@ -0,0 +1,82 @@
+"""Tests of the bounded per-row state cache and the DcorBatch D_N cache."""
+import unittest
+import numpy as np
+import numpy.ma as ma
+from batch import RowCache, state_nbytes
+from batch import SpearmanBatch
+from dcor_batch import DcorBatch, BACKENDS
+from fixtures import all_pairs
+
+
+class RowCacheTest(unittest.TestCase):
+  def test_entries(self):
+    C = RowCache(2)
+    for key in (1, 2, 3, 1):
+      C.get(key, lambda: key)
+    self.assertEqual(list(C.items), [3, 1])
+    self.assertEqual((C.hits, C.misses), (0, 4))
+
+  def test_bytes(self):
+    C = RowCache(100, max_bytes=3*800)
+    for key in xrange(5):
+      C.get(key, lambda: (np.zeros(100), 1.0))
+    self.assertEqual(list(C.items), [2, 3, 4])
+    self.assertEqual(C.nbytes, 3*800)
+    C.get(2, lambda: None)
+    self.assertEqual(C.hits, 1)
+    # Values larger than the bound are returned but not cached.
+    C.get(9, lambda: np.zeros(1000))
+    self.assertEqual(list(C.items), [3, 4, 2])
+
+  def test_state_nbytes(self):
+    class State(object):
+      def __init__(self):
+        self.a, self.b, self.c = np.zeros(10), [np.zeros(5)], 3
+    self.assertEqual(state_nbytes((State(), np.zeros(2))), 8*17)
+
+  def test_dcor_numpy_backend(self):
+    # Each numpy D_N of 200 samples is a 200 x 200 matrix of 320000 bytes.
+    M = ma.array(np.random.RandomState(0).randn(10, 200))
+    F = DcorBatch(45, backend='numpy', cache_mb=1)
+    G = DcorBatch(45, backend='numpy')
+    i = 0
+    for x in xrange(10):
+      for y in xrange(x+1, 10):
+        F.compute_pair(M[x], M[y], i, x, y)
+        G.compute(M[x].data, M[y].data, i)
+        i += 1
+    self.assertTrue(F.cache.nbytes <= 2**20)
+    self.assertEqual(len(F.cache.items), 3)
+    self.assertTrue(np.allclose(F.Matrices["DCOR"], G.Matrices["DCOR"], rtol=1e-12))
+
+  def test_dcor_cached(self):
+    rng = np.random.RandomState(1)
+    M = ma.masked_array(rng.randn(8, 40), mask=rng.rand(8, 40) < 0.1)
+    M.mask[:4] = False
+    for backend in BACKENDS:
+      F, G = DcorBatch(1, backend=backend, cache_size=3), DcorBatch(1, backend=backend)
+      for x, y in all_pairs(M):
+        shared = ~(M.mask[x] | M.mask[y])
+        F.compute_pair(M[x], M[y], 0, x, y)
+        G.compute(M.data[x][shared], M.data[y][shared], 0)
+        self.assertEqual(F.get(0), G.get(0), "%s (%d, %d)" % (backend, x, y))
+      self.assertTrue(F.cache.hits > 0)
+      self.assertEqual(len(F.cache.items), 3)
+
+  def test_spearman_cached(self):
+    rng = np.random.RandomState(2)
+    M = ma.masked_array(np.floor(rng.randn(8, 40) * 3), mask=rng.rand(8, 40) < 0.1)
+    M.mask[:4] = False
+    F, G = SpearmanBatch(1, cache_size=3), SpearmanBatch(1)
+    for x, y in all_pairs(M):
+      shared = ~(M.mask[x] | M.mask[y])
+      F.compute_pair(M[x], M[y], 0, x, y)
+      G.compute(M.data[x][shared], M.data[y][shared], 0)
+      for name in F.MNAMES:
+        self.assertTrue(abs(F.get(0)[name] - G.get(0)[name]) < 1e-12, "(%d, %d) %s" % (x, y, name))
+    self.assertTrue(F.cache.hits > 0)
+    self.assertTrue(len(F.cache.items) <= 3)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,46 @@
+"""Tests of square row indexes of compiled matrices."""
+import unittest
+import numpy as np
+import compact
+import row_index
+from fixtures import CompiledTest
+from py_symmetric_matrix import sym_idx
+
+
+class RowIndexTest(CompiledTest):
+  def check_square(self, fname, dtype):
+    R = row_index.RowIndex(fname)
+    self.assertEqual(R.S.dtype, dtype)
+    expected = self.expected.astype(dtype)
+    for i in (0, 7, self.n_rows-1):
+      row = R.row(i)
+      self.assertTrue(np.isnan(row[i]))
+      for j in xrange(self.n_rows):
+        if j == i: continue
+        e = expected[sym_idx(i, j, self.n_rows)]
+        self.assertTrue(np.isnan(row[j]) if np.isnan(e) else row[j] == e)
+        self.assertTrue(np.isnan(R.pair(i, j)) and np.isnan(row[j]) or R.pair(i, j) == row[j])
+    idx, values = R.top_k(3, 5, absolute=True)
+    row = R.row(3)
+    valid = np.nonzero(~np.isnan(row))[0]
+    self.assertEqual(sorted(idx), sorted(valid[np.argsort(-np.abs(row[valid]))[:5]]))
+    np.testing.assert_array_equal(values, row[idx])
+
+  def test_values(self):
+    values_fname, isset_fname = self.save("PEARSON", self.Q, self.isset)
+    M, B = row_index.open_condensed(values_fname)
+    fname = row_index.build_square(M, self.n_rows, row_index.square_fname(values_fname), B, block_rows=7)
+    self.check_square(fname, np.float32)
+
+  def test_compact(self):
+    values_fname, isset_fname = self.save("PEARSON", self.Q, self.isset)
+    fname = compact.write_compact(values_fname, isset_fname, 'float16', matrix_name="PEARSON", chunk=64)
+    M, B = row_index.open_condensed(fname)
+    dtype = compact.value_dtype(M.encoding)
+    self.assertEqual(dtype, np.float16)
+    fname = row_index.build_square(M, self.n_rows, row_index.square_fname(fname), B, block_rows=4, dtype=dtype)
+    self.check_square(fname, np.float16)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,78 @@
+"""Tests of sparse top-k and threshold records of batches merged by compile_sparse."""
+import glob
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+import sparse_edges
+from fixtures import WorkDirTest
+from util import FUNCTIONS
+
+
+class SparseEdgesTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    self.n = 15
+    self.M = ma.masked_array(rng.randn(self.n, 30), mask=rng.rand(self.n, 30) < 0.1)
+    # Dense PEARSON of all pairs as a symmetric matrix, nan on the diagonal.
+    F = FUNCTIONS['pearson'](1)
+    self.dense = dict([(name, np.full((self.n, self.n), np.nan)) for name in F.MNAMES])
+    for x in xrange(self.n):
+      for y in xrange(x+1, self.n):
+        F.compute_pair(self.M[x], self.M[y], 0, x, y)
+        for name in F.MNAMES:
+          self.dense[name][x,y] = self.dense[name][y,x] = F.get(0)[name]
+    self.saved_buffer = sparse_edges.MERGE_BUFFER
+
+  def tearDown(self):
+    sparse_edges.MERGE_BUFFER = self.saved_buffer
+    WorkDirTest.tearDown(self)
+
+  def compile(self, keep, ranges):
+    n = self.n
+    for start, end in ranges:
+      batch_pairwise.main(npyfile='M.npy', work_dir=self.work_dir, function='pearson', n=n,
+        start=start, end=end, M=self.M, keep=keep)
+    fnames = sorted(glob.glob(os.path.join(self.work_dir, "*" + sparse_edges.SPARSE_EXT)))
+    self.assertEqual(len(fnames), len(ranges))
+    out_fname = os.path.join(self.work_dir, "M.sparse.npz")
+    sparse_edges.compile_sparse(fnames, out_fname, n, keep)
+    return np.load(out_fname)
+
+  def check_rows(self, S, expected):
+    """Check that row r of CSR S has pairs expected(r), by decreasing score, and their values."""
+    for r in xrange(self.n):
+      a, b = S['indptr'][r], S['indptr'][r+1]
+      cols = S['indices'][a:b]
+      self.assertEqual(list(cols), list(expected(r)), "row %d" % r)
+      np.testing.assert_array_equal(S['score'][a:b], np.abs(self.dense['PEARSON'][r, cols]))
+      for name in self.dense:
+        np.testing.assert_array_equal(S[name][a:b], self.dense[name][r, cols])
+
+  def test_topk(self):
+    k = 3
+    score = np.abs(self.dense['PEARSON'])
+    np.fill_diagonal(score, -np.inf)
+    top = [set(np.argsort(-score[r])[:k]) for r in xrange(self.n)]
+    def expected(r):
+      # Pairs in the top k of either row, ranked within row r and cut to its k best.
+      cols = [c for c in xrange(self.n) if c in top[r] or r in top[c]]
+      return sorted(cols, key=lambda c: -score[r,c])[:k]
+    for buffer, ranges in [(sparse_edges.MERGE_BUFFER, [(0, 105)]), (20, [(0, 17), (17, 50), (50, 105)])]:
+      sparse_edges.MERGE_BUFFER = buffer
+      for fname in glob.glob(os.path.join(self.work_dir, "*")):
+        os.remove(fname)
+      self.check_rows(self.compile("topk:%d" % k, ranges), expected)
+
+  def test_abs_gt(self):
+    score = np.abs(self.dense['PEARSON'])
+    def expected(r):
+      cols = [c for c in xrange(self.n) if c != r and score[r,c] > 0.2]
+      return sorted(cols, key=lambda c: -score[r,c])
+    self.check_rows(self.compile("abs_gt:0.2", [(0, 40), (40, 105)]), expected)
+
+
+if __name__ == "__main__":
+  unittest.main()
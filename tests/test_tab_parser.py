@@ -0,0 +1,66 @@
+"""Tests of parsing .tab files to the memory-mapped .npy pair."""
+import cPickle as pickle
+import os
+import random
+import unittest
+import numpy as np
+import numpy.ma as ma
+import tab_parser
+import util
+from fixtures import WorkDirTest
+
+TOKENS = ['nan', 'None', 'N/A', 'none', 'NaN', '', '1', '-2.5', '3e2', ' 4 ', 'inf', '-0', '0.12345678901234567']
+
+
+def genfromtxt(tabfile):
+  """Return ([str], np.ma.MaskedArray) of row names and matrix as loaded before tab_parser."""
+  varlist = []
+  M = np.genfromtxt(util.name_iter(open(tabfile), varlist), usemask=True, delimiter='\t',
+    missing_values=util.MISSING_VALUES, dtype=np.float)
+  return varlist, M
+
+
+class TabParserTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    self.tabfile = os.path.join(self.work_dir, "x.tab")
+    rng = random.Random(0)
+    lines = ["# comment\n", "\n"]
+    for i in xrange(60):
+      end = "\r\n" if i % 3 == 0 else "\n"
+      lines.append("r%d\t" % i + "\t".join([rng.choice(TOKENS) for j in xrange(7)]) + end)
+    open(self.tabfile, 'w').write("".join(lines))
+    self.varlist, self.expected = genfromtxt(self.tabfile)
+
+  def assert_identical(self, M):
+    E = self.expected
+    self.assertEqual(M.dtype, E.dtype)
+    self.assertEqual(M.fill_value, E.fill_value)
+    np.testing.assert_array_equal(ma.getmaskarray(M), ma.getmaskarray(E))
+    # Bit-identical data, including nan at masked positions.
+    np.testing.assert_array_equal(np.asarray(ma.getdata(M)).view(np.uint64), ma.getdata(E).view(np.uint64))
+
+  def test_parse_tabfile(self):
+    data_fname, mask_fname = util.npy_pair_fnames(self.tabfile + ".pkl")
+    varlist_fname = self.tabfile + ".varlist.txt"
+    for n_workers, block_bytes in [(1, tab_parser.BLOCK_BYTES), (1, 100), (2, 100)]:
+      shape = tab_parser.parse_tabfile(self.tabfile, data_fname, mask_fname, varlist_fname,
+        util.MISSING_VALUES, n_workers, block_bytes)
+      self.assertEqual(shape, self.expected.shape)
+      self.assertEqual(open(varlist_fname).read().split('\n'), self.varlist)
+      self.assert_identical(util.load_masked(data_fname))
+
+  def test_npy_varlist_from_tabfile(self):
+    data_fname, n, M = util.npy_varlist_from_tabfile(self.tabfile, self.work_dir, save_pkl=True)
+    self.assertEqual(n, len(self.varlist))
+    self.assertEqual(util.npy_pair_fnames(data_fname)[0], data_fname)
+    self.assert_identical(M)
+    self.assert_identical(util.load_masked(data_fname))
+    self.assert_identical(pickle.load(open(self.tabfile + ".pkl")))
+    # An existing .npy pair is loaded as it was saved.
+    data_fname, n, M = util.npy_varlist_from_tabfile(self.tabfile, self.work_dir)
+    self.assert_identical(M)
+
+
+if __name__ == "__main__":
+  unittest.main()
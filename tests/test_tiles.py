@@ -0,0 +1,48 @@
+"""Tests of tile partitions computed by batch_pairwise.py and compiled by compile_pairwise.py."""
+import os
+import unittest
+import numpy as np
+import numpy.ma as ma
+import batch_pairwise
+import compile_pairwise
+from dispatch_pairwise import make_chunks
+from fixtures import WorkDirTest
+
+
+class TilesTest(WorkDirTest):
+  def setUp(self):
+    WorkDirTest.setUp(self)
+    rng = np.random.RandomState(0)
+    self.n = 11
+    self.M = ma.masked_array(rng.randn(self.n, 25), mask=rng.rand(self.n, 25) < 0.1)
+    self.num_pairs = self.n*(self.n-1)//2
+
+  def compiled(self, name, chunks, **kwds):
+    path = os.path.join(self.work_dir, name)
+    os.mkdir(path)
+    for span, suffix in chunks:
+      kwds.update(span)
+      batch_pairwise.main(npyfile='M.npy', work_dir=path, function='pearson', n=self.n, M=self.M, **kwds)
+    prefix = os.path.join(self.work_dir, name)
+    compile_pairwise.main(path=path, outpath_prefix=prefix, n=self.num_pairs)
+    self.assertFalse(os.path.exists(prefix + ".PEARSON.isset.npy"))
+    return np.load(prefix + ".PEARSON.values.npy")
+
+  def test_make_chunks(self):
+    for tile_rows in (2, 4, 11, 20):
+      chunks = make_chunks(self.num_pairs, self.n, 0, partition='tiles', tile_rows=tile_rows)
+      pairs = []
+      for span, suffix in chunks:
+        (x0, x1), (y0, y1) = batch_pairwise.parse_span(span['rows']), batch_pairwise.parse_span(span['cols'])
+        pairs += [(x, y) for x in xrange(x0, x1) for y in xrange(y0, y1) if x < y]
+      self.assertEqual(sorted(pairs), [(x, y) for x in xrange(self.n) for y in xrange(x+1, self.n)])
+
+  def test_tiles(self):
+    expected = self.compiled("range", make_chunks(self.num_pairs, self.n, 17))
+    chunks = make_chunks(self.num_pairs, self.n, 0, partition='tiles', tile_rows=4)
+    np.testing.assert_array_equal(self.compiled("tiles", chunks), expected)
+    np.testing.assert_allclose(self.compiled("block_tiles", chunks, block=True, tile=3), expected, rtol=1e-10)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -5,9 +5,12 @@ import datetime
 import cPickle as pickle
 import os
 import errno
+import inspect
+import numpy as np
 from numpy import ma
 from scipy.stats import mstats
 import shutil
+import tab_parser
 
 MISSING_VALUES = ",".join(["nan", "None", "N/A", "none", "NaN"])
 
@@ -45,10 +48,51 @@ FUNCTIONS = {
   'euclidean': EuclideanBatch,
   'kendalltau': KendallBatch,
   }
-IGNORE = ['euclidean', 'kendalltau']
+IGNORE = ['euclidean']
+
+def split_functions(function):
+  """Return list of function names in a function or fused functions str, e.g., pearson+dcor."""
+  names = str(function).split('+')
+  for name in names:
+    assert name in FUNCTIONS, "Unknown function %s." % name
+  assert len(set(names)) == len(names), "Repeated function in %s." % function
+  return names
+
+def make_batch(function, size, **kwds):
+  """Return Batch of size for function, or a FusedBatch for functions joined by '+'.
+
+  In a FusedBatch, keyword arguments are passed only to the Batches which accept them;
+  'backend' only to Batches which list it in BACKENDS.
+  """
+  names = split_functions(function)
+  if len(names) == 1:
+    return FUNCTIONS[function](size, **kwds)
+  batches = []
+  for name in names:
+    cls = FUNCTIONS[name]
+    args = inspect.getargspec(cls.__init__).args
+    F_kwds = dict([(k, v) for k, v in kwds.items() if k in args])
+    if 'backend' in F_kwds and F_kwds['backend'] not in getattr(cls, 'BACKENDS', {}):
+      del F_kwds['backend']
+    batches.append((name, cls(size, **F_kwds)))
+  return FusedBatch(size, batches)
+
+def batch_mnames(function, **kwds):
+  """Return {str: [str]} of matrix names of each function of a Batch made with kwds.
+
+  Matrix names may depend on kwds, e.g., DcorBatch adds DCOR_PV if n_perm > 0, so they
+  are taken from Batch instances (see make_batch) rather than from classes.
+  """
+  F = make_batch(function, 1, **kwds)
+  if isinstance(F, FusedBatch):
+    return dict([(name, B.MNAMES) for name, B in F.batches.items()])
+  return {function: F.MNAMES}
 
 def move_numpy_to_workdir(work_dir, npy_fname, do_copy=False):
   work_npy_fname = os.path.join(work_dir, os.path.basename(npy_fname))
+  if npy_fname.endswith(".data.npy"):
+    # Move the paired mask file along with the data file.
+    move_numpy_to_workdir(work_dir, npy_pair_fnames(npy_fname)[1], do_copy)
   if not os.path.exists(work_npy_fname):
     if do_copy:
       shutil.copyfile(npy_fname, work_npy_fname)
@@ -66,46 +110,90 @@ def read_samples(tabfile_1_coltitles):
   return sample_titles_1, sample_titles_set_1, idx_1
 
 
-def npy_varlist_from_tabfile(tabfile, outdir, overwrite=False):
-  """Convert .tab into pickled npy np.ma.MaskedArray matrix and variable list; save to disk.
+def npy_pair_fnames(npy_fname):
+  """Return (data, mask) .npy file names paired with a pickled masked matrix file name.
+
+  E.g., GSE7307.tab.pkl -> (GSE7307.tab.data.npy, GSE7307.tab.mask.npy)
+  """
+  for ext in (".pkl", ".data.npy"):
+    if npy_fname.endswith(ext):
+      npy_fname = npy_fname[:-len(ext)]
+  return npy_fname + ".data.npy", npy_fname + ".mask.npy"
+
+def save_npy_pair(M, npy_fname):
+  """Save masked matrix M as a data .npy and a mask .npy file pair. Return data file name."""
+  data_fname, mask_fname = npy_pair_fnames(npy_fname)
+  print "Saving %d rows, %d columns of matrix as data %s and mask %s..." % \
+      (np.size(M,0), np.size(M,1), data_fname, mask_fname)
+  np.save(data_fname, ma.getdata(M))
+  np.save(mask_fname, ma.getmaskarray(M))
+  return data_fname
+
+def load_masked(npyfile):
+  """Load a masked matrix.
+
+  A .data.npy file is opened memory-mapped with its .mask.npy file so that only rows
+  which are used are read from disk. A .pkl file is loaded as a level 2 pickle and
+  any other file as a level 0 numpy.MaskedArray pickle.
+  """
+  if npyfile.endswith(".data.npy"):
+    print "Loading as memory-mapped data and mask .npy pair"
+    data_fname, mask_fname = npy_pair_fnames(npyfile)
+    return ma.MaskedArray(np.load(data_fname, mmap_mode='r'), mask=np.load(mask_fname, mmap_mode='r'), copy=False)
+  elif npyfile.rpartition('.')[2].lower() == 'pkl':
+    print "Loading as level 2 pickle"
+    return pickle.load(open(npyfile))
+  else:
+    print "Loading as level 0 numpy.MaskedArray pickle"
+    return ma.load(npyfile)
+
+def npy_varlist_from_tabfile(tabfile, outdir, overwrite=False, n_workers=1, save_pkl=False):
+  """Convert .tab into a data .npy and mask .npy pair and variable list; save to disk.
+
+  The .tab is parsed in blocks by tab_parser straight to the .npy pair (see
+  npy_pair_fnames) for batch jobs to open memory-mapped with load_masked. The pickled
+  np.ma.MaskedArray is also saved if save_pkl.
 
   Args:
     tabfile: str of path to .tab input data file
+    n_workers: int of processes to parse the .tab file
   Returns:
-    (str, int, np.ma.MaskedArray) of path to pickled numpy object, rows in data matrix, M
+    (str, int, np.ma.MaskedArray) of path to the data .npy file (see npy_pair_fnames for
+      its mask .npy file), rows in data matrix, M
   """
   varlist_fname = os.path.join(outdir, os.path.basename(tabfile) + ".varlist.txt")
   npy_fname = os.path.join(outdir, "%s.pkl" % tabfile)
-  if not overwrite and os.path.exists(varlist_fname) and os.path.exists(npy_fname):
+  data_fname, mask_fname = npy_pair_fnames(npy_fname)
+  has_npy = os.path.exists(npy_fname) or (os.path.exists(data_fname) and os.path.exists(mask_fname))
+  if not overwrite and os.path.exists(varlist_fname) and has_npy:
     print "Both %s and %s exist, do not recreate varlist and pickled numpy masked matrix files." % \
         (varlist_fname, npy_fname)
     # load numpy matrix to get its size
     try:
-      M = pickle.load(open(npy_fname))
-    except EOFError:
+      if os.path.exists(data_fname) and os.path.exists(mask_fname):
+        M = load_masked(data_fname)
+      else:
+        M = pickle.load(open(npy_fname))
+        save_npy_pair(M, npy_fname)
+    except (EOFError, ValueError, IOError):
       # Some error may have occurred in a previous save. Reload .tab and overwrite pickle.
       print "Error reading %s. Attempt to recreate and overwrite." % (npy_fname)
-      return npy_varlist_from_tabfile(tabfile, outdir, overwrite=True)
+      return npy_varlist_from_tabfile(tabfile, outdir, True, n_workers, save_pkl)
     n = np.size(M, 0)
   else:
     # import tab
-    varlist = []
-    # M is masked matrix
     print "Loading %s into masked numpy matrix and varlist..." % tabfile
-    M = np.genfromtxt(name_iter(open(tabfile), varlist), usemask=True, delimiter='\t', missing_values=MISSING_VALUES, dtype=np.float)
-    n = np.size(M, 0) # number of rows (variables)
-    # save to file
-    print "Saving %d rows in varlist to %s..." % (len(varlist), varlist_fname)
-    fp = open(varlist_fname, "w")
-    fp.write('\n'.join(varlist))
-    fp.close()
-    print "Saving %d rows, %d columns of matrix as protocol 2 pickle to %s..." % \
-        (np.size(M,0), np.size(M,1), npy_fname)
-    pickle.dump(M, open(npy_fname, 'w'), protocol=2)
+    n, m = tab_parser.parse_tabfile(tabfile, data_fname, mask_fname, varlist_fname, MISSING_VALUES, n_workers)
+    # M is memory-mapped masked matrix
+    M = load_masked(data_fname)
+    if save_pkl:
+      print "Saving %d rows, %d columns of matrix as protocol 2 pickle to %s..." % \
+          (np.size(M,0), np.size(M,1), npy_fname)
+      pickle.dump(M, open(npy_fname, 'w'), protocol=2)
     
   n_nans = np.count_nonzero(np.isnan(M.compressed()))
-  assert n_nans == 0, "%d 'nan's exists in matrix %s!" % (n_nans, npy_fname)
-  return npy_fname, n, M
+  assert n_nans == 0, "%d 'nan's exists in matrix %s!" % (n_nans, data_fname)
+  return data_fname, n, M
   
 
 def print_matrix_stats(M1):